@@ -0,0 +1,72 @@
+import os
+import sys
+
+import click
+
+from msync.cli.playlists import get_default_paths
+from msync.config import load_config
+from msync.daemon import SOCKET_FILE, Daemon, send_request
+
+
+def request_daemon(request: dict) -> dict:
+    socket_path = os.path.join(get_default_paths()[0], SOCKET_FILE)
+    try:
+        response = send_request(socket_path, request)
+    except OSError:
+        click.echo("msync daemon is not running.")
+        sys.exit(1)
+
+    if not response["ok"]:
+        click.echo("Error: %s" % response["error"])
+        sys.exit(1)
+
+    return response
+
+
+@click.group()
+def daemon():
+    """Keep playlists synchronised in the background."""
+
+
+@daemon.command()
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Parallel downloads. Defaults to 'jobs' in config.",
+)
+def run(jobs):
+    """Run the daemon in the foreground."""
+    paths = get_default_paths()
+    config = load_config(paths[1])
+    if jobs is not None:
+        config["jobs"] = jobs
+
+    try:
+        Daemon(paths, config).serve()
+    except RuntimeError as e:
+        click.echo(e)
+        sys.exit(1)
+
+
+@daemon.command()
+def status():
+    """Show what the running daemon is doing."""
+    response = request_daemon({"command": "status"})
+
+    click.echo("Running since %s (pid %d)" % (response["started"], response["pid"]))
+    if response["syncing"]:
+        click.echo("Syncing: %s" % ", ".join(response["syncing"]))
+    for p in response["playlists"]:
+        last = p["last_sync"] or "never"
+        error = " (failed: %s)" % p["error"] if p["error"] else ""
+        click.echo(f"{p['id']}: last synced {last}{error}, next poll {p['next_poll']}")
+
+
+@daemon.command("sync")
+@click.argument("playlist_ids", nargs=-1)
+def sync_now(playlist_ids):
+    """Sync playlists now, every playlist if none are given."""
+    request_daemon({"command": "sync", "playlists": list(playlist_ids)})
+    click.echo("Sync requested.")
@@ -3,10 +3,22 @@ import os
 import click
 
 from msync import PROG
+from msync.cli.daemon import daemon
 from msync.cli.ffmpeg import ffmpeg
 from msync.cli.playlists import get_default_paths, playlists
-from msync.sync import synchronize
-from msync.utils import get_user_config_folder
+from msync.cli.storage import storage
+from msync.config import load_config
+from msync.convert import TARGETS, convert_library
+from msync.db import PlaylistDB
+from msync.ffstack import where as ffmpeg_location
+from msync.export import LAYOUTS, export_playlists
+from msync.gc import collect_garbage
+from msync.loudness import analyse_library
+from msync.scan import import_folder
+from msync.sync import plan_sync, synchronize_all
+from msync.transcode import cache_folder, profile_for, transcode_library
+from msync.verify import verify_library
+from msync.utils import get_user_config_folder, read_sync_list
 
 
 @click.group(PROG)
@@ -15,36 +27,331 @@ def cli():
 
 
 @click.command("sync")
-def sync():
+@click.option(
+    "--plan",
+    "show_plan",
+    is_flag=True,
+    help="Print the sync plan without downloading or linking anything.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print the plan as JSON.")
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Parallel downloads. Defaults to 'jobs' in config.",
+)
+def sync(show_plan, as_json, jobs):
     "Synchronise playlists in sync.lst"
-    pl = []
-    paths = get_default_paths()
-    try:
-        with open(os.path.join(paths[1], "sync.lst"), "r") as f:
-            for line in f.readlines():
-                line = line.strip()
-                if line.startswith("#"):
-                    continue
-                elif not line:
-                    continue
-
-                com = line.rfind(" #")
-                if com != -1:
-                    line = line[:com].strip()
-                pl.append(line)
-    except FileNotFoundError:
-        pl = []
+    paths = get_default_paths(make_folders=not show_plan)
+    pl = read_sync_list(os.path.join(paths[1], "sync.lst"))
 
     if len(pl) == 0:
         print("Sync List is empty!")
         return 1
 
+    if show_plan:
+        plan = plan_sync(pl, *paths[2:], prune=True, config_dir=paths[1])
+        print(plan.to_json() if as_json else plan.to_table())
+        return
+
     print("Synchronising %d playlist(s):" % len(pl))
 
-    for p in pl:
-        synchronize(p, *paths[2:])
+    config = load_config(paths[1])
+    if jobs is not None:
+        config["jobs"] = jobs
+
+    synchronize_all(pl, *paths[2:], prune=True, config=config)
+
+
+@click.command("gc")
+@click.option(
+    "--grace-days",
+    type=float,
+    default=None,
+    help="Days an unreferenced song is kept. Defaults to 'gc_grace_days' in config.",
+)
+@click.option("--dry-run", is_flag=True, help="Only show what would be deleted.")
+def gc(grace_days, dry_run):
+    "Delete stored songs which no playlist references anymore"
+    paths = get_default_paths()
+    if grace_days is None:
+        grace_days = load_config(paths[1])["gc_grace_days"]
+
+    db = PlaylistDB(paths[2])
+    deleted, orphaned, referenced = collect_garbage(db, paths[3], grace_days, dry_run)
+
+    for _, file_path in deleted:
+        print(("Would delete %s" if dry_run else "Deleted %s") % file_path)
+    print(
+        "%d file(s) %s, %d newly unreferenced, %d referenced again."
+        % (
+            len(deleted),
+            "would be deleted" if dry_run else "deleted",
+            orphaned,
+            referenced,
+        )
+    )
+
+
+@click.command("convert")
+@click.option(
+    "--codec",
+    "-c",
+    type=click.Choice(list(TARGETS)),
+    default="m4a",
+    show_default=True,
+    help="Format songs are converted to.",
+)
+@click.option(
+    "--processes",
+    "-p",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Encoding processes. Defaults to 'processes' in config.",
+)
+@click.option("--dry-run", is_flag=True, help="Only show what would be converted.")
+def convert(codec, processes, dry_run):
+    "Convert stored songs to another codec"
+    paths = get_default_paths()
+    if processes is None:
+        processes = load_config(paths[1])["processes"]
+
+    db = PlaylistDB(paths[2])
+    converted, failed = convert_library(
+        db, paths[3], codec, ffmpeg_location(), processes, dry_run
+    )
+
+    for old_path, new_path in converted:
+        print(("Would convert %s" if dry_run else "Converted %s") % old_path)
+    for path in failed:
+        print("Failed to convert %s" % path)
+    print(
+        "%d song(s) %s, %d failed."
+        % (
+            len(converted),
+            "would be converted" if dry_run else "converted",
+            len(failed),
+        )
+    )
+
+
+@click.command("import")
+@click.argument(
+    "folder", type=click.Path(exists=True, file_okay=False, resolve_path=True)
+)
+@click.option(
+    "--processes",
+    "-p",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Tag reading processes. Defaults to 'processes' in config.",
+)
+def import_(folder, processes):
+    "Register songs of an existing music folder, so they are not downloaded again"
+    paths = get_default_paths()
+    if processes is None:
+        processes = load_config(paths[1])["processes"]
+
+    db = PlaylistDB(paths[2])
+    result = import_folder(db, folder, processes)
+
+    print(
+        "%d file(s) found, %d read, %d unchanged."
+        % (result.files, result.read, result.files - result.read)
+    )
+    print(
+        "%d song(s) registered, %d already known, %d without a YouTube source."
+        % (result.registered, result.known, result.untagged)
+    )
+    if result.failed:
+        print("%d file(s) could not be read." % result.failed)
+
+
+@click.command("verify")
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Hash unchanged files too, to find corruption which kept size and mtime.",
+)
+@click.option(
+    "--processes",
+    "-p",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Checking processes. Defaults to 'processes' in config.",
+)
+def verify(full, processes):
+    "Check stored songs and queue broken ones for download by the next sync"
+    paths = get_default_paths()
+    if processes is None:
+        processes = load_config(paths[1])["processes"]
+
+    db = PlaylistDB(paths[2])
+    result = verify_library(db, processes, full)
+
+    for path, problem in result.broken:
+        print("Broken: %s (%s)" % (path, problem))
+    print(
+        "%d song file(s) checked, %d read, %d unchanged, %d broken."
+        % (result.checked, result.read, result.unchanged, len(result.broken))
+    )
+    if result.broken:
+        print("Broken songs are downloaded again on the next sync.")
+
+
+@click.command("replaygain")
+@click.option("--full", is_flag=True, help="Measure unchanged files again too.")
+@click.option(
+    "--processes",
+    "-p",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Measuring processes. Defaults to 'processes' in config.",
+)
+def replaygain(full, processes):
+    "Measure the loudness of stored songs and write ReplayGain tags"
+    paths = get_default_paths()
+    if processes is None:
+        processes = load_config(paths[1])["processes"]
+
+    db = PlaylistDB(paths[2])
+    result = analyse_library(db, ffmpeg_location(), processes, full)
+
+    for path in result.failed:
+        print("Failed to measure or tag %s" % path)
+    print(
+        "%d song file(s) checked, %d measured, %d unchanged, %d tagged."
+        % (
+            result.checked,
+            result.measured,
+            result.unchanged,
+            result.tagged,
+        )
+    )
+    print("%d playlist(s) with an album gain." % result.albums)
+
+
+@click.command("transcode")
+@click.option(
+    "--profile",
+    required=True,
+    help="Transcode profile, from 'transcode_profiles' in config.",
+)
+@click.option(
+    "--processes",
+    "-p",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Encoding processes. Defaults to 'processes' in config.",
+)
+@click.option("--dry-run", is_flag=True, help="Only show what would be done.")
+def transcode(profile, processes, dry_run):
+    "Transcode synced songs for a device profile into its cache"
+    paths = get_default_paths()
+    config = load_config(paths[1])
+    if processes is None:
+        processes = config["processes"]
+    try:
+        settings = profile_for(config, profile)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--profile")
+    cache_dir = cache_folder(config, paths[0], profile)
+
+    db = PlaylistDB(paths[2])
+    result = transcode_library(
+        db, settings, cache_dir, ffmpeg_location(), processes, dry_run
+    )
+
+    for path in result.failed:
+        print("Failed to transcode %s" % path)
+    print(
+        "%d synced song(s), %d transcoded, %d cached, %d evicted%s."
+        % (
+            result.songs,
+            result.transcoded,
+            result.cached,
+            result.evicted,
+            " (dry run)" if dry_run else "",
+        )
+    )
+
+
+@click.command("export")
+@click.argument(
+    "mountpoint", type=click.Path(exists=True, file_okay=False, resolve_path=True)
+)
+@click.option(
+    "--playlists",
+    "names",
+    multiple=True,
+    help="Playlist names or IDs, comma separated or repeated. Defaults to every "
+    "synced playlist.",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(LAYOUTS),
+    default="m3u",
+    show_default=True,
+    help="Songs in one Tracks folder, or in the folder of their first playlist. "
+    "Playlists are M3U files either way.",
+)
+@click.option(
+    "--profile",
+    default=None,
+    help="Export the transcodes of this profile, see msync transcode.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Files copied at the same time.",
+)
+@click.option("--dry-run", is_flag=True, help="Only show what would be copied.")
+def export(mountpoint, names, layout, profile, jobs, dry_run):
+    "Copy playlists to a mounted device, only what changed since the last export"
+    paths = get_default_paths()
+    config = load_config(paths[1])
+    names = [name for value in names for name in value.split(",") if name] or None
+    if profile is not None:
+        try:
+            settings = profile_for(config, profile)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--profile")
+        profile = (settings, cache_folder(config, paths[0], profile))
+
+    db = PlaylistDB(paths[2])
+    result = export_playlists(db, mountpoint, names, layout, profile, jobs, dry_run)
+
+    if result.missing:
+        print(
+            "%d song(s) skipped without a transcode, run msync transcode first."
+            % len(result.missing)
+        )
+    print(
+        "%d playlist(s), %d unique song(s): %d copied (%.1f MiB), %d removed%s."
+        % (
+            result.playlists,
+            result.tracks,
+            result.copied,
+            result.copied_bytes / 1024**2,
+            result.removed,
+            " (dry run)" if dry_run else "",
+        )
+    )
 
 
 cli.add_command(ffmpeg)
 cli.add_command(playlists)
 cli.add_command(sync)
+cli.add_command(gc)
+cli.add_command(convert)
+cli.add_command(import_)
+cli.add_command(verify)
+cli.add_command(replaygain)
+cli.add_command(transcode)
+cli.add_command(export)
+cli.add_command(storage)
+cli.add_command(daemon)
@@ -6,12 +6,13 @@ import click
 import msync.db as dba
 import msync.sync as msc
 from msync import PROG
+from msync.config import load_config
 from msync.utils import get_user_config_folder, get_user_data_folder
 
 
-def get_default_paths():
-    data_dir = get_user_data_folder()
-    config_dir = get_user_config_folder()
+def get_default_paths(make_folders: bool = True):
+    data_dir = get_user_data_folder(make_folders)
+    config_dir = get_user_config_folder(make_folders)
     db_path = os.path.join(data_dir, dba.DB_FILE)
     storage_path = os.path.join(data_dir, "storage")
     music_path = os.path.expanduser("~/Music")
@@ -35,5 +36,17 @@ def show_playlists():
 
 @playlists.command("sync")
 @click.argument("playlist_id")
-def sync(playlist_id):
-    msc.synchronize(playlist_id, *get_default_paths()[2:])
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Parallel downloads. Defaults to 'jobs' in config.",
+)
+def sync(playlist_id, jobs):
+    paths = get_default_paths()
+    config = load_config(paths[1])
+    if jobs is not None:
+        config["jobs"] = jobs
+
+    msc.synchronize(playlist_id, *paths[2:], config=config)
@@ -0,0 +1,26 @@
+import click
+
+from msync.cli.playlists import get_default_paths
+from msync.db import PlaylistDB
+from msync.storage import migrate_storage
+
+
+@click.group()
+def storage():
+    """Manage the song storage."""
+
+
+@storage.command()
+def migrate():
+    """Move stored songs into the sharded, video ID keyed layout."""
+    paths = get_default_paths()
+    db = PlaylistDB(paths[2])
+
+    moved, shared, missing = migrate_storage(db, paths[3])
+    click.echo("%d song(s) moved." % moved)
+    if shared:
+        click.echo(
+            "%d song(s) shared a file with another video of the same name." % shared
+        )
+    if missing:
+        click.echo("%d song(s) are missing from storage." % missing)
@@ -0,0 +1,105 @@
+"""
+msync/config.py - User configuration.
+
+Settings are read from config.json in the user config folder. Keys missing from the
+file fall back to DEFAULTS.
+
+"""
+
+import json
+import os
+
+from .utils import get_user_config_folder
+
+CONFIG_FILE = "config.json"
+
+DEFAULTS = {
+    # Download bandwidth shared by all downloads in KiB/s, 0 is unlimited.
+    "bandwidth_limit_kib": 0,
+    # Codec policy of downloads. "m4a" prefers AAC sources and encodes others to
+    # AAC, "native" keeps every source codec (Opus, AAC, ...) by stream copy only.
+    "codec": "m4a",
+    # Size cap of the cover art cache in MiB, least recently used covers go first.
+    "cover_cache_mb": 200,
+    # Largest width and height of embedded cover art in pixels.
+    "cover_size": 600,
+    # What to do with re-uploads of a song already stored or being downloaded,
+    # matched on normalised artist and title and on duration: "link" registers
+    # them on the file of the original, "download" downloads them anyway.
+    "duplicates": "link",
+    # Kinds of uploads, most preferred first, deciding which of several stored
+    # copies a re-upload is linked to: "topic" (auto-generated "- Topic" tracks),
+    # "official", "other" and "lyric" videos.
+    "duplicate_preference": ["topic", "official", "other", "lyric"],
+    # Days a song stays in storage after no playlist references it anymore.
+    "gc_grace_days": 7,
+    # Number of songs downloaded at the same time.
+    "jobs": 4,
+    # MPD server receiving stored playlists of playlists with the "mpd" output.
+    # Songs under music_directory, MPD's own, are sent relative to it, others as
+    # absolute paths which MPD only accepts over its local socket.
+    "mpd": {"host": "localhost", "port": 6600, "music_directory": ""},
+    # Share of a playlist's links which must change for its folder to be rebuilt
+    # beside the old one and swapped in, instead of being changed link by link.
+    "link_swap_ratio": 0.25,
+    # How playlists are shown to music players: "symlink" folders, "hardlink"
+    # folders, "m3u8" playlist files or "mpd" stored playlists.
+    "output": "symlink",
+    # Minutes between two polls of a playlist by the daemon.
+    "poll_interval_minutes": 30,
+    # Per playlist poll intervals in minutes, overriding poll_interval_minutes.
+    "poll_intervals": {},
+    # Per playlist outputs by playlist ID, overriding output.
+    "playlist_outputs": {},
+    # Fraction of the poll interval randomly added or removed, so playlists
+    # drift apart instead of being polled in bursts.
+    "poll_jitter": 0.1,
+    # Processes converting and tagging downloads, 0 uses every core.
+    "processes": 0,
+    # Capacity of the queues between download pipeline stages.
+    "queue_size": 8,
+    # Requests to YouTube per minute, downloads and playlist fetches alike. 0 is
+    # unlimited.
+    "requests_per_minute": 120,
+    # Hours a playlist may be trusted to be unchanged from a cheap check before it
+    # is fully enumerated again.
+    "snapshot_max_age_hours": 24,
+    # Seconds a download may wait for its first byte before it counts as slow and
+    # concurrency is reduced, 0 never does.
+    "slow_request_seconds": 30,
+    # Folder holding a cache folder per transcode profile. Defaults to
+    # "transcodes" in the user data folder.
+    "transcode_dir": "",
+    # Named device profiles for msync transcode: "codec" ("opus", "mp3" or "m4a"),
+    # "bitrate" as given to ffmpeg and "sample_rate" in Hz.
+    "transcode_profiles": {
+        "phone": {"codec": "opus", "bitrate": "96k", "sample_rate": 48000},
+        "car": {"codec": "mp3", "bitrate": "192k", "sample_rate": 44100},
+    },
+    # Seconds requests pause after YouTube throttles us, doubled while it continues.
+    "throttle_backoff_seconds": 30,
+}
+
+
+def load_config(config_dir: str = "") -> dict:
+    """Returns user configuration merged over the defaults.
+
+    Args:
+        config_dir (str, optional): Folder containing config.json. Defaults to the
+            user config folder.
+
+    Returns:
+        dict: configuration
+    """
+    config = dict(DEFAULTS)
+    path = os.path.join(config_dir or get_user_config_folder(), CONFIG_FILE)
+    try:
+        with open(path) as f:
+            config.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    for key, value in DEFAULTS.items():  # settings grouped in a dict merge as well
+        if isinstance(value, dict) and config[key] is not value:
+            config[key] = {**value, **config[key]}
+
+    return config
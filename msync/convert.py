@@ -0,0 +1,134 @@
+"""
+msync/convert.py - Batch conversion of stored songs to another codec.
+
+For players which need a specific codec after songs were kept in their native
+codec. Tags and cover art are carried over, and playlist links are moved to the
+converted files. Only files msync stored are converted, files registered by msync
+import are the user's own and left as they are.
+
+"""
+
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from mutagen import MutagenError
+
+from .db import PlaylistDB
+from .plan import LibraryIndex, link_index
+from .tags import embed_cover, read_cover, read_tags, write_tags
+from .verify import fingerprint
+from .youtube.postprocess import run_ffmpeg
+
+# Target extension -> ffmpeg encoder arguments
+TARGETS = {
+    "m4a": ["-c:a", "aac", "-b:a", "192k"],
+    "opus": ["-c:a", "libopus", "-b:a", "128k"],
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "192k"],
+}
+
+
+def owned_files(db: PlaylistDB, storage_dir: str, paths) -> list[str]:
+    """Returns the files among `paths` which msync stored and may move or replace.
+
+    Files outside the storage folder or registered by msync import are skipped.
+    """
+    prefix = os.path.join(os.path.abspath(storage_dir), "")
+    imported = db.get_scan_cache(os.sep)
+    return [path for path in paths if path.startswith(prefix) and path not in imported]
+
+
+def converted_path(path: str, target: str) -> str:
+    return os.path.splitext(path)[0] + "." + target
+
+
+def convert_file(path: str, target: str, ffmpeg_string: str) -> str:
+    """Encodes a song to `target` next to it, keeping tags and cover art.
+
+    Returns:
+        str: path of the converted song
+    """
+    output = converted_path(path, target)
+    converting = os.path.splitext(path)[0] + ".converting." + target
+
+    tags = read_tags(path)
+    if not tags["title"]:  # untaggable source, use the storage name
+        artist, _, title = os.path.splitext(os.path.basename(path))[0].partition(" - ")
+        tags.update(artist=artist, title=title)
+    cover = read_cover(path)
+
+    run_ffmpeg(
+        ffmpeg_string, "-i", path, "-vn", "-map", "0:a:0", *TARGETS[target], converting
+    )
+    write_tags(converting, tags["title"], tags["artist"], tags["url"])
+    if cover:
+        embed_cover(converting, cover)
+    os.replace(converting, output)
+
+    return output
+
+
+def relink(links: dict[str, list[str]], old_path: str, new_path: str):
+    """Points playlist links of `old_path` at `new_path`, adopting its extension."""
+    extension = os.path.splitext(new_path)[1]
+    for link in links.get(old_path, []):
+        os.unlink(link)
+        os.symlink(new_path, os.path.splitext(link)[0] + extension)
+
+
+def convert_library(
+    db: PlaylistDB,
+    storage_dir: str,
+    target: str,
+    ffmpeg_string: str,
+    processes: int = 0,
+    dry_run: bool = False,
+) -> tuple[list[tuple[str, str]], list[str]]:
+    """Converts every stored song which is not already in the `target` format.
+
+    Args:
+        db (PlaylistDB): Database.
+        storage_dir (str): Folder where songs are stored.
+        target (str): Extension of the wanted format, one of TARGETS.
+        ffmpeg_string (str): ffmpeg location.
+        processes (int, optional): Encoding processes, 0 uses every core.
+        dry_run (bool, optional): Only report what would be converted.
+
+    Returns:
+        tuple[list, list]: converted (old path, new path) pairs, paths which
+            failed to convert.
+    """
+    paths = sorted(
+        {
+            file_path
+            for (file_path,) in db.cur.execute(
+                f"SELECT file_path FROM {db.SONGS_TABLE};"
+            ).fetchall()
+            if not file_path.endswith("." + target) and os.path.exists(file_path)
+        }
+    )
+    paths = owned_files(db, storage_dir, paths)
+    if dry_run:
+        return [(path, converted_path(path, target)) for path in paths], []
+
+    links = link_index(folder for _, folder in LibraryIndex(db).enabled.values())
+    converted, failed = [], []
+    with ProcessPoolExecutor(max_workers=processes or None) as pool:
+        futures = [
+            (path, pool.submit(convert_file, path, target, ffmpeg_string))
+            for path in paths
+        ]
+        for path, future in futures:
+            try:
+                new_path = future.result()
+            except (subprocess.CalledProcessError, OSError, MutagenError):
+                failed.append(path)  # unreadable, or no ffmpeg at all
+                continue
+
+            db.update_song_file(path, new_path, commit=False)
+            db.set_fingerprints([(new_path, fingerprint(new_path))])
+            relink(links, path, new_path)
+            os.remove(path)
+            converted.append((path, new_path))
+
+    return converted, failed
@@ -0,0 +1,374 @@
+"""
+msync/daemon.py - Long running synchronisation with scheduled polling.
+
+The daemon looks up ffmpeg once and runs every sync on its worker thread, with a
+database connection of its own per sync. Every playlist in sync.lst is polled on
+its own interval with jitter, edits to sync.lst are picked up immediately through
+inotify (or by watching its mtime where inotify is unavailable), and a unix socket
+in the data folder takes JSON line requests from the CLI.
+
+"""
+
+import ctypes
+import ctypes.util
+import datetime
+import json
+import os
+import random
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from .db import PlaylistDB
+from .ffstack import where as ffmpeg_location
+from .sync import synchronize_all
+from .utils import read_sync_list
+
+SOCKET_FILE = "daemon.sock"
+SYNC_LIST_FILE = "sync.lst"
+
+# inotify(7) events which mean a file in the watched folder changed. Editors
+# usually replace files instead of writing them in place.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def inotify_watch(folder: str):
+    """Returns an inotify file descriptor watching `folder`, None if unsupported."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (AttributeError, OSError):  # not Linux
+        return None
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def read_inotify_names(fd: int) -> list[str]:
+    """Reads pending inotify events and returns the file names they concern."""
+    data = os.read(fd, 4096)
+    names = []
+    offset = 0
+    while offset < len(data):
+        _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+        offset += length
+
+    return names
+
+
+def mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def watch_file(path: str, on_change, stop: threading.Event, interval: float = 2.0):
+    """Calls `on_change` whenever `path` is written, replaced or deleted.
+
+    Args:
+        path (str): Watched file, its folder must exist.
+        on_change (Callable): Called without arguments on every change.
+        stop (threading.Event): Watching ends once it is set.
+        interval (float, optional): Seconds between mtime checks when inotify is
+            unavailable. Defaults to 2.0.
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    fd = inotify_watch(folder)
+
+    if fd is None:
+        last = mtime(path)
+        while not stop.wait(interval):
+            current = mtime(path)
+            if current != last:
+                last = current
+                on_change()
+        return
+
+    try:
+        while not stop.is_set():
+            ready, _, _ = select.select([fd], [], [], 1.0)
+            if ready and name in read_inotify_names(fd):
+                on_change()
+    finally:
+        os.close(fd)
+
+
+def isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+
+
+class Daemon:
+    """Daemon class.
+
+    Polls the playlists of sync.lst, each on its own schedule. Syncs run one at a
+    time on a worker thread which owns the database connection, playlists falling
+    due together are synchronised in one session. Other threads only touch the
+    schedule under `cond`.
+    """
+
+    def __init__(self, paths, config: dict) -> None:
+        """
+        Args:
+            paths (tuple): get_default_paths() result.
+            config (dict): User configuration.
+        """
+        data_dir, config_dir, self.db_path, self.storage_dir, self.music_dir = paths
+        self.config = config
+        self.sync_list_path = os.path.join(config_dir, SYNC_LIST_FILE)
+        self.socket_path = os.path.join(data_dir, SOCKET_FILE)
+
+        self.cond = threading.Condition()
+        self.stopping = threading.Event()
+        self.started = time.time()
+        self.synced_ids: list[str] = []
+        self.schedule: dict[str, float] = {}  # yt playlist id -> next poll time
+        self.last: dict[str, dict] = {}  # yt playlist id -> last sync time and error
+        self.requested: set[str] = set()
+        self.syncing: list[str] = []
+        self.reload = True
+
+    def interval(self, yt_playlist_id: str) -> float:
+        """Returns seconds until the next poll of a playlist, jitter included."""
+        minutes = self.config["poll_intervals"].get(
+            yt_playlist_id, self.config["poll_interval_minutes"]
+        )
+        jitter = self.config["poll_jitter"]
+
+        return minutes * 60 * (1 + random.uniform(-jitter, jitter))
+
+    def request_reload(self):
+        with self.cond:
+            self.reload = True
+            self.cond.notify()
+
+    def request_sync(self, yt_playlist_ids=()) -> list[str]:
+        """Asks for an immediate sync of the given playlists, or of every playlist.
+
+        Returns:
+            list[str]: requested playlist IDs which are not in sync.lst
+        """
+        with self.cond:
+            ids = list(yt_playlist_ids) or self.synced_ids
+            unknown = [i for i in ids if i not in self.schedule]
+            self.requested.update(i for i in ids if i in self.schedule)
+            self.cond.notify()
+
+        return unknown
+
+    def stop(self):
+        self.stopping.set()
+        with self.cond:
+            self.cond.notify()
+
+    def status(self) -> dict:
+        with self.cond:
+            return {
+                "pid": os.getpid(),
+                "started": isoformat(self.started),
+                "syncing": list(self.syncing),
+                "playlists": [
+                    {
+                        "id": yt_playlist_id,
+                        "next_poll": isoformat(self.schedule[yt_playlist_id]),
+                        "last_sync": isoformat(
+                            self.last.get(yt_playlist_id, {}).get("time")
+                        ),
+                        "error": self.last.get(yt_playlist_id, {}).get("error"),
+                    }
+                    for yt_playlist_id in self.synced_ids
+                ],
+            }
+
+    def handle(self, request: dict) -> dict:
+        """Answers a control socket request."""
+        command = request.get("command")
+        if command == "status":
+            return {"ok": True, **self.status()}
+        elif command == "sync":
+            unknown = self.request_sync(request.get("playlists") or ())
+            if unknown:
+                return {
+                    "ok": False,
+                    "error": "not in sync.lst: %s" % ", ".join(unknown),
+                }
+            return {"ok": True}
+
+        return {"ok": False, "error": "unknown command %r" % command}
+
+    def reload_sync_list(self) -> bool:
+        """Schedules added playlists right away. Must hold `cond`.
+
+        Returns:
+            bool: True if playlists were removed, so a sync must drop them
+        """
+        ids = read_sync_list(self.sync_list_path)
+        removed = set(self.schedule) - set(ids)
+        for yt_playlist_id in removed:
+            del self.schedule[yt_playlist_id]
+            self.last.pop(yt_playlist_id, None)
+        for yt_playlist_id in ids:
+            self.schedule.setdefault(yt_playlist_id, time.time())
+        self.requested &= set(ids)
+        self.synced_ids = ids
+
+        return bool(removed)
+
+    def wait_due(self):
+        """Blocks until playlists are due. Must hold `cond`.
+
+        Returns:
+            list[str] | None: due playlist IDs, None once stopping
+        """
+        while not self.stopping.is_set():
+            dropped = False
+            if self.reload:
+                self.reload = False
+                dropped = self.reload_sync_list()
+
+            now = time.time()
+            due = [
+                yt_playlist_id
+                for yt_playlist_id, next_poll in self.schedule.items()
+                if next_poll <= now or yt_playlist_id in self.requested
+            ]
+            if due or dropped:
+                self.requested.clear()
+                return due
+
+            timeout = None
+            if self.schedule:
+                timeout = min(self.schedule.values()) - now
+            self.cond.wait(timeout)
+
+        return None
+
+    def work(self):
+        ffmpeg_string = ffmpeg_location()
+
+        while True:
+            with self.cond:
+                due = self.wait_due()
+                if due is None:
+                    break
+                self.syncing = due
+                synced_ids = list(self.synced_ids)
+
+            # A connection per cycle, opened by this thread: nothing a failed cycle
+            # left uncommitted can be committed by the next one
+            db = PlaylistDB(self.db_path)
+            error = None
+            try:
+                synchronize_all(
+                    due,
+                    self.db_path,
+                    self.storage_dir,
+                    self.music_dir,
+                    prune=True,
+                    config=self.config,
+                    synced_ids=synced_ids,
+                    db=db,
+                    ffmpeg_string=ffmpeg_string,
+                )
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                print("Sync failed: %s" % error)
+            finally:
+                db.conn.close()
+
+            now = time.time()
+            with self.cond:
+                for yt_playlist_id in due:
+                    if yt_playlist_id in self.schedule:
+                        self.schedule[yt_playlist_id] = now + self.interval(
+                            yt_playlist_id
+                        )
+                        self.last[yt_playlist_id] = {"time": now, "error": error}
+                self.syncing = []
+
+    def bind(self) -> socketserver.ThreadingUnixStreamServer:
+        if os.path.exists(self.socket_path):
+            try:
+                send_request(self.socket_path, {"command": "status"})
+            except OSError:  # left behind by a daemon which died
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError("msync daemon is already running")
+
+        server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, ControlHandler
+        )
+        server.daemon_threads = True
+        server.msync_daemon = self
+        return server
+
+    def serve(self):
+        """Runs the daemon until interrupted."""
+        server = self.bind()
+        worker = threading.Thread(target=self.work, daemon=True)
+        watcher = threading.Thread(
+            target=watch_file,
+            args=(self.sync_list_path, self.request_reload, self.stopping),
+            daemon=True,
+        )
+        worker.start()
+        watcher.start()
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print()
+            print("Exiting... (user interrupt)")
+        finally:
+            # A sync cut short here is resumed from the journal next time
+            self.stop()
+            server.server_close()
+            os.unlink(self.socket_path)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Answers JSON line requests like {"command": "status"} on the control socket."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.msync_daemon.handle(json.loads(line))
+            except (ValueError, AttributeError) as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def send_request(socket_path: str, request: dict, timeout: float = 10.0) -> dict:
+    """Sends one request to a running daemon and returns its response.
+
+    Raises:
+        OSError: no daemon listens on `socket_path`
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(request).encode() + b"\n")
+        with s.makefile("rb") as f:
+            line = f.readline()
+
+    return json.loads(line)
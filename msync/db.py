@@ -1,11 +1,41 @@
 import sqlite3
 import datetime
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import quote
 from uuid import uuid4 as gen_uuid
 
 
 DB_FILE = "synchronisation_data.db"
 
+# Version of the schema created by this code, see PlaylistDB.__migrate
+SCHEMA_VERSION = 6
+
+# Set on every connection. WAL lets readers work while a sync writes and, with
+# synchronous=NORMAL, only syncs to disk at checkpoints instead of every commit.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # KiB
+    "temp_store": "MEMORY",
+}
+
+# Attempts at inserting rows under new UUIDs before a collision is raised
+ID_RETRIES = 3
+
+# A Writer commits after this many mutations or milliseconds, whichever is first
+GROUP_COMMIT_SIZE = 256
+GROUP_COMMIT_MS = 50
+
+
+def set_pragmas(conn: sqlite3.Connection):
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value};")
+
 
 class PlaylistDB:
     """
@@ -17,48 +47,92 @@ class PlaylistDB:
 
     PLAYLIST_TABLE = "playlists"
     SONGS_TABLE = "songs"
+    JOBS_TABLE = "jobs"
+    SNAPSHOTS_TABLE = "playlist_snapshots"
+    TITLES_TABLE = "title_cache"
+    SONG_PLAYLISTS_TABLE = "song_playlists"
+    SCHEMA_TABLE = "schema_version"
+    SCAN_CACHE_TABLE = "scan_cache"
+    LOUDNESS_TABLE = "loudness"
 
-    def __init__(self, db_path: str) -> None:
+    def __init__(self, db_path: str, read_only: bool = False) -> None:
         """Creates a database (if it doesn't exist), connects to it and sets up playlist and songs tables.
 
         Args:
             db_path (str): Database file.
+            read_only (bool, optional): Work on an in-memory copy of the database,
+                migrated there, so the file is never created or written. Defaults
+                to False.
         """
-        self.conn = sqlite3.connect(db_path)
+        self.path = db_path
+        if read_only:
+            uri = "file:%s?mode=ro" % quote(os.path.abspath(db_path))
+            source = sqlite3.connect(uri, uri=True)
+            self.conn = sqlite3.connect(":memory:")
+            source.backup(self.conn)
+            source.close()
+        else:
+            self.conn = sqlite3.connect(db_path)
         self.cur = self.conn.cursor()
 
+        set_pragmas(self.conn)
         self.__setup_database()
 
     def __del__(self) -> None:
-        self.cur.close()
-        self.conn.close()
+        self.conn.close()  # and its cursor, even if closed already
 
-    def __generate_id(self, check_collision: bool = True) -> str:
-        UUID_EXTRACT = f"""
-            SELECT 
-                playlist_id 
-            FROM 
-                {self.PLAYLIST_TABLE} 
-            UNION 
-            SELECT 
-                song_id 
-            FROM 
-                {self.SONGS_TABLE};
-        """
+    def __generate_id(self) -> str:
+        return str(gen_uuid())
 
-        uuids = []
-        if check_collision:
-            uuids = self.cur.execute(UUID_EXTRACT).fetchall()
+    def __insert_with_ids(self, statement: str, rows: list[tuple]) -> list[str]:
+        """Inserts rows under new UUIDs, which are bound before each row's values.
 
-        uuid = str(gen_uuid())
+        Ids are kept unique by the table's UNIQUE id column. In the unlikely case of
+        a collision the batch is rolled back and retried with fresh ids.
 
-        # Collision check Just in case, yk :)
-        while (uuid,) in uuids:
-            uuid = str(gen_uuid())
+        Args:
+            statement (str): INSERT statement taking the id first.
+            rows (list[tuple]): Values of the other columns.
+
+        Returns:
+            list[str]: the ids, in the order of `rows`
+        """
+        if not self.conn.in_transaction:
+            self.cur.execute("BEGIN;")  # or RELEASE would commit
 
-        return uuid
+        for attempt in range(ID_RETRIES):
+            ids = [self.__generate_id() for _ in rows]
+            self.cur.execute("SAVEPOINT new_ids;")
+            try:
+                self.cur.executemany(
+                    statement, [(i, *row) for i, row in zip(ids, rows)]
+                )
+                return ids
+            except sqlite3.IntegrityError:
+                self.cur.execute("ROLLBACK TO new_ids;")
+                if attempt == ID_RETRIES - 1:
+                    raise
+            finally:
+                self.cur.execute("RELEASE new_ids;")
 
-    def __setup_database(self, commit=True) -> None:
+    def __setup_database(self) -> None:
+        """Creates missing tables and migrates the schema, in one transaction.
+
+        The write lock is taken first, so concurrent msync processes opening an old
+        database wait for the one migrating it.
+        """
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.cur.execute("BEGIN IMMEDIATE;")
+        try:
+            self.__create_tables()
+            self.__migrate()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def __create_tables(self) -> None:
         CREATE_PLAYLIST_TABLE = f"""CREATE TABLE IF NOT EXISTS {self.PLAYLIST_TABLE} (
                 enabled integer NOT NULL,
                 playlist_id text NOT NULL UNIQUE,
@@ -71,29 +145,243 @@ class PlaylistDB:
         CREATE_SONGS_TABLE = f"""CREATE TABLE IF NOT EXISTS {self.SONGS_TABLE} (
                 song_id text NOT NULL UNIQUE,
                 file_path text NOT NULL,
-                yt_song_id text,
-                playlists text
+                yt_song_id text
+            );"""
+
+        CREATE_JOBS_TABLE = f"""CREATE TABLE IF NOT EXISTS {self.JOBS_TABLE} (
+                yt_song_id text NOT NULL UNIQUE,
+                state text NOT NULL,
+                partial_path text,
+                job text,
+                update_time text
             );"""
 
         self.cur.execute(CREATE_PLAYLIST_TABLE)
         self.cur.execute(CREATE_SONGS_TABLE)
+        CREATE_SNAPSHOTS_TABLE = f"""CREATE TABLE IF NOT EXISTS {self.SNAPSHOTS_TABLE} (
+                yt_playlist_id text NOT NULL UNIQUE,
+                video_ids text NOT NULL,
+                titles text NOT NULL,
+                channels text NOT NULL,
+                playlist_count integer,
+                fetch_time text
+            );"""
 
-        if commit:
-            self.conn.commit()
+        CREATE_TITLES_TABLE = f"""CREATE TABLE IF NOT EXISTS {self.TITLES_TABLE} (
+                yt_song_id text NOT NULL,
+                raw_title text NOT NULL,
+                artist text NOT NULL,
+                title text NOT NULL,
+                parser_version text NOT NULL,
+                PRIMARY KEY (yt_song_id, raw_title)
+            );"""
+
+        self.cur.execute(CREATE_JOBS_TABLE)
+        self.cur.execute(CREATE_SNAPSHOTS_TABLE)
+        self.cur.execute(CREATE_TITLES_TABLE)
+
+    def __migrate(self) -> None:
+        """Upgrades the schema version by version up to SCHEMA_VERSION.
+
+        Databases created before versioning count as version 0. Missing tables are
+        created by __create_tables without any column a version adds, so a new
+        database goes through every migration like an old one; those converting
+        old data, such as version 1, find none and only create what they add.
+        """
+        CREATE_SCHEMA_TABLE = f"""CREATE TABLE IF NOT EXISTS {self.SCHEMA_TABLE} (
+                version integer NOT NULL
+            );"""
+        FETCH_VERSION = f"SELECT max(version) FROM {self.SCHEMA_TABLE};"
+        CLEAR_VERSION = f"DELETE FROM {self.SCHEMA_TABLE};"
+        INSERT_VERSION = f"INSERT INTO {self.SCHEMA_TABLE} VALUES (?);"
+
+        migrations = [
+            self.__migrate_memberships,
+            self.__create_scan_cache,
+            self.__add_fingerprints,
+            self.__add_durations,
+            self.__create_loudness,
+            self.__add_sync_columns,
+        ]
+
+        self.cur.execute(CREATE_SCHEMA_TABLE)
+        version = self.cur.execute(FETCH_VERSION).fetchone()[0] or 0
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                "%s has schema version %d, this msync only knows up to %d"
+                % (self.path, version, SCHEMA_VERSION)
+            )
+
+        for migration in migrations[version:SCHEMA_VERSION]:
+            migration()
+        if version < SCHEMA_VERSION:
+            self.cur.execute(CLEAR_VERSION)
+            self.cur.execute(INSERT_VERSION, (SCHEMA_VERSION,))
+
+    def __migrate_memberships(self) -> None:
+        """Version 1: memberships move from the comma-joined songs.playlists column
+        to the song_playlists table, and every lookup column gets an index.
+
+        Positions of migrated memberships are taken from the playlist snapshots
+        where a song is listed, later syncs keep them up to date.
+        """
+        CREATE_SONG_PLAYLISTS_TABLE = f"""CREATE TABLE {self.SONG_PLAYLISTS_TABLE} (
+                song_id text NOT NULL,
+                playlist_id text NOT NULL,
+                position integer,
+                added_time text,
+                PRIMARY KEY (song_id, playlist_id)
+            );"""
+        CREATE_INDEX = "CREATE INDEX IF NOT EXISTS %s ON %s (%s);"
+        INDEXES = {  # song_playlists is looked up by song id through its key
+            "song_playlists_playlist": (
+                self.SONG_PLAYLISTS_TABLE,
+                "playlist_id, position",
+            ),
+            "songs_yt_song_id": (self.SONGS_TABLE, "yt_song_id"),
+            "songs_file_path": (self.SONGS_TABLE, "file_path"),
+            "playlists_yt_playlist_id": (self.PLAYLIST_TABLE, "yt_playlist_id"),
+            "title_cache_parser_version": (self.TITLES_TABLE, "parser_version"),
+        }
+        INSERT_MEMBERSHIP = f"""
+            INSERT OR IGNORE INTO {self.SONG_PLAYLISTS_TABLE} VALUES (?, ?, ?, ?)
+        """
+        FETCH_MEMBERSHIPS = f"""
+            SELECT
+                song_id, yt_song_id, playlists
+            FROM
+                {self.SONGS_TABLE} ;
+        """
+        FETCH_ORDER = f"""
+            SELECT
+                playlist_id, video_ids
+            FROM
+                {self.PLAYLIST_TABLE}
+                JOIN {self.SNAPSHOTS_TABLE} USING (yt_playlist_id) ;
+        """
+        DROP_PLAYLISTS_COLUMN = f"ALTER TABLE {self.SONGS_TABLE} DROP COLUMN playlists;"
+
+        self.cur.execute(CREATE_SONG_PLAYLISTS_TABLE)
+        for name, (table, columns) in INDEXES.items():
+            self.cur.execute(CREATE_INDEX % (name, table, columns))
+
+        if "playlists" not in self.__columns(self.SONGS_TABLE):  # a new database
+            return
+
+        positions = {}  # (playlist id, yt song id) -> position
+        for playlist_id, video_ids in self.cur.execute(FETCH_ORDER).fetchall():
+            for position, yt_song_id in enumerate(json.loads(video_ids)):
+                positions.setdefault((playlist_id, yt_song_id), position)
+
+        added_time = datetime.datetime.now().isoformat()
+        memberships = []
+        rows = self.cur.execute(FETCH_MEMBERSHIPS).fetchall()
+        for song_id, yt_song_id, playlists in rows:
+            for playlist_id in filter(None, (playlists or "").split(",")):
+                position = positions.get((playlist_id, yt_song_id))
+                memberships.append((song_id, playlist_id, position, added_time))
+        self.cur.executemany(INSERT_MEMBERSHIP, memberships)
+
+        # SQLite before 3.35 cannot drop columns, the old one is then left unused
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            self.cur.execute(DROP_PLAYLISTS_COLUMN)
+
+    def __create_scan_cache(self) -> None:
+        """Version 2: files read by msync import, see msync.scan."""
+        CREATE_SCAN_CACHE_TABLE = f"""CREATE TABLE {self.SCAN_CACHE_TABLE} (
+                path text PRIMARY KEY,
+                size integer NOT NULL,
+                mtime_ns integer NOT NULL,
+                yt_song_id text,
+                artist text,
+                title text
+            );"""
+
+        self.cur.execute(CREATE_SCAN_CACHE_TABLE)
+
+    def __add_fingerprints(self) -> None:
+        """Version 3: size, mtime and content hash of song files, and the time a
+        file was found broken, see msync.verify."""
+        self.__add_missing_columns(
+            self.SONGS_TABLE,
+            {
+                "size": "integer",
+                "mtime_ns": "integer",
+                "content_hash": "text",
+                "broken_time": "text",
+            },
+        )
+
+    def __add_durations(self) -> None:
+        """Version 4: durations of playlist entries and songs, and the kind of upload
+        a song was downloaded from, see msync.dedupe."""
+        self.__add_missing_columns(self.SNAPSHOTS_TABLE, {"durations": "text"})
+        self.__add_missing_columns(
+            self.SONGS_TABLE, {"duration": "real", "source_kind": "text"}
+        )
+
+    def __create_loudness(self) -> None:
+        """Version 5: loudness of song files and the ReplayGain tagged into them,
+        see msync.loudness."""
+        CREATE_LOUDNESS_TABLE = f"""CREATE TABLE {self.LOUDNESS_TABLE} (
+                file_path text PRIMARY KEY,
+                size integer NOT NULL,
+                mtime_ns integer NOT NULL,
+                integrated real NOT NULL,
+                true_peak real NOT NULL,
+                loudness_range real,
+                duration real NOT NULL,
+                album_gain real,
+                album_peak real,
+                tagged integer NOT NULL
+            );"""
+
+        self.cur.execute(CREATE_LOUDNESS_TABLE)
+
+    def __add_sync_columns(self) -> None:
+        """Version 6: orphaned time, artist and title of songs and the output of
+        playlists, see msync.gc and msync.outputs.
+
+        Databases created before versioning may have them already."""
+        self.__add_missing_columns(
+            self.SONGS_TABLE,
+            {"orphaned_time": "text", "artist": "text", "title": "text"},
+        )
+        self.__add_missing_columns(self.PLAYLIST_TABLE, {"output": "text"})
+
+    def __add_missing_columns(self, table: str, columns: dict[str, str]) -> None:
+        """Adds columns introduced after a database was created.
+
+        Args:
+            table (str): Table name.
+            columns (dict[str, str]): Column names mapped to their definitions.
+        """
+        ADD_COLUMN = f"ALTER TABLE {table} ADD COLUMN %s %s;"
+
+        existing = self.__columns(table)
+        for column, definition in columns.items():
+            if column not in existing:
+                self.cur.execute(ADD_COLUMN % (column, definition))
+
+    def __columns(self, table: str) -> list[str]:
+        TABLE_INFO = f"PRAGMA table_info({table});"
+
+        return [row[1] for row in self.cur.execute(TABLE_INFO).fetchall()]
 
     def create_playlist_entry(
         self, enabled, yt_playlist, folder_path, folder_name, commit=True
     ) -> str:
-        INSERT_PLAYLIST = (
-            f"""INSERT INTO {self.PLAYLIST_TABLE} VALUES (?, ?, ?, ?, ?, ?)"""
-        )
+        INSERT_PLAYLIST = f"""
+            INSERT INTO {self.PLAYLIST_TABLE} (
+                playlist_id, enabled, yt_playlist_id, folder_path, folder_name,
+                update_time
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        """
 
         update_time = datetime.datetime.now().isoformat()
-        playlist_id = self.__generate_id()
-
-        self.cur.execute(
+        (playlist_id,) = self.__insert_with_ids(
             INSERT_PLAYLIST,
-            (enabled, playlist_id, yt_playlist, folder_path, folder_name, update_time),
+            [(enabled, yt_playlist, folder_path, folder_name, update_time)],
         )
 
         if commit:
@@ -101,84 +389,779 @@ class PlaylistDB:
 
         return playlist_id
 
-    def create_song_entry(self, file_path, yt_song_id, playlists, commit=True) -> str:
-        INSERT_SONG = f"""INSERT INTO {self.SONGS_TABLE} VALUES (?, ?, ?, ?)"""
+    def create_song_entry(
+        self, file_path, yt_song_id, playlists, commit=True, artist=None, title=None
+    ) -> str:
+        (song_id,) = self.create_song_entries(
+            [(file_path, yt_song_id, artist, title, None)], commit=False
+        )
+        self.add_memberships([(song_id, playlist_id) for playlist_id in playlists])
+
+        if commit:
+            self.conn.commit()
+
+        return song_id
+
+    def create_song_entries(self, songs, commit=True) -> list[str]:
+        """Creates songs in one batch.
+
+        Args:
+            songs (list[tuple]): (file path, yt song id, artist, title, fingerprint)
+                of each song. Fingerprints are (size, mtime in ns, content hash) of
+                the file, see msync.verify.fingerprint, or None if unknown.
 
-        song_id = self.__generate_id()
-        file_path = os.path.abspath(file_path)
-        playlists_str = ",".join(playlists)
+        Returns:
+            list[str]: song ids, in the order of `songs`
+        """
+        INSERT_SONG = f"""
+            INSERT INTO {self.SONGS_TABLE}
+                (song_id, file_path, yt_song_id, artist, title, size, mtime_ns,
+                content_hash)
+            VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?)
+        """
 
-        self.cur.execute(INSERT_SONG, (song_id, file_path, yt_song_id, playlists_str))
+        song_ids = self.__insert_with_ids(
+            INSERT_SONG,
+            [
+                (
+                    os.path.abspath(file_path),
+                    yt_song_id,
+                    artist,
+                    title,
+                    *(fingerprint or (None, None, None)),
+                )
+                for file_path, yt_song_id, artist, title, fingerprint in songs
+            ],
+        )
 
         if commit:
             self.conn.commit()
 
-        return song_id
+        return song_ids
 
-    def add_song_playlist(self, song_id, playlist_id, commit=True):
-        FETCH_PLAYLISTS = f"""
-            SELECT 
-                playlists 
-            FROM 
-                {self.SONGS_TABLE} 
-            WHERE 
-                song_id = ? ;
+    def add_song_playlist(self, song_id, playlist_id, commit=True, position=None):
+        self.add_memberships([(song_id, playlist_id, position)], commit)
+
+    def add_memberships(self, memberships, commit=True):
+        """Adds songs to playlists in one batch, songs no longer count as orphaned.
+
+        Args:
+            memberships (list[tuple]): (song id, playlist id) or (song id,
+                playlist id, position) of each membership. Known memberships only
+                have their position updated, if one is given.
+        """
+        INSERT_MEMBERSHIP = f"""
+            INSERT INTO {self.SONG_PLAYLISTS_TABLE} VALUES (?, ?, ?, ?)
+            ON CONFLICT (song_id, playlist_id) DO UPDATE SET
+                position = coalesce(excluded.position, position) ;
         """
 
-        UPDATE_PLAYLIST = f"""
-            UPDATE 
+        UNORPHAN_SONG = f"""
+            UPDATE
                 {self.SONGS_TABLE}
-            SET 
-                playlists = ?
+            SET
+                orphaned_time = NULL
             WHERE
-                song_id = ? ;
+                song_id = ? AND orphaned_time IS NOT NULL ;
         """
 
-        playlists: list = (
-            self.cur.execute(FETCH_PLAYLISTS, (song_id,)).fetchone()[0].split(",")
+        added_time = datetime.datetime.now().isoformat()
+        rows = []
+        for song_id, playlist_id, *position in memberships:
+            rows.append((song_id, playlist_id, (position or [None])[0], added_time))
+        self.cur.executemany(INSERT_MEMBERSHIP, rows)
+        self.cur.executemany(UNORPHAN_SONG, {(row[0],) for row in rows})
+
+        if commit:
+            self.conn.commit()
+
+    def remove_song_playlist(self, song_id, playlist_id, commit=True):
+        self.remove_memberships([(song_id, playlist_id)], commit)
+
+    def remove_memberships(self, memberships, commit=True):
+        """Removes songs from playlists in one batch.
+
+        Args:
+            memberships (list[tuple]): (song id, playlist id) of each membership.
+        """
+        DELETE_MEMBERSHIP = f"""
+            DELETE FROM
+                {self.SONG_PLAYLISTS_TABLE}
+            WHERE
+                song_id = ? AND playlist_id = ? ;
+        """
+
+        self.cur.executemany(DELETE_MEMBERSHIP, memberships)
+
+        if commit:
+            self.conn.commit()
+
+    def set_playlist_order(self, playlist_id, yt_song_ids, commit=True):
+        """Stores the upstream position of every song of a playlist.
+
+        Args:
+            playlist_id (str): Playlist id.
+            yt_song_ids (list[str]): YouTube song ids in upstream order.
+        """
+        UPDATE_POSITION = f"""
+            UPDATE
+                {self.SONG_PLAYLISTS_TABLE}
+            SET
+                position = ?
+            WHERE
+                playlist_id = ? AND song_id IN (
+                    SELECT song_id FROM {self.SONGS_TABLE} WHERE yt_song_id = ?
+                ) AND position IS NOT ? ;
+        """
+
+        self.cur.executemany(
+            UPDATE_POSITION,
+            [
+                (position, playlist_id, yt_song_id, position)
+                for position, yt_song_id in enumerate(yt_song_ids)
+            ],
         )
 
-        if playlist_id in playlists:
-            return
+        if commit:
+            self.conn.commit()
 
-        playlists.append(playlist_id)
+    def get_playlist_snapshots(self) -> dict[str, dict]:
+        """Returns the last seen state of every playlist.
 
-        playlists_str = ",".join(playlists)
-        self.cur.execute(UPDATE_PLAYLIST, (playlists_str, song_id))
+        Returns:
+            dict: YouTube playlist id mapped to a snapshot with 'entries' (ordered
+                id, title, channel and duration dicts), 'count' and 'fetch_time'.
+        """
+        FETCH_SNAPSHOTS = f"""
+            SELECT
+                yt_playlist_id, video_ids, titles, channels, durations,
+                playlist_count, fetch_time
+            FROM
+                {self.SNAPSHOTS_TABLE} ;
+        """
+
+        snapshots = {}
+        for row in self.cur.execute(FETCH_SNAPSHOTS).fetchall():
+            yt_playlist_id, ids, titles, channels, durations, count, fetch_time = row
+            ids = json.loads(ids)
+            durations = json.loads(durations) if durations else [None] * len(ids)
+            columns = zip(ids, json.loads(titles), json.loads(channels), durations)
+            entries = [
+                {"id": i, "title": t, "channel": c, "duration": d}
+                for i, t, c, d in columns
+            ]
+            snapshots[yt_playlist_id] = {
+                "entries": entries,
+                "count": count,
+                "fetch_time": fetch_time,
+            }
+
+        return snapshots
+
+    def save_playlist_snapshot(
+        self, yt_playlist_id, entries, playlist_count, fetch_time, commit=True
+    ):
+        self.upsert_playlist_snapshots(
+            [(yt_playlist_id, entries, playlist_count, fetch_time)], commit
+        )
+
+    def upsert_playlist_snapshots(self, snapshots, commit=True):
+        """Stores the current state of playlists in one batch.
+
+        Args:
+            snapshots (list[tuple]): (yt playlist id, entries, playlist count, fetch
+                time) of each playlist, entries being id, title, channel and
+                duration dicts.
+        """
+        UPSERT_SNAPSHOT = f"""
+            INSERT OR REPLACE INTO {self.SNAPSHOTS_TABLE}
+                (yt_playlist_id, video_ids, titles, channels, durations,
+                playlist_count, fetch_time)
+            VALUES
+                (?, ?, ?, ?, ?, ?, ?)
+        """
+
+        self.cur.executemany(
+            UPSERT_SNAPSHOT,
+            [
+                (
+                    yt_playlist_id,
+                    json.dumps([e["id"] for e in entries]),
+                    json.dumps([e["title"] for e in entries]),
+                    json.dumps([e.get("channel") for e in entries]),
+                    json.dumps([e.get("duration") for e in entries]),
+                    playlist_count,
+                    fetch_time,
+                )
+                for yt_playlist_id, entries, playlist_count, fetch_time in snapshots
+            ],
+        )
 
         if commit:
             self.conn.commit()
 
-    def remove_song_playlist(self, song_id, playlist_id, commit=True):
-        FETCH_PLAYLISTS = f"""
-            SELECT 
-                playlists 
-            FROM 
-                {self.SONGS_TABLE} 
-            WHERE 
+    def get_scan_cache(self, folder) -> dict[str, tuple]:
+        """Returns the scan cache of the files below a folder.
+
+        Returns:
+            dict: path mapped to (size, mtime in ns, yt song id, artist, title).
+        """
+        FETCH_SCANNED = f"""
+            SELECT
+                path, size, mtime_ns, yt_song_id, artist, title
+            FROM
+                {self.SCAN_CACHE_TABLE}
+            WHERE
+                path >= ? AND path < ? ;
+        """
+
+        # Every path starting with "<folder>/", as a range over the primary key
+        prefix = os.path.join(folder, "")
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self.cur.execute(FETCH_SCANNED, (prefix, end)).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def update_scan_cache(self, rows, commit=True):
+        """Stores scanned files.
+
+        Args:
+            rows (list[tuple]): (path, size, mtime in ns, yt song id, artist,
+                title) of each file.
+        """
+        UPSERT_SCANNED = f"""
+            INSERT OR REPLACE INTO {self.SCAN_CACHE_TABLE} VALUES (?, ?, ?, ?, ?, ?)
+        """
+
+        self.cur.executemany(UPSERT_SCANNED, rows)
+
+        if commit:
+            self.conn.commit()
+
+    def remove_scan_cache(self, paths, commit=True):
+        DELETE_SCANNED = f"DELETE FROM {self.SCAN_CACHE_TABLE} WHERE path = ? ;"
+
+        self.cur.executemany(DELETE_SCANNED, [(path,) for path in paths])
+
+        if commit:
+            self.conn.commit()
+
+    def get_loudness(self) -> dict[str, tuple]:
+        """Returns the measured loudness of song files.
+
+        Returns:
+            dict: path mapped to (size, mtime in ns, integrated loudness in LUFS,
+                true peak in dBTP, loudness range in LU, duration in seconds,
+                tagged album gain, tagged album peak, tagged).
+        """
+        FETCH_LOUDNESS = f"""
+            SELECT
+                file_path, size, mtime_ns, integrated, true_peak, loudness_range,
+                duration, album_gain, album_peak, tagged
+            FROM
+                {self.LOUDNESS_TABLE} ;
+        """
+
+        rows = self.cur.execute(FETCH_LOUDNESS).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def update_loudness(self, rows, commit=True):
+        """Stores the loudness of song files.
+
+        Args:
+            rows (list[tuple]): (path, *values) of each file, values as returned by
+                get_loudness.
+        """
+        UPSERT_LOUDNESS = f"""
+            INSERT OR REPLACE INTO {self.LOUDNESS_TABLE}
+                (file_path, size, mtime_ns, integrated, true_peak, loudness_range,
+                duration, album_gain, album_peak, tagged)
+            VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+
+        self.cur.executemany(UPSERT_LOUDNESS, rows)
+
+        if commit:
+            self.conn.commit()
+
+    def remove_loudness(self, paths, commit=True):
+        DELETE_LOUDNESS = f"DELETE FROM {self.LOUDNESS_TABLE} WHERE file_path = ? ;"
+
+        self.cur.executemany(DELETE_LOUDNESS, [(path,) for path in paths])
+
+        if commit:
+            self.conn.commit()
+
+    def get_title_cache(self, parser_version) -> dict:
+        """Returns parsed titles cached by the given parser version.
+
+        Returns:
+            dict: (yt song id, raw title) mapped to (artist, title).
+        """
+        FETCH_TITLES = f"""
+            SELECT
+                yt_song_id, raw_title, artist, title
+            FROM
+                {self.TITLES_TABLE}
+            WHERE
+                parser_version = ? ;
+        """
+
+        rows = self.cur.execute(FETCH_TITLES, (parser_version,)).fetchall()
+        return {(i, raw): (artist, title) for i, raw, artist, title in rows}
+
+    def save_title_cache(self, parsed: dict, parser_version, commit=True):
+        """Stores parsed titles and drops the ones of other parser versions.
+
+        Args:
+            parsed (dict): (yt song id, raw title) mapped to (artist, title).
+            parser_version (str): Version of the parser which produced them.
+        """
+        DELETE_STALE = f"""
+            DELETE FROM {self.TITLES_TABLE} WHERE parser_version != ? ;
+        """
+        UPSERT_TITLE = f"""
+            INSERT OR REPLACE INTO {self.TITLES_TABLE} VALUES (?, ?, ?, ?, ?)
+        """
+
+        self.cur.execute(DELETE_STALE, (parser_version,))
+        self.cur.executemany(
+            UPSERT_TITLE,
+            [
+                (i, raw, artist, title, parser_version)
+                for (i, raw), (artist, title) in parsed.items()
+            ],
+        )
+
+        if commit:
+            self.conn.commit()
+
+    def set_playlist_enabled(self, playlist_id, enabled, commit=True):
+        UPDATE_ENABLED = f"""
+            UPDATE
+                {self.PLAYLIST_TABLE}
+            SET
+                enabled = ?
+            WHERE
+                playlist_id = ? ;
+        """
+
+        self.cur.execute(UPDATE_ENABLED, (int(enabled), playlist_id))
+
+        if commit:
+            self.conn.commit()
+
+    def set_playlist_folder(self, playlist_id, folder_path, folder_name, commit=True):
+        UPDATE_FOLDER = f"""
+            UPDATE
+                {self.PLAYLIST_TABLE}
+            SET
+                folder_path = ?,
+                folder_name = ?
+            WHERE
+                playlist_id = ? ;
+        """
+
+        self.cur.execute(UPDATE_FOLDER, (folder_path, folder_name, playlist_id))
+
+        if commit:
+            self.conn.commit()
+
+    def set_playlist_output(self, playlist_id, output, commit=True):
+        UPDATE_OUTPUT = f"""
+            UPDATE
+                {self.PLAYLIST_TABLE}
+            SET
+                output = ?
+            WHERE
+                playlist_id = ? ;
+        """
+
+        self.cur.execute(UPDATE_OUTPUT, (output, playlist_id))
+
+        if commit:
+            self.conn.commit()
+
+    def update_song_files(self, paths, commit=True):
+        """Moves songs to new files.
+
+        Args:
+            paths (list[tuple[str, str]]): (old path, new path) pairs.
+        """
+        UPDATE_FILE = f"""
+            UPDATE
+                {self.SONGS_TABLE}
+            SET
+                file_path = ?
+            WHERE
+                file_path = ? ;
+        """
+
+        self.cur.executemany(UPDATE_FILE, [(new, old) for old, new in paths])
+
+        if commit:
+            self.conn.commit()
+
+    def update_song_file(self, old_path, new_path, commit=True):
+        self.update_song_files([(old_path, new_path)], commit)
+
+    def set_fingerprints(self, fingerprints, commit=True):
+        """Records the state of song files found healthy.
+
+        Args:
+            fingerprints (list[tuple]): (file path, (size, mtime in ns, content
+                hash)) of each file.
+        """
+        UPDATE_FINGERPRINT = f"""
+            UPDATE
+                {self.SONGS_TABLE}
+            SET
+                size = ?,
+                mtime_ns = ?,
+                content_hash = ?,
+                broken_time = NULL
+            WHERE
+                file_path = ? ;
+        """
+
+        self.cur.executemany(
+            UPDATE_FINGERPRINT,
+            [(*fingerprint, path) for path, fingerprint in fingerprints],
+        )
+
+        if commit:
+            self.conn.commit()
+
+    def set_song_sources(self, sources, commit=True):
+        """Records what songs were downloaded from, see msync.dedupe.
+
+        Args:
+            sources (list[tuple]): (song id, duration in seconds, source kind) of
+                each song.
+        """
+        UPDATE_SOURCE = f"""
+            UPDATE
+                {self.SONGS_TABLE}
+            SET
+                duration = ?,
+                source_kind = ?
+            WHERE
                 song_id = ? ;
         """
 
-        UPDATE_PLAYLIST = f"""
-            UPDATE 
+        self.cur.executemany(
+            UPDATE_SOURCE,
+            [(duration, kind, song_id) for song_id, duration, kind in sources],
+        )
+
+        if commit:
+            self.conn.commit()
+
+    def mark_broken(self, paths, commit=True):
+        """Queues the songs of broken files for download by the next sync."""
+        MARK_BROKEN = f"""
+            UPDATE
                 {self.SONGS_TABLE}
-            SET 
-                playlists = ?
+            SET
+                broken_time = ?
+            WHERE
+                file_path = ? AND broken_time IS NULL ;
+        """
+
+        broken_time = datetime.datetime.now().isoformat()
+        self.cur.executemany(MARK_BROKEN, [(broken_time, path) for path in paths])
+
+        if commit:
+            self.conn.commit()
+
+    def repair_songs(self, songs, commit=True):
+        """Points broken songs at their downloaded replacement.
+
+        Args:
+            songs (list[tuple]): (song id, file path, fingerprint) of each song.
+        """
+        UPDATE_SONG = f"""
+            UPDATE
+                {self.SONGS_TABLE}
+            SET
+                file_path = ?,
+                size = ?,
+                mtime_ns = ?,
+                content_hash = ?,
+                broken_time = NULL
             WHERE
                 song_id = ? ;
         """
 
-        playlists: list = (
-            self.cur.execute(FETCH_PLAYLISTS, (song_id,)).fetchone()[0].split(",")
+        self.cur.executemany(
+            UPDATE_SONG,
+            [
+                (os.path.abspath(file_path), *(fingerprint or (None,) * 3), song_id)
+                for song_id, file_path, fingerprint in songs
+            ],
         )
 
-        if playlist_id not in playlists:
-            return
+        if commit:
+            self.conn.commit()
 
-        playlists.remove(playlist_id)
+    def mark_orphans(self, commit=True) -> int:
+        """Stamps songs which no playlist references with the current time.
 
-        playlists_str = ",".join(playlists)
-        self.cur.execute(UPDATE_PLAYLIST, (playlists_str, song_id))
+        Returns:
+            int: Number of newly orphaned songs.
+        """
+        MARK_ORPHANS = f"""
+            UPDATE
+                {self.SONGS_TABLE}
+            SET
+                orphaned_time = ?
+            WHERE
+                orphaned_time IS NULL AND song_id NOT IN (
+                    SELECT song_id FROM {self.SONG_PLAYLISTS_TABLE}
+                ) ;
+        """
+
+        orphaned_time = datetime.datetime.now().isoformat()
+        count = self.cur.execute(MARK_ORPHANS, (orphaned_time,)).rowcount
 
         if commit:
             self.conn.commit()
+
+        return count
+
+
+class Writer:
+    """Writer class.
+
+    Owns the only connection of a process writing through it, on a thread of its
+    own. Mutations are queued and group-committed every GROUP_COMMIT_SIZE
+    mutations or GROUP_COMMIT_MS milliseconds, so threads producing them never
+    contend on SQLite's write lock nor pay a commit each. Every mutation returns a
+    future resolved once its transaction is committed.
+
+    """
+
+    STOP = object()
+
+    def __init__(
+        self,
+        db_path: str,
+        batch_size: int = GROUP_COMMIT_SIZE,
+        interval_ms: float = GROUP_COMMIT_MS,
+    ) -> None:
+        """Connects to a database already set up by PlaylistDB.
+
+        Args:
+            db_path (str): Database file.
+            batch_size (int, optional): Mutations per transaction at most.
+            interval_ms (float, optional): Milliseconds a transaction stays open
+                for more mutations at most.
+        """
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self.__run, args=(db_path,), name="msync-db-writer", daemon=True
+        )
+        self.thread.start()
+
+    def execute(self, statement: str, params=()) -> Future:
+        """Queues a statement.
+
+        Returns:
+            Future: resolves to the number of rows it changed
+        """
+        return self.__submit("execute", statement, params)
+
+    def executemany(self, statement: str, rows) -> Future:
+        return self.__submit("executemany", statement, list(rows))
+
+    def flush(self) -> Future:
+        """Commits everything queued so far without waiting for the group."""
+        return self.__submit("flush", None, None)
+
+    def close(self):
+        """Commits everything queued and stops the writer thread."""
+        if self.thread.is_alive():
+            self.flush().result()
+            self.queue.put(self.STOP)
+            self.thread.join()
+
+    def __submit(self, method, statement, params) -> Future:
+        future = Future()
+        self.queue.put((future, method, statement, params))
+        return future
+
+    def __run(self, db_path: str):
+        conn = sqlite3.connect(db_path)
+        set_pragmas(conn)
+
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            deadline = time.monotonic() + self.interval
+            done = []  # (future, result, error) of this transaction
+            while True:
+                if item is self.STOP:
+                    stopping = True
+                    break
+
+                future, method, statement, params = item
+                if method == "flush":
+                    done.append((future, None, None))
+                    break
+                try:
+                    cursor = getattr(conn, method)(statement, params)
+                    done.append((future, cursor.rowcount, None))
+                except Exception as e:  # only fails this mutation
+                    done.append((future, None, e))
+
+                timeout = deadline - time.monotonic()
+                if len(done) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            try:
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                done = [(future, None, error or e) for future, _, error in done]
+            for future, result, error in done:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+        conn.close()
+
+
+class Readers:
+    """Readers class.
+
+    Read-only connections to a database, one per thread. In WAL mode they read
+    the last committed state while a Writer or PlaylistDB writes.
+
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.uri = "file:%s?mode=ro" % quote(os.path.abspath(db_path))
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Other threads only ever close it
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            set_pragmas(conn)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def execute(self, statement: str, params=()) -> list[tuple]:
+        return self.connection().execute(statement, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
+
+class Journal:
+    """Journal class.
+
+    Persistent record of every track a sync is working on, used to resume an
+    interrupted sync. Writes go through a Writer and reads through Readers, so it
+    is safe to use from several threads. Updates which fail to commit are reported
+    as they fail and counted in `failures`.
+
+    """
+
+    STATES = ("queued", "downloaded", "postprocessed", "tagged", "linked")
+
+    def __init__(self, db_path: str) -> None:
+        """Connects to a database already set up by PlaylistDB.
+
+        Args:
+            db_path (str): Database file.
+        """
+        self.writer = Writer(db_path)
+        self.readers = Readers(db_path)
+        self.failures = 0
+
+    def __del__(self) -> None:
+        self.close()
+
+    def flush(self):
+        """Waits until every update so far is committed."""
+        self.writer.flush().result()
+
+    def close(self):
+        """Commits pending updates and closes the connections."""
+        self.writer.close()
+        self.readers.close()
+
+    def load(self) -> dict[str, tuple[str, str, dict]]:
+        """Returns journaled tracks, including updates still being committed.
+
+        Returns:
+            dict: YouTube song id mapped to (state, partial path, job).
+        """
+        FETCH_JOBS = f"""
+            SELECT
+                yt_song_id, state, partial_path, job
+            FROM
+                {PlaylistDB.JOBS_TABLE} ;
+        """
+
+        self.flush()
+        rows = self.readers.execute(FETCH_JOBS)
+
+        return {
+            yt_song_id: (state, partial_path, json.loads(job or "{}"))
+            for yt_song_id, state, partial_path, job in rows
+        }
+
+    def update(self, yt_song_id, state, partial_path=None, job=None) -> Future:
+        UPSERT_JOB = f"""
+            INSERT INTO {PlaylistDB.JOBS_TABLE} VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (yt_song_id) DO UPDATE SET
+                state = excluded.state,
+                partial_path = coalesce(excluded.partial_path, partial_path),
+                job = coalesce(excluded.job, job),
+                update_time = excluded.update_time ;
+        """
+
+        update_time = datetime.datetime.now().isoformat()
+        job = json.dumps(job) if job is not None else None
+
+        return self.__checked(
+            self.writer.execute(
+                UPSERT_JOB, (yt_song_id, state, partial_path, job, update_time)
+            )
+        )
+
+    def remove(self, yt_song_ids) -> Future:
+        DELETE_JOB = f"DELETE FROM {PlaylistDB.JOBS_TABLE} WHERE yt_song_id = ? ;"
+
+        return self.__checked(
+            self.writer.executemany(DELETE_JOB, [(i,) for i in yt_song_ids])
+        )
+
+    def __checked(self, future: Future) -> Future:
+        """Reports `future` if its mutation fails, nobody else waits for it."""
+        future.add_done_callback(self.__report)
+        return future
+
+    def __report(self, future: Future):
+        error = future.exception()
+        if error is not None:  # the track resumes from an older state, if any
+            self.failures += 1
+            print("\033[1;33m!\033[0m journal update failed: %s" % error)
@@ -0,0 +1,122 @@
+"""
+msync/dedupe.py - Detection of re-uploads of songs already in the library.
+
+The same song is often on YouTube several times: the official video, a lyric video,
+the auto-generated "<artist> - Topic" track. Videos are matched on a key made of
+their parsed artist and title, normalised like titles.normalise and stripped of the
+decorations uploads add ("(Official Video)", "[Lyrics]", ...), and on their
+duration within DURATION_TOLERANCE seconds. Durations are bucketed so a lookup only
+compares videos of the same and neighbouring buckets.
+
+With the "link" policy a duplicate of a stored or queued song is not downloaded,
+it is registered on that song's file. When several stored songs match, the one of
+the most preferred source kind ('duplicate_preference') is used.
+
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from .titles import normalise
+
+POLICIES = ("link", "download")
+SOURCE_KINDS = ("topic", "official", "other", "lyric")
+
+# Largest difference in seconds between durations of the same song
+DURATION_TOLERANCE = 3
+BUCKET_SECONDS = DURATION_TOLERANCE  # neighbouring buckets cover the tolerance
+
+DECORATIONS = re.compile(
+    r"[(\[][^()\[\]]*\b(official|lyrics?|audio|video|visuali[sz]er|hd|hq|4k|mv)\b"
+    r"[^()\[\]]*[)\]]",
+    re.IGNORECASE,
+)
+SEPARATORS = re.compile(r"[\W_]+")
+
+
+def match_key(artist: str, title: str) -> str:
+    """Returns what two uploads of the same song have in common in their names."""
+    artist, title = normalise(artist or "", title or "")
+    text = DECORATIONS.sub(" ", f"{artist} {title}").casefold()
+    return " ".join(SEPARATORS.sub(" ", text).split())
+
+
+def source_kind(raw_title: str, channel: Optional[str]) -> str:
+    """Tells which kind of upload a video is, one of SOURCE_KINDS."""
+    if channel and channel.endswith(" - Topic"):
+        return "topic"
+    raw_title = raw_title.casefold()
+    if "lyric" in raw_title:
+        return "lyric"
+    if "official" in raw_title:
+        return "official"
+    return "other"
+
+
+def duplicate_policy(config: dict) -> str:
+    policy = config["duplicates"]
+    if policy not in POLICIES:
+        raise ValueError("unknown duplicates policy %r" % policy)
+    return policy
+
+
+@dataclass
+class Candidate:
+    yt_song_id: str
+    source: str  # stored file, or where a queued download will be stored
+    kind: str
+    duration: float
+
+
+class DuplicateIndex:
+    """DuplicateIndex class.
+
+    Songs by match key and duration bucket. Videos without a duration are never
+    indexed nor matched.
+    """
+
+    def __init__(self, preference=SOURCE_KINDS) -> None:
+        """
+        Args:
+            preference (list[str], optional): Source kinds, most preferred first.
+                Kinds not listed come last. Defaults to SOURCE_KINDS.
+        """
+        self.rank = {kind: i for i, kind in enumerate(preference)}
+        self.buckets: dict[tuple[str, int], list[Candidate]] = {}
+
+    def add(self, video: dict, source: str):
+        """Indexes a song.
+
+        Args:
+            video (dict): Song with 'id', 'artist', 'title', 'duration' and 'kind'.
+            source (str): File the song is or will be stored in.
+        """
+        if not video.get("duration"):
+            return
+        key = (
+            match_key(video["artist"], video["title"]),
+            int(video["duration"] // BUCKET_SECONDS),
+        )
+        candidate = Candidate(
+            video["id"], source, video.get("kind") or "other", video["duration"]
+        )
+        self.buckets.setdefault(key, []).append(candidate)
+
+    def find(self, video: dict) -> Optional[Candidate]:
+        """Returns the preferred indexed song `video` is a re-upload of, if any."""
+        duration = video.get("duration")
+        if not duration:
+            return None
+        key = match_key(video["artist"], video["title"])
+        bucket = int(duration // BUCKET_SECONDS)
+        found = [
+            candidate
+            for b in (bucket - 1, bucket, bucket + 1)
+            for candidate in self.buckets.get((key, b), ())
+            if candidate.yt_song_id != video["id"]
+            and abs(candidate.duration - duration) <= DURATION_TOLERANCE
+        ]
+        return min(
+            found, key=lambda c: self.rank.get(c.kind, len(self.rank)), default=None
+        )
@@ -0,0 +1,282 @@
+"""
+msync/export.py - Incremental export of playlists to mounted devices.
+
+USB sticks and SD cards are usually FAT formatted: no links, a restricted set of
+characters in names and case insensitive. Every unique song file is copied to the
+device once and playlists are written as M3U files referencing the copies. The
+"folders" layout keeps a song in the folder of the first exported playlist listing
+it, the "m3u" layout keeps every song in one Tracks folder.
+
+A manifest on the device records each copy by its path and the content hash of its
+source, so an export only copies what changed and removes what is no longer
+exported. Files are copied with copy_file_range(2), or sendfile(2) across file
+systems, by a few threads to keep the device busy.
+
+"""
+
+import errno
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .db import PlaylistDB
+from .outputs import write_m3u8
+from .transcode import synced_hashes, transcoded_path
+
+LAYOUTS = ("m3u", "folders")
+
+MANIFEST_FILE = ".msync-export.json"
+TRACKS_FOLDER = "Tracks"
+
+# Longest file name kept, FAT allows 255 UTF-16 characters
+NAME_LENGTH = 200
+
+FAT_UNSAFE = re.compile(r'[\x00-\x1f"*/:<>?\\|\x7f]')
+RESERVED_NAMES = {"CON", "PRN", "AUX", "NUL"} | {
+    f"{device}{i}" for device in ("COM", "LPT") for i in range(1, 10)
+}
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+@dataclass
+class ExportResult:
+    playlists: int = 0  # playlists written
+    tracks: int = 0  # unique songs on the device
+    copied: int = 0  # songs copied
+    copied_bytes: int = 0
+    removed: int = 0  # songs removed from the device
+    missing: list[str] = field(default_factory=list)  # songs without a transcode
+
+
+def fat_name(name: str) -> str:
+    """Returns `name` with what FAT file systems reject replaced."""
+    name = FAT_UNSAFE.sub("_", name).strip().rstrip(".")
+    stem, extension = os.path.splitext(name)
+    if stem.split(".")[0].upper() in RESERVED_NAMES:
+        stem += "_"
+    stem = stem[: NAME_LENGTH - len(extension)].rstrip(". ")
+
+    return (stem or "_") + extension
+
+
+def track_name(file_path: str, artist: str, title: str) -> str:
+    """Returns the readable name of a song, without extension. Songs stored before
+    their artist and title were recorded are named after their file."""
+    if artist is None or title is None:
+        return os.path.splitext(os.path.basename(file_path))[0]
+    return f"{artist} - {title}"
+
+
+def read_manifest(root: str) -> dict:
+    try:
+        with open(os.path.join(root, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"tracks": {}, "playlists": []}
+
+
+def write_manifest(root: str, manifest: dict):
+    path = os.path.join(root, MANIFEST_FILE)
+    with open(path + ".msync", "w") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(path + ".msync", path)
+
+
+def copy_file(source: str, path: str) -> int:
+    """Copies a file in the kernel, atomically and durably.
+
+    Returns:
+        int: bytes copied
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + ".msync"
+    size = os.path.getsize(source)
+    with open(source, "rb") as src, open(temp, "wb") as dst:
+        copied = 0
+        try:
+            while copied < size:
+                sent = os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK_SIZE)
+                if not sent:
+                    break
+                copied += sent
+        except (AttributeError, OSError) as e:  # other file system or no support
+            if isinstance(e, OSError) and e.errno not in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            ):
+                raise
+            try:
+                while copied < size:
+                    sent = os.sendfile(
+                        dst.fileno(), src.fileno(), copied, size - copied
+                    )
+                    if not sent:
+                        break
+                    copied += sent
+            except (AttributeError, OSError):
+                src.seek(copied)
+                dst.seek(copied)
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(temp, path)
+
+    return size
+
+
+def exported_playlists(db: PlaylistDB, names: Optional[list[str]]) -> dict:
+    """Returns enabled playlists by folder name, their songs in playlist order.
+
+    Args:
+        db (PlaylistDB): Database.
+        names (list, optional): Folder names or YouTube IDs of the playlists to
+            export. Defaults to None (every enabled playlist).
+
+    Returns:
+        dict: folder name mapped to (file path, artist, title) of each song
+    """
+    FETCH_SONGS = f"""
+        SELECT
+            folder_name, yt_playlist_id, file_path, artist, title
+        FROM
+            {db.PLAYLIST_TABLE}
+            JOIN {db.SONG_PLAYLISTS_TABLE} USING (playlist_id)
+            JOIN {db.SONGS_TABLE} USING (song_id)
+        WHERE
+            enabled = 1 AND broken_time IS NULL
+        ORDER BY
+            folder_name, position IS NULL, position, added_time ;
+    """
+
+    playlists = {}
+    for folder_name, yt_playlist_id, *song in db.cur.execute(FETCH_SONGS):
+        if names is None or folder_name in names or yt_playlist_id in names:
+            playlists.setdefault(folder_name, []).append(tuple(song))
+
+    return playlists
+
+
+def export_playlists(
+    db: PlaylistDB,
+    root: str,
+    names: Optional[list[str]] = None,
+    layout: str = "m3u",
+    profile: Optional[tuple[dict, str]] = None,
+    jobs: int = 4,
+    dry_run: bool = False,
+) -> ExportResult:
+    """Brings the export on a device up to date.
+
+    Args:
+        db (PlaylistDB): Database.
+        root (str): Mount point of the device, or a folder on it.
+        names (list, optional): Playlists to export by folder name or YouTube ID.
+            Defaults to None (every enabled playlist).
+        layout (str, optional): One of LAYOUTS. Defaults to "m3u".
+        profile (tuple, optional): (settings, cache folder) of a transcode profile
+            whose transcodes are exported instead of stored songs, see
+            msync.transcode. Defaults to None.
+        jobs (int, optional): Files copied at the same time. Defaults to 4.
+        dry_run (bool, optional): Only count what would be done.
+
+    Returns:
+        ExportResult: what was copied and removed
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("unknown export layout %r" % layout)
+
+    playlists = exported_playlists(db, names)
+    with ProcessPoolExecutor() as pool:
+        hashes = synced_hashes(db, pool, dry_run)
+
+    result = ExportResult()
+    wanted = {}  # device path -> (source, key)
+    placed = {}  # key -> device path, every unique file is copied once
+    taken = set()  # case folded device paths
+    m3u = {}  # playlist file -> track names mapped to device paths, in order
+    for folder_name, songs in sorted(playlists.items()):
+        folder = fat_name(folder_name)
+        tracks = {}
+        for file_path, artist, title in songs:
+            if file_path not in hashes:  # missing file, left to msync verify
+                continue
+            source, key = file_path, hashes[file_path]
+            if profile is not None:
+                settings, cache_dir = profile
+                source = transcoded_path(cache_dir, settings, key)
+                key = os.path.basename(source)
+                if not os.path.exists(source):
+                    result.missing.append(file_path)
+                    continue
+
+            if key not in placed:
+                extension = os.path.splitext(source)[1]
+                parent = folder if layout == "folders" else TRACKS_FOLDER
+                track = track_name(file_path, artist, title)
+                name = fat_name(f"{track}{extension}")
+                path = f"{parent}/{name}"
+                if path.casefold() in taken:
+                    name = fat_name(f"{track} [{key[:8]}]{extension}")
+                    path = f"{parent}/{name}"
+                taken.add(path.casefold())
+                placed[key] = path
+                wanted[path] = (source, key)
+            # M3U entries are titled after their name, the path is relative
+            name = os.path.basename(placed[key])
+            tracks[name if name not in tracks else placed[key]] = placed[key]
+        m3u[folder + ".m3u8"] = tracks
+    result.playlists = len(m3u)
+    result.tracks = len(wanted)
+
+    manifest = read_manifest(root)
+    todo = [
+        path
+        for path, (source, key) in sorted(wanted.items())
+        if manifest["tracks"].get(path) != key
+        or not os.path.exists(os.path.join(root, path))
+    ]
+    stale = [path for path in manifest["tracks"] if path not in wanted]
+    result.removed = len(stale)
+    if dry_run:
+        result.copied = len(todo)
+        result.copied_bytes = sum(os.path.getsize(wanted[p][0]) for p in todo)
+        return result
+
+    for path in stale:
+        try:
+            os.remove(os.path.join(root, path))
+            os.rmdir(os.path.dirname(os.path.join(root, path)))
+        except OSError:  # gone already, or the folder holds more
+            pass
+        del manifest["tracks"][path]
+    for path in set(manifest["playlists"]) - set(m3u):
+        try:
+            os.remove(os.path.join(root, path))
+        except FileNotFoundError:
+            pass
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as threads:
+            copies = [
+                (path, threads.submit(copy_file, wanted[path][0], f"{root}/{path}"))
+                for path in todo
+            ]
+            for path, future in copies:
+                result.copied_bytes += future.result()
+                result.copied += 1
+                manifest["tracks"][path] = wanted[path][1]
+    finally:  # copies made so far are not made again
+        manifest["playlists"] = sorted(m3u)
+        write_manifest(root, manifest)
+
+    for path, tracks in m3u.items():
+        write_m3u8(os.path.join(root, path), tracks)
+
+    return result
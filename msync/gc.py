@@ -0,0 +1,118 @@
+"""
+msync/gc.py - Reference-counted garbage collection of storage.
+
+A song is referenced by every enabled playlist listing it in its membership data.
+Songs nobody references are stamped with an orphaned time during sync and deleted
+here once they have stayed orphaned longer than the grace period. Files brought in
+by msync import are the user's own: their songs are forgotten, the files kept.
+Shard folders left empty by a deletion are removed as well.
+
+"""
+
+import datetime
+import os
+from collections import Counter
+
+from .db import PlaylistDB
+from .storage import is_sharded
+
+
+def remove_empty_shards(storage_dir: str, file_path: str):
+    """Removes the <ab>/<cd> folders of a deleted sharded file if they are empty."""
+    if not is_sharded(storage_dir, file_path):
+        return
+    folder = os.path.dirname(file_path)
+    for _ in range(2):
+        try:
+            os.rmdir(folder)
+        except OSError:  # holds other songs
+            return
+        folder = os.path.dirname(folder)
+
+
+def collect_garbage(
+    db: PlaylistDB, storage_dir: str, grace_days: float, dry_run: bool = False
+):
+    """Deletes storage files which no playlist has referenced for `grace_days`.
+
+    Works purely from the database, the storage folder is never scanned.
+
+    Args:
+        db (PlaylistDB): Database.
+        storage_dir (str): Folder where songs are stored.
+        grace_days (float): Days a song must stay unreferenced before deletion.
+        dry_run (bool, optional): Only report what would be deleted. Defaults to False.
+
+    Returns:
+        tuple[list, int, int]: deleted (song_id, file_path) pairs, one per file,
+            songs newly orphaned, songs referenced again. Expired songs whose
+            file is kept are forgotten without being listed.
+    """
+    songs = db.cur.execute(f"""
+            SELECT
+                song_id, file_path, count(playlists.playlist_id), orphaned_time
+            FROM
+                {db.SONGS_TABLE} songs
+                LEFT JOIN {db.SONG_PLAYLISTS_TABLE} USING (song_id)
+                LEFT JOIN {db.PLAYLIST_TABLE} playlists
+                    ON playlists.playlist_id = {db.SONG_PLAYLISTS_TABLE}.playlist_id
+                    AND playlists.enabled = 1
+            GROUP BY
+                song_id;
+        """).fetchall()
+
+    now = datetime.datetime.now()
+    deadline = now - datetime.timedelta(days=grace_days)
+
+    orphaned, referenced, expired = [], [], []
+    for song_id, file_path, refs, orphaned_time in songs:
+        if refs:
+            if orphaned_time is not None:
+                referenced.append((song_id,))
+        elif orphaned_time is None:
+            orphaned.append((now.isoformat(), song_id))
+        elif datetime.datetime.fromisoformat(orphaned_time) <= deadline:
+            expired.append((song_id, file_path))
+
+    # Several rows may point at one file, only delete files nobody else keeps
+    expired_ids = {song_id for song_id, _ in expired}
+    kept_paths = Counter(
+        file_path for song_id, file_path, _, _ in songs if song_id not in expired_ids
+    )
+    kept_paths.update(
+        path
+        for (path,) in db.cur.execute(
+            f"SELECT path FROM {db.SCAN_CACHE_TABLE};"
+        ).fetchall()
+    )
+    deleted = {p: (s, p) for s, p in reversed(expired) if not kept_paths[p]}
+    deleted = sorted(deleted.values(), key=lambda song: song[1])
+
+    if dry_run:
+        return deleted, len(orphaned), len(referenced)
+
+    storage_dir = os.path.abspath(storage_dir)
+    found = []
+    for song_id, file_path in deleted:
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:  # gone already, nothing was deleted
+            continue
+        found.append((song_id, file_path))
+        remove_empty_shards(storage_dir, file_path)
+
+    db.cur.executemany(
+        f"UPDATE {db.SONGS_TABLE} SET orphaned_time = ? WHERE song_id = ?;", orphaned
+    )
+    db.cur.executemany(
+        f"UPDATE {db.SONGS_TABLE} SET orphaned_time = NULL WHERE song_id = ?;",
+        referenced,
+    )
+    for table in (db.SONGS_TABLE, db.SONG_PLAYLISTS_TABLE):  # and disabled ones
+        db.cur.executemany(
+            f"DELETE FROM {table} WHERE song_id = ?;",
+            [(song_id,) for song_id, _ in expired],
+        )
+    db.conn.commit()
+
+    return found, len(orphaned), len(referenced)
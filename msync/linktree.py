@@ -0,0 +1,266 @@
+"""
+msync/linktree.py - Materialises playlist folders of symlinks.
+
+A playlist folder is read once and compared with the links it should hold. Small
+differences are applied in place, every link atomically. Large ones are built in
+a new folder beside the old one which is then swapped in, so music players never
+see a half-built playlist. Files in a playlist folder which msync did not create
+are never touched: symlink folders only manage symlinks, hardlink folders only the
+files listed in their manifest.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import shutil
+from dataclasses import dataclass
+
+from .plan import read_links
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 1 << 1
+
+# Differences below this many links are always applied in place
+SWAP_MIN_CHANGES = 32
+
+# Names of the hardlinks msync manages in a hardlink folder
+MANIFEST_FILE = ".msync-links"
+
+
+@dataclass
+class TreeChanges:
+    created: int = 0
+    retargeted: int = 0
+    removed: int = 0
+    swapped: bool = False
+
+
+def exchange(a: str, b: str) -> bool:
+    """Atomically exchanges two paths with renameat2(2).
+
+    Returns:
+        bool: False if the platform or file system does not support it
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        renameat2 = libc.renameat2
+    except (AttributeError, OSError):
+        return False
+
+    result = renameat2(
+        AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE
+    )
+    return result == 0
+
+
+def replace_symlink(source: str, path: str):
+    """Creates or retargets a symlink atomically."""
+    temp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.msync")
+    if os.path.lexists(temp):
+        os.unlink(temp)
+    os.symlink(source, temp)
+    os.replace(temp, path)
+
+
+def hardlink(source: str, path: str):
+    try:
+        os.link(source, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        os.symlink(source, path)  # storage is on another file system
+
+
+def replace_hardlink(source: str, path: str):
+    """Creates or replaces a hardlink atomically."""
+    temp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.msync")
+    if os.path.lexists(temp):
+        os.unlink(temp)
+    hardlink(source, temp)
+    os.replace(temp, path)
+
+
+def read_manifest(folder: str) -> set[str]:
+    try:
+        with open(os.path.join(folder, MANIFEST_FILE)) as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        return set()
+
+
+def write_manifest(folder: str, names):
+    path = os.path.join(folder, MANIFEST_FILE)
+    with open(path + ".msync", "w") as f:
+        json.dump(sorted(names), f, ensure_ascii=False)
+    os.replace(path + ".msync", path)
+
+
+def swap_in(folder: str, desired: dict[str, str], make_link=os.symlink):
+    """Builds `desired` beside `folder` with `make_link` and swaps it in."""
+    parent, name = os.path.split(folder)
+    building = os.path.join(parent, f".{name}.msync-new")
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    for link_name, source in desired.items():
+        make_link(source, os.path.join(building, link_name))
+    if make_link is hardlink:
+        write_manifest(building, desired)
+
+    if not os.path.exists(folder):
+        os.rename(building, folder)
+    elif exchange(building, folder):
+        shutil.rmtree(building)  # the old folder, holding only our links
+    else:
+        # Not atomic, but the playlist is only missing between two renames
+        old = os.path.join(parent, f".{name}.msync-old")
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(folder, old)
+        os.rename(building, folder)
+        shutil.rmtree(old)
+
+
+def materialise(
+    folder: str, desired: dict[str, str], swap_ratio: float = 0.25
+) -> TreeChanges:
+    """Makes `folder` hold exactly the `desired` symlinks.
+
+    Args:
+        folder (str): Playlist folder, created if missing.
+        desired (dict[str, str]): Link names mapped to their targets.
+        swap_ratio (float, optional): Share of changed links above which the
+            folder is rebuilt and swapped in instead of changed in place. Defaults
+            to 0.25.
+
+    Returns:
+        TreeChanges: what was changed
+    """
+    existing = read_links(folder)
+    changes = TreeChanges()
+    create, retarget = [], []
+    for link_name, source in desired.items():
+        if link_name not in existing:
+            create.append(link_name)
+        elif existing[link_name] and existing[link_name] != source:
+            retarget.append(link_name)
+        # names taken by regular files are left alone
+    remove = [
+        link_name
+        for link_name, target in existing.items()
+        if target and link_name not in desired
+    ]
+
+    changes.created, changes.retargeted = len(create), len(retarget)
+    changes.removed = len(remove)
+    changed = len(create) + len(retarget) + len(remove)
+    if not changed:
+        os.makedirs(folder, exist_ok=True)
+        return changes
+
+    # Only a folder holding nothing but symlinks can be rebuilt from `desired`
+    only_links = all(existing.values())
+    if only_links and (
+        not os.path.exists(folder)
+        or changed >= max(SWAP_MIN_CHANGES, swap_ratio * max(len(desired), 1))
+    ):
+        swap_in(folder, desired)
+        changes.swapped = True
+        return changes
+
+    os.makedirs(folder, exist_ok=True)
+    for link_name in remove:
+        os.unlink(os.path.join(folder, link_name))
+    for link_name in create + retarget:
+        replace_symlink(desired[link_name], os.path.join(folder, link_name))
+
+    return changes
+
+
+def same_file(entry: os.DirEntry, source: str) -> bool:
+    if entry.is_symlink():  # hardlinking fell back to a symlink
+        return os.readlink(entry.path) == source
+    try:
+        return os.path.samestat(entry.stat(), os.stat(source))
+    except FileNotFoundError:
+        return False
+
+
+def materialise_hardlinks(
+    folder: str, desired: dict[str, str], swap_ratio: float = 0.25
+) -> TreeChanges:
+    """Makes `folder` hold exactly the `desired` hardlinks, like materialise.
+
+    Storage on another file system is symlinked instead.
+    """
+    managed = read_manifest(folder)
+    entries = {}
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name != MANIFEST_FILE:
+                    entries[entry.name] = entry
+    except FileNotFoundError:
+        pass
+
+    changes = TreeChanges()
+    create, retarget = [], []
+    for link_name, source in desired.items():
+        if link_name not in entries:
+            create.append(link_name)
+        elif link_name in managed and not same_file(entries[link_name], source):
+            retarget.append(link_name)
+    remove = [name for name in managed if name in entries and name not in desired]
+
+    changes.created, changes.retargeted = len(create), len(retarget)
+    changes.removed = len(remove)
+    changed = len(create) + len(retarget) + len(remove)
+    if not changed:
+        os.makedirs(folder, exist_ok=True)
+        return changes
+
+    if set(entries) <= managed and (
+        not os.path.exists(folder)
+        or changed >= max(SWAP_MIN_CHANGES, swap_ratio * max(len(desired), 1))
+    ):
+        swap_in(folder, desired, hardlink)
+        changes.swapped = True
+        return changes
+
+    os.makedirs(folder, exist_ok=True)
+    for link_name in remove:
+        os.unlink(os.path.join(folder, link_name))
+    for link_name in create + retarget:
+        replace_hardlink(desired[link_name], os.path.join(folder, link_name))
+    write_manifest(
+        folder, [name for name in desired if name not in entries or name in managed]
+    )
+
+    return changes
+
+
+def rename_folder(old_folder: str, folder: str) -> bool:
+    """Moves a renamed playlist's folder, unless a folder of the new name exists.
+
+    Returns:
+        bool: True if the folder was moved
+    """
+    if not os.path.isdir(old_folder) or os.path.lexists(folder):
+        return False
+    os.rename(old_folder, folder)
+    return True
+
+
+def clear_folder(folder: str):
+    """Removes every link msync made in a folder, and the folder if it is then empty."""
+    managed = read_manifest(folder)
+    for link_name, target in read_links(folder).items():
+        if target or link_name in managed:
+            os.unlink(os.path.join(folder, link_name))
+    if managed:
+        os.unlink(os.path.join(folder, MANIFEST_FILE))
+    try:
+        os.rmdir(folder)
+    except OSError:  # missing, or holds files we did not create
+        pass
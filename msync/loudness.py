@@ -0,0 +1,259 @@
+"""
+msync/loudness.py - ReplayGain analysis of stored songs.
+
+Songs are measured with ffmpeg's ebur128 filter (EBU R128 integrated loudness,
+true peak and loudness range) on a process pool. Results are kept per song file
+with the size and mtime it had, so only new or changed files are measured again.
+
+Album gain is computed per playlist from the stored track results, without
+reading audio again: the album loudness is the duration weighted energy mean of
+its tracks. A song in several playlists carries the album gain of the playlist it
+was added to first. Gains are written as ReplayGain 2.0 tags relative to -18 LUFS,
+see msync.tags.write_replaygain.
+
+"""
+
+import math
+import os
+import re
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from mutagen import MutagenError
+
+from .db import PlaylistDB
+from .tags import write_replaygain
+from .verify import fingerprint
+from .youtube.postprocess import ffmpeg_binary
+
+REFERENCE_LUFS = -18.0
+
+SUMMARY = re.compile(
+    r"I:\s+(?P<integrated>-?[\d.]+|-inf) LUFS.*"
+    r"LRA:\s+(?P<range>-?[\d.]+) LU.*"
+    r"Peak:\s+(?P<peak>-?[\d.]+|-inf) dBFS",
+    re.DOTALL,
+)
+DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+
+# Quietest loudness and peak kept, silence measures as -inf
+FLOOR = -70.0
+
+
+@dataclass
+class LoudnessResult:
+    checked: int = 0  # song files looked at
+    measured: int = 0  # files analysed
+    unchanged: int = 0  # files skipped for their size and mtime
+    tagged: int = 0  # files whose ReplayGain tags were written
+    albums: int = 0  # playlists with an album gain
+    failed: list[str] = field(default_factory=list)  # files ffmpeg could not read
+
+
+def parse_summary(output: str) -> tuple[float, float, float]:
+    """Returns (integrated loudness, true peak, loudness range) from the summary
+    ebur128 logs when a file is done."""
+    summary = output[output.rindex("Summary:") :]
+    match = SUMMARY.search(summary)
+
+    def level(value):
+        return max(float(value), FLOOR)  # float("-inf") works as well
+
+    return (
+        level(match["integrated"]),
+        level(match["peak"]),
+        float(match["range"]),
+    )
+
+
+def measure_file(path: str, ffmpeg_string: str) -> tuple:
+    """Measures a song file.
+
+    Returns:
+        tuple: (size, mtime in ns, integrated loudness in LUFS, true peak in dBTP,
+            loudness range in LU, duration in seconds)
+    """
+    st = os.stat(path)
+    process = subprocess.run(
+        [
+            ffmpeg_binary(ffmpeg_string),
+            "-hide_banner",
+            "-nostats",
+            "-i",
+            path,
+            "-map",
+            "0:a:0",
+            "-af",
+            "ebur128=peak=true",
+            "-f",
+            "null",
+            "-",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    integrated, peak, loudness_range = parse_summary(process.stderr)
+    hours, minutes, seconds = DURATION.search(process.stderr).groups()
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    return st.st_size, st.st_mtime_ns, integrated, peak, loudness_range, duration
+
+
+def album_loudness(tracks) -> tuple[float, float]:
+    """Combines track results into album ones.
+
+    Args:
+        tracks (list[tuple]): (integrated loudness, true peak, duration) of each
+            track.
+
+    Returns:
+        tuple[float, float]: integrated loudness and true peak of the album
+    """
+    total = sum(duration for _, _, duration in tracks)
+    if not total:
+        return FLOOR, max((peak for _, peak, _ in tracks), default=FLOOR)
+    energy = sum(duration * 10 ** (lufs / 10) for lufs, _, duration in tracks)
+
+    return (
+        max(10 * math.log10(energy / total), FLOOR),
+        max(peak for _, peak, _ in tracks),
+    )
+
+
+def gain(lufs: float) -> float:
+    return round(REFERENCE_LUFS - lufs, 2)
+
+
+def amplitude(dbtp: float) -> float:
+    return round(10 ** (dbtp / 20), 6)
+
+
+def tag_file(path: str, track: tuple, album) -> tuple[int, int, str]:
+    """Writes ReplayGain tags and returns the new fingerprint of the file.
+
+    Args:
+        path (str): Song file.
+        track (tuple): (gain, peak) of the song.
+        album (tuple): (gain, peak) of its album, or None.
+    """
+    write_replaygain(path, *track, *(album or (None, None)))
+    return fingerprint(path)
+
+
+def analyse_library(
+    db: PlaylistDB, ffmpeg_string: str, processes: int = 0, full: bool = False
+) -> LoudnessResult:
+    """Measures new or changed song files and tags them with ReplayGain.
+
+    Args:
+        db (PlaylistDB): Database.
+        ffmpeg_string (str): ffmpeg location.
+        processes (int, optional): Measuring processes, 0 uses every core.
+        full (bool, optional): Measure every file again. Defaults to False.
+
+    Returns:
+        LoudnessResult: what was measured and tagged
+    """
+    FETCH_SONGS = f"""
+        SELECT DISTINCT
+            file_path
+        FROM
+            {db.SONGS_TABLE}
+        WHERE
+            broken_time IS NULL ;
+    """
+    FETCH_MEMBERS = f"""
+        SELECT
+            file_path, playlist_id
+        FROM
+            {db.SONGS_TABLE}
+            JOIN {db.SONG_PLAYLISTS_TABLE} USING (song_id)
+            JOIN {db.PLAYLIST_TABLE} USING (playlist_id)
+        WHERE
+            enabled = 1
+        ORDER BY
+            added_time ;
+    """
+
+    paths = [path for (path,) in db.cur.execute(FETCH_SONGS).fetchall()]
+    stored = db.get_loudness()
+    db.remove_loudness(set(stored) - set(paths), commit=False)
+
+    result = LoudnessResult()
+    cached, todo = {}, []
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:  # left to msync verify
+            continue
+        result.checked += 1
+        if full or stored.get(path, (None, None))[:2] != (st.st_size, st.st_mtime_ns):
+            todo.append(path)
+        else:
+            cached[path] = stored[path]
+            result.unchanged += 1
+
+    with ProcessPoolExecutor(max_workers=processes or None) as pool:
+        futures = [
+            (path, pool.submit(measure_file, path, ffmpeg_string)) for path in todo
+        ]
+        for path, future in futures:
+            try:
+                measured = future.result()
+            except (subprocess.CalledProcessError, ValueError, AttributeError):
+                result.failed.append(path)  # unreadable, or no summary logged
+                continue
+            cached[path] = (*measured, None, None, False)
+        result.measured = len(todo) - len(result.failed)
+
+        playlists = {}  # playlist id -> files
+        primary = {}  # file -> playlist whose album gain it is tagged with
+        for path, playlist_id in db.cur.execute(FETCH_MEMBERS).fetchall():
+            if path in cached:
+                playlists.setdefault(playlist_id, {}).setdefault(path)
+                primary.setdefault(path, playlist_id)
+        albums = {}
+        for playlist_id, files in playlists.items():
+            lufs, peak = album_loudness(
+                [(cached[path][2], cached[path][3], cached[path][5]) for path in files]
+            )
+            albums[playlist_id] = (gain(lufs), amplitude(peak))
+        result.albums = len(albums)
+
+        futures = []
+        for path in sorted(cached):
+            size, mtime_ns, integrated, peak, lra, duration, *tagged = cached[path]
+            album = albums.get(primary.get(path))
+            if tagged == [*(album or (None, None)), True]:
+                continue
+            track = (gain(integrated), amplitude(peak))
+            futures.append((path, album, pool.submit(tag_file, path, track, album)))
+
+        fingerprints = []
+        for path, album, future in futures:
+            try:
+                found = future.result()
+            except (MutagenError, OSError):
+                result.failed.append(path)
+                continue
+            _, _, *loudness, _, _, _ = cached[path]
+            cached[path] = (*found[:2], *loudness, *(album or (None, None)), True)
+            fingerprints.append((path, found))
+        result.tagged = len(fingerprints)
+
+    # Measured files are stored even if tagging them failed, and tried again
+    db.update_loudness(
+        [
+            (path, *cached[path])
+            for path in set(todo) | {f[0] for f in futures}
+            if path in cached
+        ],
+        commit=False,
+    )
+    db.set_fingerprints(fingerprints, commit=False)
+    db.conn.commit()
+
+    return result
@@ -0,0 +1,181 @@
+"""
+msync/outputs.py - How synchronised playlists are shown to music players.
+
+Every playlist has one output, chosen in config ('playlist_outputs' by playlist
+ID, else 'output'):
+
+    symlink   a folder of symlinks into storage (default)
+    hardlink  a folder of hardlinks, no symlink resolution for players
+    m3u8      one playlist file beside the playlist folders, in upstream order
+    mpd       a stored playlist on an MPD server, in upstream order, needs
+              python-mpd2
+
+Outputs are given the playlist's tracks as an ordered dict of track names
+("<artist> - <title>.<ext>") mapped to stored files.
+
+"""
+
+import os
+
+from .linktree import clear_folder, materialise, materialise_hardlinks
+
+OUTPUTS = ("symlink", "hardlink", "m3u8", "mpd")
+FOLDER_OUTPUTS = ("symlink", "hardlink")
+
+
+class OutputError(Exception):
+    """A playlist could not be published, the sync itself is unaffected."""
+
+
+def output_for(config: dict, yt_playlist_id: str) -> str:
+    output = config["playlist_outputs"].get(yt_playlist_id, config["output"])
+    if output not in OUTPUTS:
+        raise ValueError("unknown playlist output %r" % output)
+    return output
+
+
+def m3u8_path(folder: str) -> str:
+    return folder + ".m3u8"
+
+
+def write_m3u8(path: str, tracks: dict[str, str]) -> bool:
+    """Writes an extended M3U playlist atomically, unless it is unchanged.
+
+    Returns:
+        bool: True if the file was written
+    """
+    lines = ["#EXTM3U"]
+    for name, source in tracks.items():
+        lines.append("#EXTINF:-1,%s" % os.path.splitext(name)[0])
+        lines.append(source)
+    content = "\n".join(lines) + "\n"
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".msync", "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(path + ".msync", path)
+    return True
+
+
+def mpd_client(mpd_config: dict):
+    try:
+        from mpd import MPDClient
+    except ImportError:
+        raise OutputError("the mpd playlist output needs python-mpd2 installed")
+
+    client = MPDClient()
+    try:
+        client.connect(mpd_config["host"], mpd_config["port"])
+    except Exception as e:  # socket errors and mpd.ConnectionError
+        raise OutputError(
+            "cannot connect to MPD at %s:%s (%s)"
+            % (mpd_config["host"], mpd_config["port"], e)
+        )
+    return client
+
+
+def mpd_disconnect(client):
+    from mpd import MPDError
+
+    try:
+        client.close()
+        client.disconnect()
+    except (MPDError, OSError):  # the server already dropped the connection
+        pass
+
+
+def mpd_uri(source: str, music_directory: str) -> str:
+    """Returns a stored file as MPD sees it: relative to its music directory, or
+    absolute, which MPD only accepts from clients on its local socket."""
+    if music_directory:
+        music_directory = os.path.expanduser(music_directory)
+        if source.startswith(music_directory.rstrip(os.sep) + os.sep):
+            return os.path.relpath(source, music_directory)
+    return source
+
+
+def push_mpd(name: str, tracks: dict[str, str], mpd_config: dict) -> bool:
+    """Replaces an MPD stored playlist, unless it is unchanged.
+
+    Returns:
+        bool: True if the playlist was replaced
+    """
+    uris = [
+        mpd_uri(source, mpd_config["music_directory"]) for source in tracks.values()
+    ]
+    client = mpd_client(mpd_config)
+    from mpd import CommandError, MPDError
+
+    try:
+        try:
+            if client.listplaylist(name) == uris:
+                return False
+            client.playlistclear(name)
+        except CommandError:  # no such playlist yet
+            pass
+
+        client.command_list_ok_begin()
+        for uri in uris:
+            client.playlistadd(name, uri)
+        client.command_list_end()
+        return True
+    except (MPDError, OSError) as e:  # e.g. absolute paths over TCP
+        raise OutputError("MPD rejected playlist %r (%s)" % (name, e))
+    finally:
+        mpd_disconnect(client)
+
+
+def remove_mpd(name: str, mpd_config: dict):
+    client = mpd_client(mpd_config)
+    from mpd import CommandError, MPDError
+
+    try:
+        client.rm(name)
+    except CommandError:  # already gone
+        pass
+    except (MPDError, OSError) as e:
+        raise OutputError("cannot remove MPD playlist %r (%s)" % (name, e))
+    finally:
+        mpd_disconnect(client)
+
+
+def publish(output: str, folder: str, tracks: dict[str, str], config: dict):
+    """Shows a playlist through `output`.
+
+    Raises:
+        OutputError: if an MPD server is unreachable or rejects the playlist
+
+    Args:
+        output (str): One of OUTPUTS.
+        folder (str): Playlist folder, output files are named after it.
+        tracks (dict[str, str]): Track names mapped to stored files, in order.
+        config (dict): User configuration.
+    """
+    if output == "symlink":
+        materialise(folder, tracks, config["link_swap_ratio"])
+    elif output == "hardlink":
+        materialise_hardlinks(folder, tracks, config["link_swap_ratio"])
+    elif output == "m3u8":
+        write_m3u8(m3u8_path(folder), tracks)
+    elif output == "mpd":
+        push_mpd(os.path.basename(folder), tracks, config["mpd"])
+
+
+def unpublish(output: str, folder: str, config: dict):
+    """Removes what `publish` created for a playlist."""
+    if output in FOLDER_OUTPUTS:
+        clear_folder(folder)
+    elif output == "m3u8":
+        try:
+            os.remove(m3u8_path(folder))
+        except FileNotFoundError:
+            pass
+    elif output == "mpd":
+        remove_mpd(os.path.basename(folder), config["mpd"])
@@ -0,0 +1,523 @@
+"""
+msync/plan.py - Reconciliation planner for playlist synchronisation.
+
+Compares upstream playlists against the library and produces a typed plan of what
+a sync has to do. Planning never writes to disk; applying the plan is left to
+msync.sync.
+
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from .db import PlaylistDB
+from .dedupe import DuplicateIndex, duplicate_policy
+from .youtube.downloader import storage_filename
+
+
+@dataclass
+class Download:
+    video: dict
+    playlists: list[str]  # yt playlist ids which want the song
+
+
+@dataclass
+class Alias:
+    video: dict
+    yt_song_id: str  # stored or downloaded song whose file the video shares
+    source: str
+    playlists: list[str]  # yt playlist ids which want the song
+
+
+@dataclass
+class SongSource:
+    song_id: str
+    duration: float
+    kind: str
+
+
+@dataclass
+class Membership:
+    song_id: str
+    yt_song_id: str
+    yt_playlist_id: str
+
+
+@dataclass
+class Link:
+    yt_song_id: str
+    source: str
+    path: str
+
+
+@dataclass
+class Removal:
+    song_id: str
+    yt_song_id: str
+    playlist_id: str
+    link: Optional[str]  # symlink to remove, if there is one
+
+
+@dataclass
+class DroppedPlaylist:
+    playlist_id: str
+    yt_playlist_id: str
+    title: str
+    folder: str
+    output: str = "symlink"
+
+
+@dataclass
+class PlaylistPlan:
+    yt_playlist_id: str
+    title: str
+    folder: str
+    playlist_id: Optional[str]  # None if the playlist is not in the database yet
+    videos: list[dict] = field(repr=False)
+    previous_folder: Optional[str] = None  # set if the playlist was renamed
+    previous_output: Optional[str] = None  # see msync.outputs, None if new
+    tree: dict[str, Link] = field(default_factory=dict, repr=False)  # wanted links
+
+
+@dataclass
+class SyncPlan:
+    playlists: list[PlaylistPlan] = field(default_factory=list)
+    downloads: list[Download] = field(default_factory=list)
+    aliases: list[Alias] = field(default_factory=list)  # duplicates, not downloaded
+    sources: list[SongSource] = field(default_factory=list)  # durations learnt
+    memberships: list[Membership] = field(default_factory=list)
+    links: list[Link] = field(default_factory=list)
+    repairs: list[Link] = field(default_factory=list)
+    removals: list[Removal] = field(default_factory=list)
+    dropped: list[DroppedPlaylist] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        plan = asdict(self)
+        for p in plan["playlists"]:
+            p["videos"] = len(p["videos"])
+            p["tree"] = len(p["tree"])
+        return plan
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=4, ensure_ascii=False)
+
+    def to_table(self) -> str:
+        titles = {p.yt_playlist_id: p.title for p in self.playlists}
+        folders = {p.playlist_id: p.title for p in self.playlists + self.dropped}
+        rows = [("ACTION", "PLAYLIST", "ITEM")]
+        for p in self.playlists:
+            if p.previous_folder is not None:
+                rows.append(("rename", os.path.basename(p.previous_folder), p.title))
+        for d in self.downloads:
+            playlists = ", ".join(titles[p] for p in d.playlists)
+            rows.append(
+                ("download", playlists, f'{d.video["artist"]} - {d.video["title"]}')
+            )
+        for a in self.aliases:
+            playlists = ", ".join(titles[p] for p in a.playlists)
+            rows.append(
+                (
+                    "duplicate",
+                    playlists,
+                    f'{a.video["artist"]} - {a.video["title"]} = {a.yt_song_id}',
+                )
+            )
+        for m in self.memberships:
+            rows.append(("add", titles[m.yt_playlist_id], m.yt_song_id))
+        for action, links in (("link", self.links), ("repair", self.repairs)):
+            for link in links:
+                folder = os.path.basename(os.path.dirname(link.path))
+                rows.append((action, folder, os.path.basename(link.path)))
+        for r in self.removals:
+            rows.append(("remove", folders[r.playlist_id], r.yt_song_id))
+        for d in self.dropped:
+            rows.append(("drop", d.title, d.yt_playlist_id))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(2)]
+        lines = [
+            f"{action:<{widths[0]}}  {playlist:<{widths[1]}}  {item}"
+            for action, playlist, item in rows
+        ]
+        lines.append(
+            "%d download(s), %d duplicate(s), %d membership(s), %d link(s), "
+            "%d repair(s), %d removal(s), %d dropped playlist(s)"
+            % (
+                len(self.downloads),
+                len(self.aliases),
+                len(self.memberships),
+                len(self.links),
+                len(self.repairs),
+                len(self.removals),
+                len(self.dropped),
+            )
+        )
+        return "\n".join(lines)
+
+
+class LibraryIndex:
+    """LibraryIndex class.
+
+    Loads songs and playlists from the database once into hash indexes.
+    """
+
+    def __init__(self, db: Optional[PlaylistDB] = None) -> None:
+        self.songs: dict[str, tuple[str, str, set[str]]] = {}
+        self.playlists: dict[str, str] = {}
+        self.folders: dict[str, str] = {}  # playlist id -> folder
+        self.outputs: dict[str, str] = {}  # playlist id -> output kind
+        self.enabled: dict[str, tuple[str, str]] = {}  # playlist id -> (yt id, folder)
+        self.members: dict[str, set[str]] = {}  # playlist id -> yt song ids
+        self.broken: set[str] = set()  # yt song ids to download again
+        self.videos: dict[str, dict] = {}  # yt song id -> song, see msync.dedupe
+        if db is None:
+            return
+
+        song_ids = {}  # song id -> yt song id
+        for (
+            yt_song_id,
+            song_id,
+            file_path,
+            broken_time,
+            artist,
+            title,
+            duration,
+            kind,
+        ) in db.cur.execute(
+            f"""
+                SELECT
+                    yt_song_id, song_id, file_path, broken_time, artist, title,
+                    duration, source_kind
+                FROM
+                    {db.SONGS_TABLE};
+            """
+        ):
+            self.songs[yt_song_id] = (song_id, file_path, set())
+            song_ids[song_id] = yt_song_id
+            if broken_time is not None:
+                self.broken.add(yt_song_id)
+            self.videos[yt_song_id] = {
+                "id": yt_song_id,
+                "artist": artist,
+                "title": title,
+                "duration": duration,
+                "kind": kind,
+            }
+
+        for song_id, playlist_id in db.cur.execute(
+            f"SELECT song_id, playlist_id FROM {db.SONG_PLAYLISTS_TABLE};"
+        ):
+            yt_song_id = song_ids.get(song_id)
+            if yt_song_id is None:
+                continue
+            self.members.setdefault(playlist_id, set()).add(yt_song_id)
+            if self.songs[yt_song_id][0] == song_id:  # the row the video maps to
+                self.songs[yt_song_id][2].add(playlist_id)
+
+        for (
+            yt_playlist_id,
+            playlist_id,
+            enabled,
+            folder_path,
+            folder_name,
+            output,
+        ) in db.cur.execute(
+            f"""
+                SELECT
+                    yt_playlist_id, playlist_id, enabled, folder_path, folder_name,
+                    output
+                FROM
+                    {db.PLAYLIST_TABLE};
+            """
+        ):
+            self.playlists[yt_playlist_id] = playlist_id
+            folder = os.path.join(folder_path, folder_name)
+            self.folders[playlist_id] = folder
+            self.outputs[playlist_id] = output or "symlink"
+            if enabled:
+                self.enabled[playlist_id] = (yt_playlist_id, folder)
+
+
+def duplicate_index(index: LibraryIndex, config: dict) -> Optional[DuplicateIndex]:
+    """Returns the stored songs re-uploads are matched against, None if duplicates
+    are downloaded like any other video."""
+    if duplicate_policy(config) == "download":
+        return None
+
+    duplicates = DuplicateIndex(config["duplicate_preference"])
+    for yt_song_id, video in index.videos.items():
+        if yt_song_id not in index.broken:
+            duplicates.add(video, index.songs[yt_song_id][1])
+
+    return duplicates
+
+
+def read_links(folder: str) -> dict[str, str]:
+    """Returns symlinks in a folder mapped to their targets, reading the folder once."""
+    links = {}
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                # Regular files map to "" and are never touched
+                links[entry.name] = (
+                    os.readlink(entry.path) if entry.is_symlink() else ""
+                )
+    except FileNotFoundError:
+        pass
+
+    return links
+
+
+def link_index(folders) -> dict[str, list[str]]:
+    """Returns link targets mapped to the playlist links pointing at them."""
+    links = {}
+    for folder in folders:
+        for name, target in read_links(folder).items():
+            if target:
+                links.setdefault(target, []).append(os.path.join(folder, name))
+
+    return links
+
+
+def link_targets(existing_links: dict[str, str]) -> dict[str, str]:
+    """Inverts read_links: symlink targets mapped to the link name."""
+    return {target: name for name, target in existing_links.items() if target}
+
+
+def link_name(video: dict, extension: str) -> str:
+    """Returns the readable name of a song's link in a playlist folder."""
+    return f'{video["artist"]} - {video["title"]}{extension}'
+
+
+def removal(
+    index: LibraryIndex,
+    yt_song_id: str,
+    playlist_id: str,
+    targets: dict[str, str],
+    folder: str,
+) -> Removal:
+    song_id, source, _ = index.songs[yt_song_id]
+    link = os.path.join(folder, targets[source]) if source in targets else None
+
+    return Removal(song_id, yt_song_id, playlist_id, link)
+
+
+class Planner:
+    """Planner class.
+
+    Builds a SyncPlan incrementally, one upstream video at a time, so planning can
+    run while playlists are still being enumerated.
+    """
+
+    def __init__(
+        self,
+        index: LibraryIndex,
+        storage_dir: str,
+        music_dir: str,
+        duplicates: Optional[DuplicateIndex] = None,
+    ) -> None:
+        """
+        Args:
+            index (LibraryIndex): Library loaded from the database.
+            storage_dir (str): Folder where downloaded songs are stored.
+            music_dir (str): Folder where playlist folders are created.
+            duplicates (DuplicateIndex, optional): Songs new videos are matched
+                against, see duplicate_index. Defaults to None (every new video is
+                downloaded).
+        """
+        self.index = index
+        self.storage_dir = storage_dir
+        self.music_dir = music_dir
+        self.duplicates = duplicates
+        self.plan = SyncPlan()
+        self.downloads: dict[str, Download] = {}
+        self.aliases: dict[str, Alias] = {}
+        self.existing_links: dict[str, dict[str, str]] = {}  # yt playlist id -> links
+        self.existing_targets: dict[str, dict[str, str]] = {}  # inverted links
+        self.link_names: dict[str, dict[str, str]] = {}  # name -> yt song id
+        self.linked: dict[str, set[str]] = {}  # yt playlist id -> planned sources
+
+    def add_playlist(self, playlist: dict) -> PlaylistPlan:
+        folder = os.path.join(self.music_dir, playlist["title"])
+        playlist_id = self.index.playlists.get(playlist["id"])
+        p = PlaylistPlan(playlist["id"], playlist["title"], folder, playlist_id, [])
+        self.plan.playlists.append(p)
+        p.previous_output = self.index.outputs.get(playlist_id)
+
+        # A playlist renamed upstream takes its old folder along
+        previous = self.index.folders.get(playlist_id, folder)
+        if previous != folder:
+            p.previous_folder = previous
+            if not os.path.exists(folder):
+                folder = previous
+        self.existing_links[playlist["id"]] = read_links(folder)
+        self.existing_targets[playlist["id"]] = link_targets(
+            self.existing_links[playlist["id"]]
+        )
+        self.link_names[playlist["id"]] = {}
+        self.linked[playlist["id"]] = set()
+
+        return p
+
+    def add_video(self, p: PlaylistPlan, video: dict) -> Optional[Download]:
+        """Plans an upstream video of a playlist.
+
+        Returns:
+            Download: The download if the video is new to the session, else None.
+        """
+        p.videos.append(video)
+        new = None
+
+        song = self.index.songs.get(video["id"])
+        duplicate = None
+        if song is None and self.duplicates is not None:
+            if video["id"] not in self.downloads and video["id"] not in self.aliases:
+                duplicate = self.duplicates.find(video)
+
+        if video["id"] in self.aliases:
+            self.aliases[video["id"]].playlists.append(p.yt_playlist_id)
+            source = self.aliases[video["id"]].source
+        elif duplicate is not None:  # a re-upload, shares the file of the original
+            alias = Alias(
+                video, duplicate.yt_song_id, duplicate.source, [p.yt_playlist_id]
+            )
+            self.aliases[video["id"]] = alias
+            self.plan.aliases.append(alias)
+            source = duplicate.source
+        elif song is None or video["id"] in self.index.broken:
+            source = storage_filename(self.storage_dir, video)
+            if video["id"] in self.downloads:
+                self.downloads[video["id"]].playlists.append(p.yt_playlist_id)
+            else:
+                new = Download(video, [p.yt_playlist_id])
+                self.downloads[video["id"]] = new
+                self.plan.downloads.append(new)
+                if self.duplicates is not None and song is None:
+                    self.duplicates.add(video, source)
+        else:
+            song_id, source, song_playlists = song
+            if p.playlist_id is None or p.playlist_id not in song_playlists:
+                self.plan.memberships.append(
+                    Membership(song_id, video["id"], p.yt_playlist_id)
+                )
+            self.learn_duration(song_id, source, video)
+
+        # Duplicates sharing a file are linked once per playlist
+        if source in self.linked[p.yt_playlist_id]:
+            return new
+        self.linked[p.yt_playlist_id].add(source)
+
+        names = self.link_names[p.yt_playlist_id]
+        targets = self.existing_targets[p.yt_playlist_id]
+        if source in targets:  # linked already, maybe under an older title
+            name = targets[source]
+            names[name] = video["id"]
+            p.tree[name] = Link(video["id"], source, os.path.join(p.folder, name))
+            return new
+
+        # Distinct videos with the same artist and title get their ID appended
+        extension = os.path.splitext(source)[1]
+        name = link_name(video, extension)
+        if names.setdefault(name, video["id"]) != video["id"]:
+            name = link_name(video, f' [{video["id"]}]{extension}')
+
+        existing_links = self.existing_links[p.yt_playlist_id]
+        link = Link(video["id"], source, os.path.join(p.folder, name))
+        p.tree[name] = link
+        if name not in existing_links:
+            self.plan.links.append(link)
+        elif existing_links[name] and existing_links[name] != source:
+            self.plan.repairs.append(link)
+
+        return new
+
+    def learn_duration(self, song_id: str, source: str, video: dict):
+        """Records the duration of a stored song which has none yet, so re-uploads
+        of songs stored before durations were known are found too."""
+        known = self.index.videos.get(video["id"])
+        if not video.get("duration") or known is None or known["duration"]:
+            return
+
+        known.update(duration=video["duration"], kind=video.get("kind"))
+        self.plan.sources.append(
+            SongSource(song_id, video["duration"], video.get("kind"))
+        )
+        if self.duplicates is not None and video["id"] not in self.index.broken:
+            self.duplicates.add(video, source)
+
+    def finish(self, synced_ids: Optional[list[str]] = None) -> SyncPlan:
+        """Adds removals once every playlist is fully planned and returns the plan.
+
+        Args:
+            synced_ids (list, optional): Full sync list. Enabled playlists missing
+                from it are dropped. Defaults to None (nothing is dropped).
+        """
+        index = self.index
+        for p in self.plan.playlists:
+            if p.playlist_id is None:
+                continue
+
+            upstream_ids = {video["id"] for video in p.videos}
+            removed = index.members.get(p.playlist_id, set()) - upstream_ids
+            targets = self.existing_targets[p.yt_playlist_id]
+            self.plan.removals.extend(
+                removal(index, yt_song_id, p.playlist_id, targets, p.folder)
+                for yt_song_id in removed
+            )
+
+        if synced_ids is not None:
+            synced_ids = set(synced_ids)
+            for playlist_id, (yt_playlist_id, folder) in index.enabled.items():
+                if yt_playlist_id in synced_ids:
+                    continue
+
+                title = os.path.basename(folder)
+                self.plan.dropped.append(
+                    DroppedPlaylist(
+                        playlist_id,
+                        yt_playlist_id,
+                        title,
+                        folder,
+                        index.outputs[playlist_id],
+                    )
+                )
+                targets = link_targets(read_links(folder))
+                self.plan.removals.extend(
+                    removal(index, yt_song_id, playlist_id, targets, folder)
+                    for yt_song_id in index.members.get(playlist_id, set())
+                )
+
+        return self.plan
+
+
+def build_plan(
+    fetched: list[tuple[dict, list[dict]]],
+    index: LibraryIndex,
+    storage_dir: str,
+    music_dir: str,
+    synced_ids: Optional[list[str]] = None,
+    duplicates: Optional[DuplicateIndex] = None,
+) -> SyncPlan:
+    """Builds a reconciliation plan for fetched playlists.
+
+    Args:
+        fetched (list): (playlist, upstream videos) pairs.
+        index (LibraryIndex): Library loaded from the database.
+        storage_dir (str): Folder where downloaded songs are stored.
+        music_dir (str): Folder where playlist folders are created.
+        synced_ids (list, optional): Full sync list. Enabled playlists missing
+            from it are dropped. Defaults to None (nothing is dropped).
+        duplicates (DuplicateIndex, optional): Songs new videos are matched
+            against. Defaults to None (every new video is downloaded).
+
+    Returns:
+        SyncPlan: Actions needed to synchronise the playlists.
+    """
+    planner = Planner(index, storage_dir, music_dir, duplicates)
+    for playlist, upstream_videos in fetched:
+        p = planner.add_playlist(playlist)
+        for video in upstream_videos:
+            planner.add_video(p, video)
+
+    return planner.finish(synced_ids)
@@ -0,0 +1,145 @@
+"""
+msync/scan.py - Imports existing audio files into the library.
+
+Folders are walked with os.scandir and tags are read in-process with mutagen on a
+process pool, no ffprobe per file. Files carrying the source URL msync and ypsync
+tag them with are registered as songs where they are, so syncs link them instead
+of downloading them again. Every file read is remembered by path, size and mtime
+in the scan cache, rescans only read files which changed.
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import parse_qs, urlparse
+
+from mutagen import MutagenError
+
+from .db import PlaylistDB
+from .tags import read_tags
+from .verify import fingerprint
+
+AUDIO_EXTENSIONS = {".m4a", ".mp4", ".opus", ".ogg", ".oga", ".mp3", ".flac"}
+
+# Files a worker process reads per task
+CHUNK_SIZE = 64
+
+
+@dataclass
+class ScanResult:
+    files: int = 0  # audio files found
+    read: int = 0  # files whose tags were read, the others were cached
+    registered: int = 0  # songs new to the library
+    known: int = 0  # tagged files of videos already in the library
+    untagged: int = 0  # files without a source URL, failed ones included
+    failed: int = 0  # files mutagen could not read
+    removed: int = 0  # cached files which are gone
+
+
+def walk(folder: str):
+    """Yields (path, size, mtime_ns) of audio files below `folder`.
+
+    Symlinks are skipped, they are playlist links or point at files elsewhere.
+    """
+    stack = [folder]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS:
+                        st = entry.stat()
+                        yield entry.path, st.st_size, st.st_mtime_ns
+        except (FileNotFoundError, PermissionError):
+            continue
+
+
+def video_id(url: str) -> str:
+    """Returns the video ID of a YouTube URL, "" if there is none."""
+    if not url:
+        return ""
+    query = parse_qs(urlparse(url).query)
+    if "v" in query:
+        return query["v"][0]
+    return url.rstrip("/").split("/")[-1].split("=")[-1]
+
+
+def read_file(path: str):
+    """Returns (yt song id, artist, title) of a file, None if it is unreadable."""
+    try:
+        tags = read_tags(path)
+    except (MutagenError, OSError):
+        return None
+    return video_id(tags["url"]), tags["artist"], tags["title"]
+
+
+def import_folder(db: PlaylistDB, folder: str, processes: int = 0) -> ScanResult:
+    """Scans a folder and registers the songs it holds.
+
+    Args:
+        db (PlaylistDB): Database.
+        folder (str): Folder to scan, recursively.
+        processes (int, optional): Processes reading tags, 0 uses every core.
+
+    Returns:
+        ScanResult: counts of what was found
+    """
+    folder = os.path.abspath(folder)
+    result = ScanResult()
+    cached = db.get_scan_cache(folder)
+
+    files = sorted(walk(folder))
+    result.files = len(files)
+    changed = [
+        (path, size, mtime)
+        for path, size, mtime in files
+        if cached.get(path, (None, None))[:2] != (size, mtime)
+    ]
+    with ProcessPoolExecutor(max_workers=processes or None) as pool:
+        rows = []
+        tags = pool.map(read_file, [f[0] for f in changed], chunksize=CHUNK_SIZE)
+        for (path, size, mtime), read in zip(changed, tags):
+            if read is None:
+                result.failed += 1
+                read = ("", "", "")
+            cached[path] = (size, mtime, *read)
+            rows.append((path, size, mtime, *read))
+        db.update_scan_cache(rows, commit=False)
+        result.read = len(changed)
+
+        present = {path for path, _, _ in files}
+        gone = [path for path in cached if path not in present]
+        db.remove_scan_cache(gone, commit=False)
+        result.removed = len(gone)
+
+        known = {
+            yt_song_id
+            for (yt_song_id,) in db.cur.execute(
+                f"SELECT yt_song_id FROM {db.SONGS_TABLE};"
+            ).fetchall()
+        }
+        songs = []
+        for path, _, _ in files:
+            _, _, yt_song_id, artist, title = cached[path]
+            if not yt_song_id:
+                result.untagged += 1
+            elif yt_song_id in known:
+                result.known += 1
+            else:
+                known.add(yt_song_id)
+                songs.append((path, yt_song_id, artist or None, title or None))
+
+        # Registered songs record their fingerprint, see msync.verify
+        fingerprints = pool.map(fingerprint, [song[0] for song in songs])
+        db.create_song_entries(
+            [(*song, found) for song, found in zip(songs, fingerprints)],
+            commit=False,
+        )
+    result.registered = len(songs)
+
+    db.conn.commit()
+    return result
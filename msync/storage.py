@@ -0,0 +1,101 @@
+"""
+msync/storage.py - Migration of the storage folder to the sharded layout.
+
+Songs used to be stored flat as "<artist> - <title>.<ext>", so different videos
+with the same parsed name overwrote each other. They are now stored as
+<ab>/<cd>/<id>.<ext> (see msync.youtube.downloader.storage_filename) and readable
+names only live in the database and in playlist folders. Files registered by
+msync import stay where they are.
+
+"""
+
+import errno
+import os
+import shutil
+
+from .convert import owned_files, relink
+from .db import PlaylistDB
+from .plan import LibraryIndex, link_index
+from .youtube.downloader import storage_filename
+
+
+def is_sharded(storage_dir: str, file_path: str) -> bool:
+    """Tells whether a file is in the sharded layout, maybe named for another video."""
+    parts = os.path.relpath(file_path, storage_dir).split(os.sep)
+    return len(parts) == 3 and all(len(part) == 2 for part in parts[:2])
+
+
+def move(old_path: str, new_path: str):
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    try:
+        os.rename(old_path, new_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(old_path, new_path)  # storage spans file systems
+
+
+def migrate_storage(db: PlaylistDB, storage_dir: str, batch_size: int = 500):
+    """Moves stored songs into the sharded layout.
+
+    Files are renamed first, then playlist links are pointed at them and finally the
+    database is updated, one batch at a time. An interrupted migration simply runs
+    again: songs already moved on disk are only relinked and updated.
+
+    Args:
+        db (PlaylistDB): Database.
+        storage_dir (str): Folder where songs are stored.
+        batch_size (int, optional): Songs per database transaction. Defaults to 500.
+
+    Returns:
+        tuple[int, int, int]: songs moved, songs sharing their file with another
+            video, songs whose file is missing
+    """
+    storage_dir = os.path.abspath(storage_dir)
+    rows = db.cur.execute(
+        f"SELECT song_id, yt_song_id, file_path, artist, title FROM {db.SONGS_TABLE};"
+    ).fetchall()
+    owned = set(owned_files(db, storage_dir, [row[2] for row in rows]))
+
+    moves = {}  # old path -> new path, the first video storing a file names it
+    names = []  # (artist, title, song id) of songs stored under their old name
+    shared = 0
+    for song_id, yt_song_id, file_path, artist, title in rows:
+        if file_path not in owned or is_sharded(storage_dir, file_path):
+            continue
+        extension = os.path.splitext(file_path)[1][1:]
+        new_path = storage_filename(storage_dir, {"id": yt_song_id}, extension)
+        if file_path in moves:
+            shared += 1
+        else:
+            moves[file_path] = new_path
+
+        if artist is None:
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            artist, _, title = name.partition(" - ")
+            names.append((artist, title, song_id))
+
+    db.cur.executemany(
+        f"UPDATE {db.SONGS_TABLE} SET artist = ?, title = ? WHERE song_id = ?;",
+        names,
+    )
+    db.conn.commit()
+
+    links = link_index(folder for _, folder in LibraryIndex(db).enabled.values())
+    moved, missing = 0, 0
+    pending = list(moves.items())
+    for start in range(0, len(pending), batch_size):
+        batch = []
+        for old_path, new_path in pending[start : start + batch_size]:
+            if os.path.exists(old_path):
+                move(old_path, new_path)
+            elif not os.path.exists(new_path):
+                missing += 1
+                continue
+            relink(links, old_path, new_path)
+            batch.append((old_path, new_path))
+
+        db.update_song_files(batch)
+        moved += len(batch)
+
+    return moved, shared, missing
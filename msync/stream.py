@@ -1,19 +1,12 @@
 import sys
 
-from youtube_title_parse import get_artist_title as extract
 from yt_dlp import YoutubeDL
 
+from msync.titles import TitleParser, load_rules
+
 
 def extract_artist_title(i):
-    try:
-        # Parse the title to extract only the artist and title.
-        artist, title = extract(i["fulltitle"])
-    except TypeError:
-        # Fallback if youtube_title_parse is not able to parse a title.
-        artist, title = (i["channel"], i["fulltitle"])
-
-    title = title.replace("/", "-")  # special case
-    artist = artist.replace(" - Topic", "")  # special case
+    artist, title = TitleParser(load_rules()).parse_title(i["fulltitle"], i["channel"])
 
     return title, artist
 
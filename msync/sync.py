@@ -1,15 +1,68 @@
+import datetime
+import os
+import shutil
 import sys
 from pathlib import Path
 from typing import Callable
 
-from .db import PlaylistDB
+from .config import load_config
+from .db import Journal, PlaylistDB, Readers
 from .ffstack import where as ffmpeg_location
+from .linktree import rename_folder
+from .outputs import FOLDER_OUTPUTS, OutputError, output_for, publish, unpublish
+from .plan import (
+    LibraryIndex,
+    Planner,
+    PlaylistPlan,
+    SyncPlan,
+    build_plan,
+    duplicate_index,
+)
+from .titles import TitleParser, load_rules, parser_version
 from .utils import StyledThread
+from .verify import fingerprint
+from .youtube import ratelimit
 from .youtube.downloader import downloader
-from .youtube.fetch import fetch_playlist, fetch_songs
+from .youtube.fetch import fetch_songs, iter_entries, iter_playlists, iter_songs
 
 
-def synchronize(yt_playlist_id, db_path, storage_dir, music_dir):
+def synchronize(yt_playlist_id, db_path, storage_dir, music_dir, config=None):
+    synchronize_all([yt_playlist_id], db_path, storage_dir, music_dir, config=config)
+
+
+def synchronize_all(
+    yt_playlist_ids,
+    db_path,
+    storage_dir,
+    music_dir,
+    prune=False,
+    config=None,
+    synced_ids=None,
+    db: PlaylistDB = None,
+    ffmpeg_string: str = None,
+):
+    """Synchronises several playlists in one session.
+
+    Playlists are enumerated while downloading: every new song found is handed to
+    the downloader straight away, and songs shared by multiple playlists are only
+    downloaded once. Memberships and links are applied once all playlists are
+    planned.
+
+    Args:
+        yt_playlist_ids (list): YouTube playlist IDs.
+        db_path (str): Database file.
+        storage_dir (str): Folder where downloaded songs are stored.
+        music_dir (str): Folder where playlist folders are created.
+        prune (bool, optional): Drop playlists which are not in `synced_ids`.
+            Defaults to False.
+        config (dict, optional): User configuration. Defaults to load_config().
+        synced_ids (list, optional): Every playlist which should stay synced, when
+            only some of them are synchronised now. Defaults to `yt_playlist_ids`.
+        db (PlaylistDB, optional): Open database to reuse. Defaults to opening
+            `db_path`.
+        ffmpeg_string (str, optional): Known ffmpeg location. Defaults to looking
+            it up.
+    """
     db_path = Path(db_path)
     db_path.parent.mkdir(parents=True, exist_ok=True)
     music_dir = Path(music_dir)
@@ -17,125 +70,364 @@ def synchronize(yt_playlist_id, db_path, storage_dir, music_dir):
     storage_dir = Path(storage_dir)
     storage_dir.mkdir(parents=True, exist_ok=True)
 
-    db = PlaylistDB(str(db_path))
+    db = db or PlaylistDB(str(db_path))
+    config = config or load_config()
+    if ffmpeg_string is None:
+        ffmpeg_string = ffmpeg_location()
+    if synced_ids is None:
+        synced_ids = yt_playlist_ids
+    ratelimit.configure(config)
+    storage_dir = str(storage_dir.absolute())
+    music_dir = str(music_dir.absolute())
 
-    playlists_in_db = db.cur.execute(
-        f"""
-        SELECT 
-            yt_playlist_id
-        FROM 
-             {db.PLAYLIST_TABLE}; 
-        """,
-    ).fetchall()
-
-    synced = (yt_playlist_id,) in playlists_in_db
-    playlist = run_async_func(func=fetch_playlist, args=([yt_playlist_id],))[0]
-    upstream_videos = fetch_songs(playlist["videos"])
-    # print(len(upstream_videos))
-    if not synced:
-        db_playlist_id = db.create_playlist_entry(
-            True, yt_playlist_id, str(music_dir.absolute()), playlist["title"]
-        )
-    else:
-        db_playlist_id = db.cur.execute(
-            f"""
-                SELECT
-                    playlist_id
-                FROM
-                    {db.PLAYLIST_TABLE}
-                WHERE
-                    yt_playlist_id = ?
-            """,
-            (yt_playlist_id,),
-        ).fetchone()[0]
-
-    songs_in_db = db.cur.execute(
-        f"""
-            SELECT
-                yt_song_id, song_id, playlists
-            FROM
-                {db.SONGS_TABLE}
-        """,
-    ).fetchall()
-
-    music_dir.joinpath(playlist["title"]).mkdir(parents=True, exist_ok=True)
-
-    downable_videos = []
-    downed_videos = []
-    for i in upstream_videos:
-        downed = False
-        song_playlists = []
-        song_uuid = ""
-        for yt_song_id, sid, song_p in songs_in_db:
-            if yt_song_id == i["id"]:
-                downed = True
-                song_playlists = song_p.split(",")
-                song_uuid = sid
-                break
-        if downed:
-            downed_videos.append(i)
-            if db_playlist_id not in song_playlists:
-                db.add_song_playlist(song_uuid, db_playlist_id)
-        else:
-            downable_videos.append(i)
+    snapshots = fresh_snapshots(db, config["snapshot_max_age_hours"])
+    parser = title_parser(db)
+    index = LibraryIndex(db)
+    planner = Planner(index, storage_dir, music_dir, duplicate_index(index, config))
+    journal = Journal(db.path)
+    readers = Readers(db.path)  # for pipeline threads
+    playlists = []  # filled in while streaming
+    created = {}  # yt song id -> (song id, file, fingerprint), see downloader_callback
 
     try:
-        callback = {
-            "target": downloader_callback,
-            "kwargs": {"db": db, "playlist_uuid": db_playlist_id},
-            "info_kwarg": "info",
-        }
-
-        if len(downable_videos) != 0:
-            downloader(
-                downable_videos,
-                playlist,
-                str(storage_dir.absolute()),
-                ffmpeg_location(),
-                callback,
-            )
-
-        for i in upstream_videos:
-            try:
-                loc = db.cur.execute(
-                    f"""
-                        SELECT
-                            file_path
-                        FROM
-                            {db.SONGS_TABLE}
-                        WHERE
-                            yt_song_id = ?
-                    """,
-                    (i["id"],),
-                ).fetchone()[0]
-            except TypeError:
-                continue
-            storage_song_path = Path(loc)
-            symlink_path = music_dir.joinpath(playlist["title"], storage_song_path.name)
-            if symlink_path.exists():
-                continue
-
-            symlink_path.symlink_to(storage_song_path)
-
-        print("\033[1;32m✔\033[0m '%s' Synced!" % playlist["title"])
+        downloader(
+            stream_downloads(planner, yt_playlist_ids, snapshots, parser, playlists),
+            {"title": "Synchronising"},
+            storage_dir,
+            ffmpeg_string,
+            {
+                "target": downloader_callback,
+                "kwargs": {"readers": readers, "created": created},
+                "info_kwarg": "info",
+            },
+            config["jobs"],
+            config["processes"],
+            config["queue_size"],
+            journal,
+            config["codec"],
+            config["cover_size"],
+            config["cover_cache_mb"],
+        )
+        # Written in the transaction apply_plan commits, which must not hold the
+        # write lock while journal updates of the pipeline are still committing
+        journal.flush()
+        save_snapshots(db, playlists, snapshots, commit=False)
+        db.save_title_cache(parser.new, parser.version, commit=False)
 
+        plan = planner.finish(synced_ids if prune else None)
+        apply_plan(db, plan, music_dir, created, journal, config)
     except KeyboardInterrupt:
+        db.conn.rollback()
         print()
         print("Exiting... (user interrupt)")
         sys.exit(130)
+    except BaseException:  # do not leave the write transaction open
+        db.conn.rollback()
+        raise
+    finally:
+        journal.close()
+        readers.close()
+
+
+def stream_downloads(
+    planner: Planner, yt_playlist_ids, snapshots, parser: TitleParser, playlists: list
+):
+    """Plans playlists as they are enumerated and yields every new video to download.
+
+    Fetched playlists are appended to `playlists`.
+    """
+    for playlist in iter_playlists(yt_playlist_ids):
+        playlists.append(playlist)
+        p = planner.add_playlist(playlist)
+
+        entries = iter_entries(playlist, snapshots.get(playlist["id"]))
+        for video in iter_songs(entries, parser):
+            download = planner.add_video(p, video)
+            if download is not None:
+                yield download.video
+
+
+def plan_sync(
+    yt_playlist_ids, db_path, storage_dir, music_dir, prune=False, config_dir=""
+) -> SyncPlan:
+    """Builds the sync plan without touching disk or network beyond the playlist fetch.
+
+    The database is read from an in-memory copy, so it is neither migrated nor
+    created, and no folders are made.
+    """
+    db = PlaylistDB(db_path, read_only=True) if os.path.exists(db_path) else None
+    config = load_config(config_dir)
+    index = LibraryIndex(db)
+    snapshots = {}
+    parser = TitleParser(load_rules(config_dir))
+    if db is not None:
+        snapshots = fresh_snapshots(db, config["snapshot_max_age_hours"])
+        parser = title_parser(db, config_dir)
+    fetched = run_async_func(
+        func=fetch_playlists, args=(yt_playlist_ids, snapshots, parser)
+    )
+
+    return build_plan(
+        fetched,
+        index,
+        os.path.abspath(storage_dir),
+        os.path.abspath(music_dir),
+        yt_playlist_ids if prune else None,
+        duplicate_index(index, config),
+    )
+
+
+def apply_plan(
+    db: PlaylistDB,
+    plan: SyncPlan,
+    music_dir: str,
+    created: dict,
+    journal: Journal,
+    config: dict,
+):
+    """Applies a plan whose downloads have already run.
+
+    Database changes are written in one transaction, together with anything the
+    sync left uncommitted before, and committed before playlists are published
+    and the journal is cleaned up.
+
+    Args:
+        db (PlaylistDB): Database.
+        plan (SyncPlan): Finished plan.
+        music_dir (str): Folder where playlist folders are created.
+        created (dict): YouTube song id mapped to song id, file and fingerprint
+            for finished downloads. Song ids are None for new songs, which are
+            created here.
+        journal (Journal): Sync journal.
+        config (dict): User configuration, chooses each playlist's output.
+    """
+    playlist_uuids = {}  # yt playlist id -> db playlist id
+    for p in plan.playlists:
+        if p.playlist_id is None:
+            p.playlist_id = db.create_playlist_entry(
+                True, p.yt_playlist_id, music_dir, p.title, commit=False
+            )
+        else:
+            db.set_playlist_enabled(p.playlist_id, True, commit=False)
+        playlist_uuids[p.yt_playlist_id] = p.playlist_id
+
+    new = [
+        d
+        for d in plan.downloads
+        if d.video["id"] in created and created[d.video["id"]][0] is None
+    ]
+    song_ids = db.create_song_entries(
+        [
+            (
+                created[d.video["id"]][1],
+                d.video["id"],
+                d.video["artist"],
+                d.video["title"],
+                created[d.video["id"]][2],
+            )
+            for d in new
+        ],
+        commit=False,
+    )
+    for d, song_id in zip(new, song_ids):
+        created[d.video["id"]] = (song_id, *created[d.video["id"]][1:])
+
+    # Re-uploads are registered on the file of the song they duplicate
+    aliases = []
+    downloaded = {d.video["id"] for d in plan.downloads}
+    for a in plan.aliases:
+        if a.yt_song_id in created:
+            aliases.append((a, *created[a.yt_song_id][1:]))
+        elif a.yt_song_id not in downloaded:
+            aliases.append((a, a.source, None))
+        # else the original failed to download
+    song_ids = db.create_song_entries(
+        [
+            (file, a.video["id"], a.video["artist"], a.video["title"], found)
+            for a, file, found in aliases
+        ],
+        commit=False,
+    )
+    for (a, file, found), song_id in zip(aliases, song_ids):
+        created[a.video["id"]] = (song_id, file, found)
+    db.set_song_sources(
+        [
+            (created[song.video["id"]][0], song.video["duration"], song.video["kind"])
+            for song in new + [a for a, _, _ in aliases]
+        ]
+        + [(s.song_id, s.duration, s.kind) for s in plan.sources],
+        commit=False,
+    )
+    # Songs downloaded again because their file was found broken
+    new_ids = {d.video["id"] for d in new}
+    db.repair_songs(
+        [
+            created[d.video["id"]]
+            for d in plan.downloads
+            if d.video["id"] in created and d.video["id"] not in new_ids
+        ],
+        commit=False,
+    )
+
+    memberships = [
+        (m.song_id, playlist_uuids[m.yt_playlist_id]) for m in plan.memberships
+    ]
+    for d in plan.downloads + plan.aliases:
+        if d.video["id"] not in created:  # failed download
+            continue
+        for yt_playlist_id in d.playlists:
+            song_id = created[d.video["id"]][0]
+            memberships.append((song_id, playlist_uuids[yt_playlist_id]))
+    db.add_memberships(memberships, commit=False)
+    for p in plan.playlists:
+        db.set_playlist_order(
+            p.playlist_id, [video["id"] for video in p.videos], commit=False
+        )
+
+    db.remove_memberships(
+        [(r.song_id, r.playlist_id) for r in plan.removals], commit=False
+    )
+    for d in plan.dropped:
+        db.set_playlist_enabled(d.playlist_id, False, commit=False)
+    db.mark_orphans(commit=False)
+
+    for p in plan.playlists:
+        output = output_for(config, p.yt_playlist_id)
+        if p.previous_folder is not None:
+            db.set_playlist_folder(p.playlist_id, music_dir, p.title, commit=False)
+        if p.previous_output != output:
+            db.set_playlist_output(p.playlist_id, output, commit=False)
+    db.conn.commit()
+
+    # Published once committed, so a failing output can not undo the sync
+    for d in plan.dropped:
+        try_output(unpublish, d.output, d.folder, config)
+    for p in plan.playlists:
+        output = output_for(config, p.yt_playlist_id)
+        previous_output = p.previous_output or output
+        previous_folder = p.previous_folder or p.folder
+        if p.previous_folder is not None and previous_output == output:
+            if output in FOLDER_OUTPUTS:  # renamed upstream
+                rename_folder(p.previous_folder, p.folder)
+        if previous_output != output or previous_folder != p.folder:
+            try_output(unpublish, previous_output, previous_folder, config)
+        try_output(publish, output, p.folder, desired_links(p, created), config)
+
+    # Journaled tracks which are no longer downloads finished or left upstream
+    wanted = {d.video["id"] for d in plan.downloads}
+    stale = {}
+    for yt_song_id, (state, partial_path, job) in journal.load().items():
+        if state == "tagged":
+            journal.update(yt_song_id, "linked")
+        elif yt_song_id not in wanted:
+            stale[yt_song_id] = partial_path
+    for partial_path in stale.values():
+        if partial_path:
+            shutil.rmtree(partial_path, ignore_errors=True)
+    journal.remove(stale)
+
+    for p in plan.playlists:
+        print("\033[1;32m✔\033[0m '%s' Synced!" % p.title)
+
+
+def try_output(func: Callable, output: str, *args):
+    try:
+        func(output, *args)
+    except OutputError as e:
+        print("\033[1;33m!\033[0m %s output: %s" % (output, e))
+
+
+def desired_links(p: PlaylistPlan, created: dict) -> dict[str, str]:
+    """Returns a playlist's tracks by link name, in upstream order."""
+    desired = {}
+    for name, link in p.tree.items():
+        source = link.source
+        if link.yt_song_id in created:  # the extension is only known once stored
+            source = created[link.yt_song_id][1]
+            name = os.path.splitext(name)[0] + os.path.splitext(source)[1]
+        if os.path.exists(source):  # not a failed download
+            desired[name] = source
+
+    return desired
+
+
+def fetch_playlists(
+    yt_playlist_ids, snapshots=None, parser: TitleParser = None
+) -> list[tuple[dict, list[dict]]]:
+    """Fetches playlists and fully lists their videos.
+
+    Playlists whose snapshot still matches upstream are not enumerated again.
+    """
+    fetched = []
+    for playlist in iter_playlists(yt_playlist_ids):
+        entries = iter_entries(playlist, (snapshots or {}).get(playlist["id"]))
+        fetched.append((playlist, fetch_songs(entries, parser)))
+
+    return fetched
+
+
+def title_parser(db: PlaylistDB, config_dir: str = "") -> TitleParser:
+    """Returns a title parser with user rules and the database's parse cache."""
+    rules = load_rules(config_dir)
+    return TitleParser(rules, db.get_title_cache(parser_version(rules)))
+
+
+def fresh_snapshots(db: PlaylistDB, max_age_hours: float) -> dict[str, dict]:
+    """Returns playlist snapshots fully enumerated less than `max_age_hours` ago."""
+    deadline = datetime.datetime.now() - datetime.timedelta(hours=max_age_hours)
+    return {
+        yt_playlist_id: snapshot
+        for yt_playlist_id, snapshot in db.get_playlist_snapshots().items()
+        if datetime.datetime.fromisoformat(snapshot["fetch_time"]) > deadline
+    }
+
+
+def save_snapshots(
+    db: PlaylistDB, playlists, snapshots: dict[str, dict], commit: bool = True
+):
+    now = datetime.datetime.now().isoformat()
+    rows = []
+    for playlist in playlists:
+        if playlist["enumeration"] == "unchanged":
+            continue
+
+        # Only a full enumeration restarts the snapshot's age
+        fetch_time = now
+        if playlist["enumeration"] != "full":
+            fetch_time = snapshots[playlist["id"]]["fetch_time"]
+        rows.append(
+            (playlist["id"], playlist["entries"], playlist["count"], fetch_time)
+        )
+    db.upsert_playlist_snapshots(rows, commit)
+
 
+def downloader_callback(info: dict, readers: Readers, created: dict):
+    """Registers a downloaded song. Songs and memberships are written once
+    planning is done, in the transaction of apply_plan.
 
-def downloader_callback(info: dict, db: PlaylistDB, playlist_uuid: str):
-    songs_in_db = db.cur.execute(
+    Args:
+        info (dict): Downloader info of the song.
+        readers (Readers): Read-only connections to the database, this runs on a
+            pipeline thread.
+        created (dict): Filled with YouTube song id mapped to song id, None if the
+            song is new, file and fingerprint.
+    """
+    song = readers.execute(
         f"""
             SELECT
-                yt_song_id
+                song_id
             FROM
-                {db.SONGS_TABLE}
+                {PlaylistDB.SONGS_TABLE}
+            WHERE
+                yt_song_id = ?
         """,
-    ).fetchall()
-    if (info["id"],) not in songs_in_db:
-        db.create_song_entry(info["file"], info["id"], (playlist_uuid,))
+        (info["id"],),
+    )
+    created[info["id"]] = (
+        song[0][0] if song else None,
+        info["file"],
+        fingerprint(info["file"]),
+    )
 
 
 def run_async_func(func: Callable, args=None, kwargs=None):
@@ -0,0 +1,205 @@
+"""
+msync/tags.py - Tags and cover art of stored songs, whatever their container.
+
+Songs are MP4 (m4a), Ogg (opus, vorbis), FLAC or MP3 files depending on the codec
+policy. Matroska audio can not be tagged by mutagen and is left untagged.
+
+"""
+
+import base64
+
+from mutagen import File
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import APIC, ID3, TXXX
+from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+from mutagen.oggopus import OggOpus
+
+# Key of the source URL, read back by msync.youtube.utils.get_video_id
+MP4_URL_KEY = "----:com.apple.iTunes:purl"
+URL_KEY = "purl"
+# Where ffmpeg puts it in MP4 files tagged by yt-dlp, as before msync tagged them
+MP4_FFMPEG_URL_KEYS = ("purl", "\xa9cmt")
+
+# ReplayGain 2.0 keys, MP4 files prefix them with MP4_FREEFORM
+REPLAYGAIN_KEYS = (
+    "replaygain_track_gain",
+    "replaygain_track_peak",
+    "replaygain_album_gain",
+    "replaygain_album_peak",
+)
+MP4_FREEFORM = "----:com.apple.iTunes:"
+
+# Opus files carry R128 gains instead (RFC 7845): Q7.8 integers relative to -23
+# LUFS, which is 5 dB below the -18 LUFS of ReplayGain
+R128_KEYS = ("R128_TRACK_GAIN", "R128_ALBUM_GAIN")
+R128_OFFSET = -5.0
+
+
+def open_tagged(path: str, easy: bool = False):
+    """Returns the mutagen file with tags added if missing, None if untaggable."""
+    audio = File(path, easy=easy)
+    if audio is not None and audio.tags is None:
+        audio.add_tags()
+    return audio
+
+
+def write_tags(path: str, title: str, artist: str, url: str = ""):
+    audio = open_tagged(path, easy=True)
+    if audio is None:
+        return
+    audio["title"] = title
+    audio["artist"] = artist
+    audio.save()
+
+    if not url:
+        return
+    audio = open_tagged(path)
+    if isinstance(audio, MP4):
+        audio[MP4_URL_KEY] = [MP4FreeForm(url.encode())]
+    elif isinstance(audio.tags, ID3):
+        audio.tags.add(TXXX(encoding=3, desc=URL_KEY, text=[url]))
+    else:  # Vorbis comments
+        audio[URL_KEY] = [url]
+    audio.save()
+
+
+def write_replaygain(
+    path: str,
+    track_gain: float,
+    track_peak: float,
+    album_gain: float = None,
+    album_peak: float = None,
+) -> bool:
+    """Tags a song with its ReplayGain, replacing older values.
+
+    Args:
+        path (str): Song file.
+        track_gain (float): Gain to -18 LUFS in dB.
+        track_peak (float): True peak, 1.0 being full scale.
+        album_gain (float, optional): Gain of the song's album. Defaults to None,
+            album tags are then removed.
+        album_peak (float, optional): Peak of the song's album.
+
+    Returns:
+        bool: False if the container can not be tagged
+    """
+    audio = open_tagged(path)
+    if audio is None:
+        return False
+
+    if isinstance(audio, OggOpus):
+        values = dict(zip(R128_KEYS, (track_gain, album_gain)))
+        for key, gain in values.items():
+            if gain is None:
+                audio.pop(key, None)
+            else:
+                audio[key] = [str(round((gain + R128_OFFSET) * 256))]
+        audio.save()
+        return True
+
+    values = (track_gain, track_peak, album_gain, album_peak)
+    for key, value, kind in zip(REPLAYGAIN_KEYS, values, ("gain", "peak") * 2):
+        text = None
+        if value is not None:
+            text = "%.2f dB" % value if kind == "gain" else "%.6f" % value
+        if isinstance(audio, MP4):
+            key = MP4_FREEFORM + key
+            if text is None:
+                audio.pop(key, None)
+            else:
+                audio[key] = [MP4FreeForm(text.encode())]
+        elif isinstance(audio.tags, ID3):
+            audio.tags.delall("TXXX:" + key.upper())
+            if text is not None:
+                audio.tags.add(TXXX(encoding=3, desc=key.upper(), text=[text]))
+        elif text is None:  # Vorbis comments
+            audio.pop(key, None)
+        else:
+            audio[key] = [text]
+    audio.save()
+
+    return True
+
+
+def read_tags(path: str) -> dict[str, str]:
+    """Returns the 'title', 'artist' and 'url' of a song, empty if missing."""
+    tags = {"title": "", "artist": "", "url": ""}
+    audio = File(path, easy=True)
+    if audio is None or audio.tags is None:
+        return tags
+    for key in ("title", "artist"):
+        tags[key] = (audio.get(key) or [""])[0]
+
+    audio = File(path)
+    if isinstance(audio, MP4):
+        urls = [bytes(value).decode() for value in audio.get(MP4_URL_KEY, [])]
+        urls += [
+            value
+            for key in MP4_FFMPEG_URL_KEYS
+            for value in audio.get(key, [])
+            if "://" in value  # comments may be anything
+        ]
+        tags["url"] = (urls or [""])[0]
+    elif isinstance(audio.tags, ID3):
+        frame = audio.tags.get("TXXX:" + URL_KEY)
+        tags["url"] = frame.text[0] if frame else ""
+    else:
+        tags["url"] = (audio.get(URL_KEY) or [""])[0]
+
+    return tags
+
+
+def cover_picture(data: bytes) -> Picture:
+    picture = Picture()
+    picture.type = 3  # front cover
+    picture.mime = "image/jpeg"
+    picture.data = data
+    return picture
+
+
+def embed_cover(path: str, data: bytes) -> bool:
+    """Embeds JPEG `data` as front cover.
+
+    Returns:
+        bool: False if the container can not hold cover art
+    """
+    audio = open_tagged(path)
+    if audio is None:
+        return False
+
+    if isinstance(audio, MP4):
+        audio["covr"] = [MP4Cover(data, imageformat=MP4Cover.FORMAT_JPEG)]
+    elif isinstance(audio, FLAC):
+        audio.clear_pictures()
+        audio.add_picture(cover_picture(data))
+    elif isinstance(audio.tags, ID3):
+        audio.tags.add(
+            APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=data)
+        )
+    else:  # Ogg
+        picture = base64.b64encode(cover_picture(data).write()).decode()
+        audio["metadata_block_picture"] = [picture]
+    audio.save()
+
+    return True
+
+
+def read_cover(path: str):
+    """Returns the embedded JPEG or PNG front cover, None if there is none."""
+    audio = File(path)
+    if audio is None or audio.tags is None:
+        return None
+
+    if isinstance(audio, MP4):
+        covers = audio.get("covr")
+        return bytes(covers[0]) if covers else None
+    elif isinstance(audio, FLAC):
+        return audio.pictures[0].data if audio.pictures else None
+    elif isinstance(audio.tags, ID3):
+        frames = audio.tags.getall("APIC")
+        return frames[0].data if frames else None
+
+    pictures = audio.get("metadata_block_picture")
+    if not pictures:
+        return None
+    return Picture(base64.b64decode(pictures[0])).data
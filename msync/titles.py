@@ -0,0 +1,109 @@
+"""
+msync/titles.py - Artist and title parsing of YouTube video titles.
+
+User rules from title_rules.json are tried first, then youtube_title_parse, then
+the channel name is used as artist. Results can be cached per (video id, raw title)
+so unchanged videos are never parsed twice.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+from importlib.metadata import PackageNotFoundError
+from importlib.metadata import version as package_version
+
+from youtube_title_parse import get_artist_title as extract
+
+from .utils import get_user_config_folder
+
+RULES_FILE = "title_rules.json"
+
+# Bump whenever parsing changes in a way that invalidates cached results.
+PARSER_VERSION = 1
+
+
+def load_rules(config_dir: str = "") -> list[dict]:
+    """Reads user title rules.
+
+    title_rules.json holds a list of rules like
+    {"match": "^(?P<title>.+) by (?P<artist>.+)$", "artist": "\\g<artist>",
+    "title": "\\g<title>"}. 'artist' and 'title' are re.Match.expand templates.
+
+    Args:
+        config_dir (str, optional): Folder containing title_rules.json. Defaults to
+            the user config folder.
+
+    Returns:
+        list[dict]: rules, empty if there is no rules file
+    """
+    try:
+        path = os.path.join(config_dir or get_user_config_folder(), RULES_FILE)
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def parser_version(rules: list[dict]) -> str:
+    """Returns a version string which changes with the parser, its library or rules."""
+    try:
+        library = package_version("youtube-title-parse")
+    except PackageNotFoundError:
+        library = ""
+    digest = hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+
+    return f"{PARSER_VERSION}/{library}/{digest[:12]}"
+
+
+def normalise(artist: str, title: str) -> tuple[str, str]:
+    artist = artist.replace(" - Topic", "")  # special case
+    title = title.replace("/", "-")  # special case
+    return artist, title
+
+
+class TitleParser:
+    """TitleParser class.
+
+    Parses (artist, title) pairs from playlist entries. Rules are compiled once.
+    Pass a cache from PlaylistDB.get_title_cache for parser_version(rules) to skip
+    known videos, newly parsed ones are collected in `new` to be saved back.
+    """
+
+    def __init__(self, rules: list[dict] = (), cache: dict = None) -> None:
+        self.rules = [
+            (re.compile(rule["match"]), rule["artist"], rule["title"]) for rule in rules
+        ]
+        self.cache = cache if cache is not None else {}
+        self.new: dict[tuple[str, str], tuple[str, str]] = {}
+        self.version = parser_version(rules)
+
+    def parse_title(self, raw_title: str, channel: str) -> tuple[str, str]:
+        for pattern, artist, title in self.rules:
+            match = pattern.search(raw_title)
+            if match is not None:
+                return normalise(match.expand(artist), match.expand(title))
+
+        try:
+            # Parse the title to extract only the artist and title.
+            artist, title = extract(raw_title)
+        except TypeError:
+            # Fallback if youtube_title_parse is not able to parse a title.
+            artist, title = (channel or "", raw_title)
+
+        return normalise(artist, title)
+
+    def parse(self, entry: dict) -> tuple[str, str]:
+        """Returns (artist, title) of a playlist entry, from the cache if possible."""
+        key = (entry["id"], entry["title"])
+        parsed = self.cache.get(key)
+        if parsed is None:
+            parsed = self.parse_title(entry["title"], entry.get("channel"))
+            self.cache[key] = self.new[key] = parsed
+
+        return parsed
+
+    def parse_batch(self, entries) -> list[tuple[str, str]]:
+        """Returns (artist, title) of every entry of a playlist."""
+        return [self.parse(entry) for entry in entries]
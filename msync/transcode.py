@@ -0,0 +1,206 @@
+"""
+msync/transcode.py - Device copies of synced songs in transcode profiles.
+
+A profile ('transcode_profiles' in config) names a codec, bitrate and sample rate.
+Every profile has a cache folder of transcoded songs named after the content hash
+of their source and a digest of the profile's settings, so a song is only
+transcoded again when its file or the profile changes. Songs which are no longer
+in any synced playlist have their transcodes evicted.
+
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from .db import PlaylistDB
+from .tags import embed_cover, read_cover, read_tags, write_tags
+from .verify import fingerprint
+from .youtube.postprocess import run_ffmpeg
+
+# Profile codec -> (extension, ffmpeg encoder)
+CODECS = {
+    "opus": ("opus", "libopus"),
+    "mp3": ("mp3", "libmp3lame"),
+    "m4a": ("m4a", "aac"),
+}
+
+
+@dataclass
+class TranscodeResult:
+    songs: int = 0  # synced song files
+    transcoded: int = 0  # transcodes made
+    cached: int = 0  # transcodes already in the cache
+    evicted: int = 0  # transcodes of songs no longer synced, or stale
+    failed: list[str] = field(default_factory=list)  # sources ffmpeg failed on
+
+
+def profile_for(config: dict, name: str) -> dict:
+    profile = config["transcode_profiles"].get(name)
+    if profile is None:
+        raise ValueError("unknown transcode profile %r" % name)
+    if profile["codec"] not in CODECS:
+        raise ValueError("unknown codec %r in profile %r" % (profile["codec"], name))
+    return profile
+
+
+def cache_folder(config: dict, data_dir: str, name: str) -> str:
+    """Returns the cache folder of a profile, below 'transcode_dir' in config."""
+    return os.path.join(
+        config["transcode_dir"] or os.path.join(data_dir, "transcodes"), name
+    )
+
+
+def profile_digest(profile: dict) -> str:
+    """Returns a digest which changes with the settings of a profile."""
+    settings = json.dumps(profile, sort_keys=True).encode()
+    return hashlib.sha1(settings).hexdigest()[:8]
+
+
+def transcoded_path(cache_dir: str, profile: dict, content_hash: str) -> str:
+    """Returns where the transcode of a song in `profile` is cached.
+
+    Args:
+        cache_dir (str): Cache folder of the profile.
+        profile (dict): Profile settings.
+        content_hash (str): Content hash of the source, see msync.verify.
+    """
+    extension = CODECS[profile["codec"]][0]
+    return os.path.join(
+        cache_dir,
+        content_hash[:2],
+        f"{content_hash}-{profile_digest(profile)}.{extension}",
+    )
+
+
+def transcode_file(path: str, output: str, profile: dict, ffmpeg_string: str):
+    """Encodes a song into `output` with the settings of `profile`, keeping tags
+    and cover art."""
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    root, extension = os.path.splitext(output)
+    transcoding = root + ".transcoding" + extension
+
+    tags = read_tags(path)
+    cover = read_cover(path)
+    run_ffmpeg(
+        ffmpeg_string,
+        "-i",
+        path,
+        "-vn",
+        "-map",
+        "0:a:0",
+        "-c:a",
+        CODECS[profile["codec"]][1],
+        "-b:a",
+        str(profile["bitrate"]),
+        "-ar",
+        str(profile["sample_rate"]),
+        transcoding,
+    )
+    if tags["title"]:
+        write_tags(transcoding, tags["title"], tags["artist"], tags["url"])
+    if cover:
+        embed_cover(transcoding, cover)
+    os.replace(transcoding, output)
+
+
+def synced_hashes(
+    db: PlaylistDB, pool: ProcessPoolExecutor, dry_run: bool = False
+) -> dict[str, str]:
+    """Returns the content hash of every song file in an enabled playlist.
+
+    Hashes which are missing or older than their file are computed on `pool` and
+    recorded, unless `dry_run` is set.
+    """
+    FETCH_SYNCED = f"""
+        SELECT DISTINCT
+            file_path, size, mtime_ns, content_hash
+        FROM
+            {db.SONGS_TABLE}
+            JOIN {db.SONG_PLAYLISTS_TABLE} USING (song_id)
+            JOIN {db.PLAYLIST_TABLE} USING (playlist_id)
+        WHERE
+            enabled = 1 AND broken_time IS NULL ;
+    """
+
+    hashes, stale = {}, []
+    for path, size, mtime_ns, digest in db.cur.execute(FETCH_SYNCED).fetchall():
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:  # left to msync verify
+            continue
+        if digest is None or (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            stale.append(path)
+        else:
+            hashes[path] = digest
+
+    found = list(pool.map(fingerprint, stale))
+    if not dry_run:
+        db.set_fingerprints(list(zip(stale, found)))
+    hashes.update((path, f[2]) for path, f in zip(stale, found))
+
+    return hashes
+
+
+def transcode_library(
+    db: PlaylistDB,
+    profile: dict,
+    cache_dir: str,
+    ffmpeg_string: str,
+    processes: int = 0,
+    dry_run: bool = False,
+) -> TranscodeResult:
+    """Brings the cache of a transcode profile up to date with synced playlists.
+
+    Args:
+        db (PlaylistDB): Database.
+        profile (dict): Profile settings, see profile_for.
+        cache_dir (str): Cache folder of the profile.
+        ffmpeg_string (str): ffmpeg location.
+        processes (int, optional): Encoding processes, 0 uses every core.
+        dry_run (bool, optional): Only count what would be done.
+
+    Returns:
+        TranscodeResult: what was transcoded and evicted
+    """
+    result = TranscodeResult()
+    with ProcessPoolExecutor(max_workers=processes or None) as pool:
+        hashes = synced_hashes(db, pool, dry_run)
+        result.songs = len(hashes)
+
+        wanted = {}  # transcode -> source
+        for path, digest in hashes.items():
+            wanted.setdefault(transcoded_path(cache_dir, profile, digest), path)
+
+        todo = [output for output in wanted if not os.path.exists(output)]
+        result.cached = len(wanted) - len(todo)
+        futures = []
+        if not dry_run:
+            futures = [
+                (
+                    output,
+                    pool.submit(
+                        transcode_file, wanted[output], output, profile, ffmpeg_string
+                    ),
+                )
+                for output in sorted(todo)
+            ]
+        for output, future in futures:
+            try:
+                future.result()
+            except subprocess.CalledProcessError:
+                result.failed.append(wanted[output])
+        result.transcoded = len(todo) - len(result.failed)
+
+    for folder, _, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(folder, name)
+            if path not in wanted:  # unsynced song, old profile or partial file
+                result.evicted += 1
+                if not dry_run:
+                    os.remove(path)
+
+    return result
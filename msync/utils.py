@@ -52,6 +52,35 @@ def get_user_config_folder(make_folder: bool = True) -> str:
     return user_config
 
 
+def read_sync_list(path: str) -> list[str]:
+    """Reads playlist IDs from a sync list. Blank lines and '#' comments are ignored.
+
+    Args:
+        path (str): sync.lst file
+
+    Returns:
+        list[str]: playlist IDs, empty if the file does not exist
+    """
+    pl = []
+    try:
+        with open(path, "r") as f:
+            for line in f.readlines():
+                line = line.strip()
+                if line.startswith("#"):
+                    continue
+                elif not line:
+                    continue
+
+                com = line.rfind(" #")
+                if com != -1:
+                    line = line[:com].strip()
+                pl.append(line)
+    except FileNotFoundError:
+        pl = []
+
+    return pl
+
+
 class StyledThread(threading.Thread):
     """StyledThread class.
 
@@ -0,0 +1,163 @@
+"""
+msync/verify.py - Integrity checks of stored songs.
+
+Every song records the size, mtime and a BLAKE2 hash of its file when it is
+registered. Verification only reads files whose size or mtime changed since, or
+which have no fingerprint yet, unless a full check is asked for: those are hashed
+and their container is checked with mutagen. Songs whose file is missing, can not
+be parsed or is truncated are marked broken, the next sync downloads them again.
+
+"""
+
+import hashlib
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from mutagen import File, MutagenError
+from mutagen.mp4 import MP4
+
+from .db import PlaylistDB
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files a worker process checks per task
+CHUNK_SIZE = 16
+
+# Containers mutagen can not parse, only hashed
+UNCHECKED_EXTENSIONS = {".mka"}
+
+
+@dataclass
+class VerifyResult:
+    checked: int = 0  # song files looked at
+    read: int = 0  # files hashed and parsed
+    unchanged: int = 0  # files skipped for their size and mtime
+    broken: list[tuple[str, str]] = field(default_factory=list)  # (path, problem)
+
+
+def content_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(path: str) -> tuple[int, int, str]:
+    """Returns (size, mtime in ns, content hash) of a file."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, content_hash(path)
+
+
+def mp4_truncated(path: str) -> bool:
+    """Tells whether an MP4 file ends inside one of its top level atoms."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(16)
+            if len(header) < 8:
+                return True
+            length, _ = struct.unpack(">I4s", header[:8])
+            if length == 1:  # 64 bit size
+                if len(header) < 16:
+                    return True
+                length = struct.unpack(">Q", header[8:16])[0]
+            elif length == 0:  # runs to the end of the file
+                return False
+            if length < 8:
+                return True
+            offset += length
+        return offset != size
+
+
+def check_container(path: str) -> str:
+    """Parses a song's container, returns what is wrong with it or ""."""
+    if os.path.splitext(path)[1] in UNCHECKED_EXTENSIONS:
+        return ""
+    try:
+        audio = File(path)
+    except MutagenError as e:
+        return "unreadable (%s)" % e
+    if audio is None:
+        return "unknown container"
+    if not audio.info.length:
+        return "no audio"
+    if isinstance(audio, MP4) and mp4_truncated(path):
+        return "truncated"
+    return ""
+
+
+def verify_file(path: str):
+    """Returns the fingerprint of a song file and what is wrong with it or ""."""
+    try:
+        return fingerprint(path), check_container(path)
+    except FileNotFoundError:
+        return None, "missing"
+    except OSError as e:
+        return None, "unreadable (%s)" % e.strerror
+
+
+def verify_library(
+    db: PlaylistDB, processes: int = 0, full: bool = False
+) -> VerifyResult:
+    """Checks stored songs and queues broken ones for download by the next sync.
+
+    Args:
+        db (PlaylistDB): Database.
+        processes (int, optional): Checking processes, 0 uses every core.
+        full (bool, optional): Hash unchanged files as well, to find corruption
+            which kept size and mtime. Defaults to False.
+
+    Returns:
+        VerifyResult: what was checked and found broken
+    """
+    FETCH_SONGS = f"""
+        SELECT
+            file_path, size, mtime_ns, content_hash, broken_time
+        FROM
+            {db.SONGS_TABLE};
+    """
+
+    recorded = {}  # path -> (size, mtime in ns, content hash), None if unknown
+    for path, size, mtime_ns, digest, broken_time in db.cur.execute(FETCH_SONGS):
+        if broken_time is None:  # broken ones are replaced on the next sync
+            recorded[path] = (size, mtime_ns, digest)
+
+    result = VerifyResult(checked=len(recorded))
+    todo = []
+    for path, (size, mtime_ns, digest) in sorted(recorded.items()):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            result.broken.append((path, "missing"))
+            continue
+        unchanged = (st.st_size, st.st_mtime_ns) == (size, mtime_ns)
+        if full or not unchanged or digest is None:
+            todo.append(path)
+        else:
+            result.unchanged += 1
+
+    healthy = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=processes or None) as pool:
+            checks = pool.map(verify_file, todo, chunksize=CHUNK_SIZE)
+            for path, (found, problem) in zip(todo, checks):
+                old = recorded[path]
+                if not problem and full and found[:2] == old[:2] and old[2]:
+                    if found[2] != old[2]:
+                        problem = "content changed"
+                if problem:
+                    result.broken.append((path, problem))
+                else:
+                    healthy.append((path, found))
+        result.read = len(todo)
+
+    db.set_fingerprints(healthy, commit=False)
+    db.mark_broken([path for path, _ in result.broken], commit=False)
+    db.conn.commit()
+
+    return result
@@ -20,13 +20,30 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
 
-import tempfile
+import multiprocessing
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import urllib.parse
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from functools import partial
 from typing import Any, Callable
 
 import yt_dlp as youtube_dl
-from mutagen.easymp4 import EasyMP4
 from tqdm import tqdm
 
+from ..tags import write_tags
+
+from .postprocess import postprocess
+from .ratelimit import LIMITER, Cancelled, is_throttled
+from .ratelimit import summary as limiter_summary
+from .thumbnails import add_thumbnail, cached_cover, evict
+
+# Attempts at a video YouTube keeps throttling before it is skipped
+THROTTLE_RETRIES = 3
+
 
 class MyLogger(object):
     def debug(self, msg):
@@ -40,37 +57,43 @@ class MyLogger(object):
         pass
 
 
-def update_metadata(media_file: str, title: str, artist: str):
-    audio = EasyMP4(media_file)
-    audio["title"] = title
-    audio["artist"] = artist
-    audio.save()
+def update_metadata(media_file: str, title: str, artist: str, url: str = ""):
+    write_tags(media_file, title, artist, url)
 
 
 class ProgressHook:
-    def __init__(self) -> None:
+    def __init__(self, position: int = 0, cancelled: threading.Event = None) -> None:
         self.bar = tqdm(
             unit="B",
             unit_divisor=1024,
             unit_scale=True,
-            position=0,
+            position=position,
             leave=False,
             bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} ",
         )
         self.bar.clear()
         self.started = False
         self.last_down = 0
+        self.limited = 0  # bytes accounted with LIMITER
+        self.cancelled = cancelled
+        self.transfer = None  # LIMITER transfer of the running download
 
     def hook(self, d):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise youtube_dl.utils.DownloadCancelled()
         if not self.started:
             self.bar.total = float(d["total_bytes"])
             self.bar.refresh()
             self.started = True
+            self.limited = float(d.get("downloaded_bytes") or 0)  # resumed bytes
         # print(d)
         if d["status"] == "downloading":
             downloaded_bytes_delta = float(d["downloaded_bytes"]) - self.last_down
             self.bar.update(downloaded_bytes_delta)
             self.last_down = float(d["downloaded_bytes"])
+            if self.transfer is not None:
+                LIMITER.consume(self.transfer, self.last_down - self.limited)
+                self.limited = self.last_down
 
         if d["status"] == "finished":
             self.bar.clear()
@@ -83,24 +106,26 @@ class ProgressHook:
         self.started = False
 
 
-def gen_options(
-    playlist, output_folder, tmpdir, video, ffmpeg_string, prog: ProgressHook
-):
+def storage_filename(output_folder: str, video: dict, extension: str = "m4a") -> str:
+    """Returns where a video is stored, <id>.<extension> sharded by a hash of its ID.
+
+    Readable names only appear in the database and in playlist folders.
+    """
+    digest = hashlib.sha1(video["id"].encode()).hexdigest()
+    return os.path.join(
+        output_folder, digest[:2], digest[2:4], f'{video["id"]}.{extension}'
+    )
+
+
+def gen_options(workdir, video, ffmpeg_string, prog: ProgressHook, codec="m4a"):
     prog.update(video)
 
+    # Post-processing happens in the pipeline's process pool, not in yt-dlp. Only
+    # the m4a policy prefers AAC sources, which it can stream copy.
     ydl_opts = {
-        "writethumbnail": True,
-        "format": "m4a/bestaudio/best",
-        "outtmpl": f'{video["artist"]} - {video["title"]}.%(ext)s',
-        "paths": {"temp": tmpdir, "home": output_folder},
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "m4a",
-            },
-            {"key": "FFmpegMetadata", "add_metadata": "True"},
-            {"key": "EmbedThumbnail", "already_have_thumbnail": False},
-        ],
+        "format": "m4a/bestaudio/best" if codec == "m4a" else "bestaudio/best",
+        "outtmpl": "%(id)s.%(ext)s",
+        "paths": {"temp": workdir, "home": workdir},
         "logger": MyLogger(),
         "progress_hooks": [prog.hook],
     }
@@ -111,56 +136,417 @@ def gen_options(
     return ydl_opts
 
 
+def fetch_thumbnail(ydl, info: dict, workdir: str, covers, cancelled) -> dict:
+    """Looks up the cover of a video in the cover cache, downloading it if needed.
+
+    Returns:
+        dict: 'cover' if cached, else the downloaded 'thumbnail' and its
+            'thumbnail_digest', for the post-processing stage to convert.
+    """
+    url = info.get("thumbnail")
+    if not url or covers is None:
+        return {}
+    folder, size = covers
+
+    cover = cached_cover(folder, url, size)
+    if cover is not None:
+        return {"cover": cover}
+
+    try:
+        with LIMITER.request(slot=False, cancelled=cancelled):
+            data = ydl.urlopen(url).read()
+    except (youtube_dl.utils.YoutubeDLError, OSError, Cancelled):
+        return {}
+    digest, cover = add_thumbnail(folder, url, data, size)
+    if cover:  # same art as a cached thumbnail
+        return {"cover": cover}
+
+    extension = os.path.splitext(urllib.parse.urlparse(url).path)[1] or ".jpg"
+    thumbnail = os.path.join(workdir, info["id"] + ".thumbnail" + extension)
+    with open(thumbnail, "wb") as f:
+        f.write(data)
+    return {"thumbnail": thumbnail, "thumbnail_digest": digest}
+
+
+def fetch_video(
+    video,
+    workdir,
+    ffmpeg_string,
+    prog: ProgressHook,
+    codec: str = "m4a",
+    covers: tuple = None,
+) -> dict:
+    """Downloads the audio of a video into workdir, and its thumbnail unless cached.
+
+    Partial downloads left in workdir by an interrupted run are continued. Requests
+    go through LIMITER, throttled ones are retried once it has backed off.
+
+    Args:
+        covers (tuple, optional): Cover cache folder and cover size. Defaults to
+            None, no cover art.
+
+    Returns:
+        dict: Job for the post-processing stage, None on failure.
+    """
+    ydl_opts = gen_options(workdir, video, ffmpeg_string, prog, codec)
+    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+        for attempt in range(THROTTLE_RETRIES + 1):
+            try:
+                with LIMITER.request(cancelled=prog.cancelled) as prog.transfer:
+                    info = ydl.extract_info(video["id"], download=True)
+                break
+            except youtube_dl.utils.DownloadError as e:
+                if not is_throttled(e) or attempt == THROTTLE_RETRIES:
+                    return None
+            except (
+                youtube_dl.utils.ExtractorError,
+                youtube_dl.utils.DownloadCancelled,
+                Cancelled,
+            ):
+                return None
+            finally:
+                prog.transfer = None
+
+        cover = fetch_thumbnail(ydl, info, workdir, covers, prog.cancelled)
+
+    return {
+        "video": video,
+        "url": info.get("webpage_url", ""),
+        "media": info["requested_downloads"][0]["filepath"],
+        "acodec": info.get("acodec", ""),
+        "codec": codec,
+        "covers": covers,
+        "ffmpeg": ffmpeg_string,
+        **cover,
+    }
+
+
+def put(q: queue.Queue, item, cancelled: threading.Event) -> bool:
+    """Puts into a bounded queue without blocking forever once cancelled."""
+    while not cancelled.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class Pipeline:
+    """Pipeline class.
+
+    Runs downloads as fetch -> postprocess -> tag & commit stages joined by
+    bounded queues. Fetching runs on `jobs` threads, each with its own progress
+    bar, ffmpeg work runs on a process pool and tagging plus callbacks run on the
+    thread calling `run`.
+
+    Every video gets its own folder under `partial_folder`, and each finished
+    stage is recorded in `journal` so an interrupted run resumes from there.
+    """
+
+    DONE = None
+
+    def __init__(
+        self,
+        jobs: int,
+        processes: int,
+        queue_size: int,
+        partial_folder: str,
+        journal,
+        codec: str = "m4a",
+        covers: tuple = None,
+    ) -> None:
+        self.jobs = jobs
+        self.processes = processes
+        self.partial_folder = partial_folder
+        self.journal = journal
+        self.resume = journal.load() if journal is not None else {}
+        self.cancelled = threading.Event()
+        self.fetch_q = queue.Queue(maxsize=queue_size)  # videos to fetch
+        self.process_q = queue.Queue(maxsize=queue_size)  # fetched, to postprocess
+        self.tag_q = queue.Queue()  # postprocessed, to tag & commit
+        self.max_depth = {"fetch": 0, "process": 0, "tag": 0}
+        self.codec = codec
+        self.covers = covers
+        self.transcoded = 0
+        self.copied = 0
+        self.fed = 0
+        self.error = None  # raised by the videos iterable
+
+    def depths(self) -> dict[str, int]:
+        depths = {
+            "fetch": self.fetch_q.qsize(),
+            "process": self.process_q.qsize(),
+            "tag": self.tag_q.qsize(),
+        }
+        for stage, depth in depths.items():
+            self.max_depth[stage] = max(self.max_depth[stage], depth)
+        return depths
+
+    def record(self, video_id, state, **kwargs):
+        if self.journal is not None:
+            self.journal.update(video_id, state, **kwargs)
+
+    def workdir(self, video) -> str:
+        return os.path.join(self.partial_folder, video["id"])
+
+    def feed(self, videos):
+        """Puts videos into the pipeline, `videos` may still be producing them."""
+        try:
+            for video in videos:
+                q, item = self.resume_point(video)
+                if not put(q, item, self.cancelled):
+                    return
+                self.fed += 1
+        except BaseException as e:
+            self.error = e
+        finally:
+            for _ in range(self.jobs):
+                put(self.fetch_q, self.DONE, self.cancelled)
+
+    def resume_point(self, video) -> tuple[queue.Queue, Any]:
+        """Returns the queue a video enters the pipeline at and its queue item."""
+        state, _, job = self.resume.get(video["id"], ("queued", None, {}))
+        job["video"] = video  # upstream metadata may have changed meanwhile
+        job["ffmpeg"] = self.ffmpeg_string
+        job["covers"] = self.covers
+
+        match state:
+            case "downloaded" if os.path.exists(job["media"]):
+                return self.process_q, job
+            case "postprocessed" if os.path.exists(job["audio"]):
+                return self.tag_q, (video, job)
+            case "tagged" if os.path.exists(job["file"]):
+                return self.tag_q, (video, job)
+
+        return self.fetch_q, video
+
+    def skip(self, video, error: Exception):
+        """Sends a video which failed unexpectedly on to commit, as a failure."""
+        tqdm.write(
+            "Error occured while processing '%s': %s"
+            % (f"https://youtu.be/{video['id']}", str(error) or type(error).__name__)
+        )
+        self.tag_q.put((video, None))
+
+    def fetch(self, ffmpeg_string, prog: ProgressHook):
+        try:
+            while not self.cancelled.is_set():
+                video = self.fetch_q.get()
+                if video is self.DONE:
+                    break
+
+                try:
+                    workdir = self.workdir(video)
+                    os.makedirs(workdir, exist_ok=True)
+                    self.record(video["id"], "queued", partial_path=workdir)
+
+                    job = fetch_video(
+                        video, workdir, ffmpeg_string, prog, self.codec, self.covers
+                    )
+                    if job is not None:
+                        self.record(video["id"], "downloaded", job=job)
+                except Exception as e:  # the video still has to reach commit
+                    self.skip(video, e)
+                    continue
+                if job is None:
+                    self.tag_q.put((video, None))
+                    continue
+                put(self.process_q, job, self.cancelled)
+        finally:  # process only ends once every fetch thread is done
+            put(self.process_q, self.DONE, self.cancelled)
+
+    def process(self, pool: ProcessPoolExecutor):
+        slots = threading.Semaphore(self.processes)
+
+        def finished(video, future):
+            try:
+                job = future.result()
+                self.record(video["id"], "postprocessed", job=job)
+                self.tag_q.put((video, job))
+            except (Exception, CancelledError):  # the video still has to reach commit
+                self.tag_q.put((video, None))
+            finally:  # only now, so DONE can not overtake this video
+                slots.release()
+
+        running = self.jobs
+        try:
+            while running and not self.cancelled.is_set():
+                job = self.process_q.get()
+                if job is self.DONE:
+                    running -= 1
+                    continue
+
+                slots.acquire()
+                try:
+                    future = pool.submit(postprocess, job)
+                except Exception as e:  # e.g. a broken pool
+                    slots.release()
+                    self.skip(job["video"], e)
+                    continue
+                future.add_done_callback(partial(finished, job["video"]))
+        finally:  # run only ends on DONE
+            for _ in range(self.processes):  # wait for outstanding work
+                slots.acquire()
+            self.tag_q.put((self.DONE, None))
+
+    def run(self, videos, ffmpeg_string, commit: Callable, bars: list, overall):
+        """Runs the pipeline to completion, calling `commit(video, job)` per video."""
+        self.ffmpeg_string = ffmpeg_string
+        # Workers are started from a thread, fork is not safe there
+        pool = ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")
+        )
+        threads = [
+            threading.Thread(target=self.feed, args=(videos,), daemon=True),
+            threading.Thread(target=self.process, args=(pool,), daemon=True),
+        ]
+        threads += [
+            threading.Thread(target=self.fetch, args=(ffmpeg_string, prog), daemon=True)
+            for prog in bars
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            while True:
+                overall.total = max(self.fed, overall.n)
+                try:
+                    video, job = self.tag_q.get(timeout=0.5)
+                except queue.Empty:
+                    overall.set_postfix(self.depths())
+                    continue
+                if video is self.DONE:
+                    break
+
+                overall.total = max(self.fed, overall.n + 1)
+                overall.update()
+                overall.set_postfix(self.depths())
+                if job is not None and "transcoded" in job:
+                    if job["transcoded"]:
+                        self.transcoded += 1
+                    else:
+                        self.copied += 1
+                commit(video, job)
+        except BaseException:
+            self.cancelled.set()
+            raise
+        finally:
+            pool.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+
+        if self.error is not None:
+            raise self.error
+
+
 def downloader(
     videos,
     playlist,
     output_folder,
     ffmpeg_string,
     callback: dict[str, Any],
+    jobs: int = 1,
+    processes: int = 0,
+    queue_size: int = 8,
+    journal=None,
+    codec: str = "m4a",
+    cover_size: int = 600,
+    cover_cache_mb: float = 200,
 ):
-    prog = ProgressHook()
-    # print(f"Downloading '{playlist['title']}'...")
-    with tempfile.TemporaryDirectory() as tmpdir:
-        for video in tqdm(
-            videos,
-            desc=playlist["title"],
-            position=1,
-            leave=False,
-            colour="GREEN",
-            bar_format="{desc}: {n_fmt}/{total_fmt}|{bar}|",
-        ):
-            filename = f'{output_folder}/{video["artist"]} - {video["title"]}.m4a'
-            ydl_opts = gen_options(
-                playlist, output_folder, tmpdir, video, ffmpeg_string, prog
+    """Downloads videos through a fetch -> postprocess -> tag & commit pipeline.
+
+    `videos` may be a generator, downloads start as soon as it yields the first
+    video. Callbacks are run from the calling thread, one at a time, after a song has
+    been tagged and moved into output_folder.
+
+    Args:
+        jobs (int, optional): Fetch threads. Defaults to 1.
+        processes (int, optional): Post-processing processes. Defaults to the
+            number of cores.
+        queue_size (int, optional): Capacity of the queues between stages.
+            Defaults to 8.
+        journal (msync.db.Journal, optional): Records the stage reached by every
+            video and resumes interrupted ones. Defaults to None.
+        codec (str, optional): Codec policy, 'm4a' or 'native' to never transcode.
+            Defaults to 'm4a'.
+        cover_size (int, optional): Largest width and height of cover art.
+            Defaults to 600.
+        cover_cache_mb (float, optional): Size cap of the cover cache kept in
+            output_folder. Defaults to 200.
+    """
+    if hasattr(videos, "__len__"):
+        jobs = max(1, min(jobs, len(videos)))
+    partial_folder = os.path.join(output_folder, ".partial")
+    cover_folder = os.path.join(output_folder, ".covers")
+    pipeline = Pipeline(
+        jobs,
+        processes or os.cpu_count() or 1,
+        queue_size,
+        partial_folder,
+        journal,
+        codec,
+        (cover_folder, cover_size),
+    )
+
+    def commit(video, job):
+        if job is None:
+            tqdm.write(
+                "Error occured while trying to download '%s'. Skipping..."
+                % f"https://youtu.be/{video['id']}"
             )
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                try:
-                    ydl.download([video["id"]])
-                    update_metadata(
-                        filename, video["title"], video["artist"]
-                    )  # update with more refined metadata
-                    info = {
-                        "id": video["id"],
-                        "title": video["title"],
-                        "artist": video["artist"],
-                        "file": filename,
-                        "folder": output_folder,
-                    }
-
-                    callback_kwargs = {
-                        callback["info_kwarg"]: info,
-                        **callback["kwargs"],
-                    }
-                    callback["target"](**callback_kwargs)
-
-                except (
-                    youtube_dl.utils.ExtractorError,
-                    youtube_dl.utils.DownloadError,
-                ):
-                    print(
-                        "Error occured while trying to download '%s'. Skipping..."
-                        % f"https://youtu.be/{video['id']}"
-                    )
-                    continue
+            return
+
+        extension = os.path.splitext(job.get("file") or job["audio"])[1]
+        filename = storage_filename(output_folder, video, extension[1:])
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if "file" not in job:  # not tagged before an interruption
+            update_metadata(
+                job["audio"], video["title"], video["artist"], job["url"]
+            )  # update with more refined metadata
+            shutil.move(job["audio"], filename)
+        elif job["file"] != filename:
+            shutil.move(job["file"], filename)
+        job["file"] = filename
+        pipeline.record(video["id"], "tagged", job=job)
+        shutil.rmtree(pipeline.workdir(video), ignore_errors=True)
+
+        info = {
+            "id": video["id"],
+            "title": video["title"],
+            "artist": video["artist"],
+            "file": filename,
+            "folder": output_folder,
+        }
+
+        callback_kwargs = {
+            callback["info_kwarg"]: info,
+            **callback["kwargs"],
+        }
+        callback["target"](**callback_kwargs)
+
+    bars = [ProgressHook(position, pipeline.cancelled) for position in range(jobs)]
+    overall = tqdm(
+        total=0,
+        desc=playlist["title"],
+        position=jobs,
+        leave=False,
+        colour="GREEN",
+        bar_format="{desc}: {n_fmt}/{total_fmt}|{bar}| {postfix}",
+    )
+    try:
+        pipeline.run(videos, ffmpeg_string, commit, bars, overall)
+    finally:
+        overall.close()
+    evict(cover_folder, cover_cache_mb * 1024 * 1024)
 
     print()
+    if pipeline.fed == 0:
+        return
+    print(
+        "Peak queue depths: %s; %d transcoded, %d stream copied"
+        % (
+            ", ".join("%s=%d" % i for i in pipeline.max_depth.items()),
+            pipeline.transcoded,
+            pipeline.copied,
+        )
+    )
+    print(limiter_summary())
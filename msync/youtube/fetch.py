@@ -18,15 +18,20 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+from itertools import chain, islice
+
 import yt_dlp
-from youtube_title_parse import get_artist_title as extract
 from yt_dlp import YoutubeDL
 
+from ..dedupe import source_kind
+from ..titles import TitleParser
+from .ratelimit import LIMITER
+
 
-def fetch_songs(videos_generator) -> list[dict[str, str]]:
-    # collecting relevant information in a dictionary and appending it in the playlist list
-    playlist = []
-    ids = []
+def iter_songs(videos_generator, parser: TitleParser = None):
+    """Yields parsed songs from playlist entries as they arrive, skipping duplicates."""
+    parser = parser or TitleParser()
+    ids = set()
     for i in videos_generator:
         if i["id"] in ids:
             continue
@@ -35,23 +40,82 @@ def fetch_songs(videos_generator) -> list[dict[str, str]]:
             "deleted video",
         ]:  # Check for private/deleted videos
             continue
-        try:
-            # Parse the title to extract only the artist and title.
-            artist, title = extract(i["title"])
-        except TypeError:
-            # Fallback if youtube_title_parse is not able to parse a title.
-            artist, title = (i["channel"], i["title"])
-
-        video = {
+        artist, title = parser.parse(i)
+
+        ids.add(i["id"])
+        yield {
             "id": i["id"],
-            "title": title.replace("/", "-"),  # special case
-            "artist": artist.replace(" - Topic", ""),  # special case
+            "title": title,
+            "artist": artist,
+            "duration": i.get("duration"),
+            "kind": source_kind(i["title"], i.get("channel")),
         }
 
-        ids.append(i["id"])
-        playlist.append(video)
 
-    return playlist
+def fetch_songs(videos_generator, parser: TitleParser = None) -> list[dict[str, str]]:
+    return list(iter_songs(videos_generator, parser))
+
+
+# Entries compared at the start of a playlist to tell whether it changed
+HEAD_SIZE = 5
+
+
+def snapshot_entry(entry: dict) -> dict:
+    return {
+        "id": entry["id"],
+        "title": entry["title"],
+        "channel": entry.get("channel"),
+        "duration": entry.get("duration"),
+    }
+
+
+def iter_entries(playlist: dict, snapshot: dict = None):
+    """Yields the entries of a fetched playlist, enumerating as little as possible.
+
+    A playlist with the snapshot's count and head is taken as unchanged and is not
+    enumerated at all. When new entries were added on top, enumeration stops as soon
+    as it reaches the snapshot's entries. Once exhausted, the playlist's 'entries'
+    key holds every entry and 'enumeration' one of 'full', 'prefix' or 'unchanged'.
+
+    Args:
+        playlist (dict): Playlist from fetch_playlist.
+        snapshot (dict, optional): Last seen state from PlaylistDB. Defaults to None.
+    """
+
+    def ids(items):
+        return [i["id"] for i in items]
+
+    entries = map(snapshot_entry, playlist["videos"])
+    head = list(islice(entries, HEAD_SIZE))
+    known = snapshot["entries"] if snapshot is not None else []
+    playlist["entries"] = seen = []
+
+    if snapshot is not None:
+        if playlist["count"] == len(known) and ids(head) == ids(known[: len(head)]):
+            playlist["enumeration"] = "unchanged"
+            seen.extend(known)
+            yield from known
+            return
+
+    playlist["enumeration"] = "full"
+    entries = chain(head, entries)
+    for entry in entries:
+        if (
+            known
+            and entry["id"] == known[0]["id"]
+            and playlist["count"] == len(seen) + len(known)
+        ):
+            rest = [entry] + list(islice(entries, HEAD_SIZE - 1))
+            if ids(rest) == ids(known[: len(rest)]):
+                playlist["enumeration"] = "prefix"
+                seen.extend(known)
+                yield from known
+                return
+            seen.extend(rest)
+            yield from rest
+            continue
+        seen.append(entry)
+        yield entry
 
 
 class Logger(object):
@@ -65,26 +129,26 @@ class Logger(object):
         pass
 
 
-def fetch_playlist(playlist_IDs: list) -> list[dict]:
-    response = []
+def iter_playlists(playlist_IDs: list):
+    """Yields playlists one by one as their first page is fetched."""
     LINK = "https://www.youtube.com/playlist?list=%s"
     with YoutubeDL(params={"quiet": True, "logger": Logger()}) as dl:
         for pid in playlist_IDs:
             try:
-                info = dl.extract_info(LINK % pid, process=False)
-                response.append(info)
+                with LIMITER.request(slot=False):
+                    i = dl.extract_info(LINK % pid, process=False)
             except yt_dlp.utils.DownloadError as e:
                 print(e)
+                continue
 
-    # collecting relevant information in a dictionary and appending it in the playlist list
-    playlists = []
-    for i in response:
-        playlist = {
-            "id": i["id"],
-            "title": i["title"],
-            "count": i["playlist_count"],
-            "videos": i["entries"],
-        }
-        playlists.append(playlist)
+            # collecting relevant information in a dictionary
+            yield {
+                "id": i["id"],
+                "title": i["title"],
+                "count": i["playlist_count"],
+                "videos": i["entries"],
+            }
 
-    return playlists
+
+def fetch_playlist(playlist_IDs: list) -> list[dict]:
+    return list(iter_playlists(playlist_IDs))
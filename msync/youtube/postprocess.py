@@ -0,0 +1,120 @@
+"""
+msync/youtube/postprocess.py - CPU bound audio post-processing.
+
+Functions here run in worker processes of the downloader pipeline, so they only
+take and return picklable values.
+
+"""
+
+import os
+import subprocess
+
+from ..tags import embed_cover
+from .thumbnails import cover_path
+
+# Codec policies. 'm4a' stream copies AAC and encodes anything else to AAC,
+# 'native' stream copies every codec into its usual container and never encodes.
+CODECS = ("m4a", "native")
+
+# Container of every codec kept by the 'native' policy
+NATIVE_CONTAINERS = {
+    "mp4a": "m4a",
+    "opus": "opus",
+    "vorbis": "ogg",
+    "mp3": "mp3",
+    "flac": "flac",
+}
+FALLBACK_CONTAINER = "mka"  # holds any codec, but can not be tagged
+
+
+def ffmpeg_binary(ffmpeg_string: str) -> str:
+    return os.path.join(ffmpeg_string, "ffmpeg") if ffmpeg_string else "ffmpeg"
+
+
+def run_ffmpeg(ffmpeg_string: str, *args: str):
+    subprocess.run(
+        [
+            ffmpeg_binary(ffmpeg_string),
+            "-y",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            *args,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+
+def output_format(acodec: str, codec: str) -> tuple[str, bool]:
+    """Returns the container extension for a source codec and whether to transcode.
+
+    Args:
+        acodec (str): Source audio codec as reported by yt-dlp, like 'mp4a.40.2'.
+        codec (str): Codec policy, one of CODECS.
+    """
+    family = (acodec or "").split(".")[0]
+    if codec == "native":
+        return NATIVE_CONTAINERS.get(family, FALLBACK_CONTAINER), False
+
+    return "m4a", family != "mp4a"
+
+
+def extract_audio(media: str, output: str, ffmpeg_string: str, transcode: bool):
+    """Extracts the first audio stream of `media`, encoding it to AAC if `transcode`."""
+    codec = ["-c:a", "aac", "-b:a", "192k"] if transcode else ["-c:a", "copy"]
+    run_ffmpeg(ffmpeg_string, "-i", media, "-vn", "-map", "0:a:0", *codec, output)
+
+
+def make_cover(
+    thumbnail: str, digest: str, folder: str, size: int, ffmpeg_string: str
+) -> str:
+    """Converts a thumbnail to a JPEG no larger than `size` into the cover cache.
+
+    Returns:
+        str: path of the cached cover
+    """
+    path = cover_path(folder, digest, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.{os.getpid()}.tmp.jpg"
+    scale = (
+        f"scale='min(iw,{size})':'min(ih,{size})':force_original_aspect_ratio=decrease"
+    )
+    run_ffmpeg(ffmpeg_string, "-i", thumbnail, "-frames:v", "1", "-vf", scale, temp)
+    os.replace(temp, path)
+
+    return path
+
+
+def postprocess(job: dict) -> dict:
+    """Turns a fetched download into a finished audio file next to it.
+
+    Args:
+        job (dict): Fetch stage result with 'media', 'acodec', 'codec', 'ffmpeg'
+            keys, and either a cached 'cover' or a downloaded 'thumbnail' to add
+            to the cover cache described by 'covers' (folder, size).
+
+    Returns:
+        dict: `job` with the 'audio' path and whether it was 'transcoded'.
+    """
+    extension, transcode = output_format(job["acodec"], job.get("codec", "m4a"))
+    audio = os.path.splitext(job["media"])[0] + ".audio." + extension
+    extract_audio(job["media"], audio, job["ffmpeg"], transcode)
+    job["transcoded"] = transcode
+    os.remove(job["media"])
+
+    if not job.get("cover") and job.get("thumbnail"):
+        try:
+            job["cover"] = make_cover(
+                job["thumbnail"], job["thumbnail_digest"], *job["covers"], job["ffmpeg"]
+            )
+        except subprocess.CalledProcessError:
+            pass  # a song without cover art is still a song
+        os.remove(job["thumbnail"])
+    if job.get("cover") and os.path.exists(job["cover"]):
+        with open(job["cover"], "rb") as f:
+            embed_cover(audio, f.read())
+
+    job["audio"] = audio
+    return job
@@ -0,0 +1,253 @@
+"""
+msync/youtube/ratelimit.py - Process-wide limits for requests to YouTube.
+
+Every download and metadata request goes through LIMITER. It combines a token
+bucket for the request rate, a byte rate cap shared fairly by the transfers in
+flight, and AIMD concurrency: the number of concurrent downloads is halved and new
+requests pause when YouTube throttles or answers slowly, and it grows back by about
+one per round of successful requests.
+
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Error messages which mean YouTube is throttling us
+THROTTLE_MARKERS = ("HTTP Error 429", "Too Many Requests")
+
+# Longest pause after repeated throttling, in seconds
+MAX_BACKOFF = 15 * 60
+
+
+class Cancelled(Exception):
+    """Raised when waiting for the limiter was cancelled."""
+
+
+def is_throttled(error: BaseException) -> bool:
+    message = str(error)
+    return any(marker in message for marker in THROTTLE_MARKERS)
+
+
+class TokenBucket:
+    """TokenBucket class.
+
+    Hands out `rate` tokens per second with bursts of up to `burst` tokens. A rate
+    of 0 means unlimited.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns the seconds to wait before using it."""
+        if not self.rate:
+            return 0.0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class Transfer:
+    """State of one request, passed to RateLimiter.consume for every chunk."""
+
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.first_byte = None
+        self.due = self.start  # when the bytes consumed so far may have arrived
+
+    def latency(self) -> float:
+        return (self.first_byte or time.monotonic()) - self.start
+
+
+class RateLimiter:
+    """RateLimiter class.
+
+    Shared by every thread of the process, see `configure` for the limits. The
+    defaults limit nothing.
+    """
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.configure()
+
+    def configure(
+        self,
+        requests_per_minute: float = 0,
+        bandwidth: float = 0,
+        max_concurrency: int = 1,
+        backoff: float = 30.0,
+        slow_seconds: float = 0,
+    ):
+        """Sets the limits and resets statistics.
+
+        Args:
+            requests_per_minute (float, optional): Request rate, 0 is unlimited.
+            bandwidth (float, optional): Bytes per second shared by all transfers,
+                0 is unlimited.
+            max_concurrency (int, optional): Most concurrent downloads. Defaults to 1.
+            backoff (float, optional): Seconds requests pause after throttling,
+                doubled while throttling continues. Defaults to 30.0.
+            slow_seconds (float, optional): Time to first byte above which a request
+                counts as slow, 0 never does.
+        """
+        with self.cond:
+            self.bucket = TokenBucket(requests_per_minute / 60, max(1, max_concurrency))
+            self.bandwidth = bandwidth
+            self.max_concurrency = max(1, max_concurrency)
+            self.limit = float(self.max_concurrency)
+            self.backoff = backoff
+            self.slow_seconds = slow_seconds
+            self.backoff_level = 0
+            self.resume_time = 0.0
+            self.active = 0
+            self.counters = {
+                "requests": 0,
+                "throttled": 0,
+                "slow": 0,
+                "bytes": 0,
+                "waited": 0.0,
+            }
+            self.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                **self.counters,
+                "concurrency": int(self.limit),
+                "max_concurrency": self.max_concurrency,
+            }
+
+    def wait(self, seconds: float, cancelled: threading.Event = None):
+        with self.cond:
+            self.counters["waited"] += seconds
+        if cancelled is None:
+            time.sleep(seconds)
+        elif cancelled.wait(seconds):
+            raise Cancelled()
+
+    def acquire(self, slot: bool, cancelled: threading.Event = None):
+        """Waits out backoff pauses, a free slot if `slot` and a request token."""
+        with self.cond:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise Cancelled()
+                pause = self.resume_time - time.monotonic()
+                if pause > 0:
+                    self.cond.wait(min(pause, 0.5))
+                elif slot and self.active >= int(self.limit):
+                    self.cond.wait(0.5)
+                else:
+                    break
+            if slot:
+                self.active += 1
+            self.counters["requests"] += 1
+
+        delay = self.bucket.reserve()
+        if delay:
+            try:
+                self.wait(delay, cancelled)
+            except Cancelled:
+                self.release(slot)
+                raise
+
+    def release(self, slot: bool):
+        if not slot:
+            return
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def throttled(self):
+        """Multiplicative decrease, and a pause growing while throttling continues."""
+        with self.cond:
+            self.counters["throttled"] += 1
+            self.limit = max(1.0, self.limit / 2)
+            pause = min(MAX_BACKOFF, self.backoff * 2**self.backoff_level)
+            self.backoff_level += 1
+            self.resume_time = max(self.resume_time, time.monotonic() + pause)
+
+    def succeeded(self, latency: float):
+        """Additive increase, unless the request was slow."""
+        with self.cond:
+            if self.slow_seconds and latency > self.slow_seconds:
+                self.counters["slow"] += 1
+                self.limit = max(1.0, self.limit / 2)
+                return
+            self.backoff_level = 0
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    @contextmanager
+    def request(self, slot: bool = True, cancelled: threading.Event = None):
+        """Context manager around one request to YouTube.
+
+        Args:
+            slot (bool, optional): Counts against concurrency, for downloads.
+                Defaults to True.
+            cancelled (threading.Event, optional): Stops waiting once set.
+
+        Raises:
+            Cancelled: `cancelled` was set while waiting
+
+        Yields:
+            Transfer: pass to `consume` for every chunk received.
+        """
+        self.acquire(slot, cancelled)
+        transfer = Transfer()
+        try:
+            yield transfer
+        except Exception as e:
+            if is_throttled(e):
+                self.throttled()
+            raise
+        else:
+            self.succeeded(transfer.latency())
+        finally:
+            self.release(slot)
+
+    def consume(self, transfer: Transfer, nbytes: float):
+        """Accounts received bytes, sleeping to keep the transfer at its share."""
+        now = time.monotonic()
+        if transfer.first_byte is None:
+            transfer.first_byte = now
+
+        with self.cond:
+            self.counters["bytes"] += nbytes
+            if not self.bandwidth:
+                return
+            share = self.bandwidth / max(1, self.active)
+
+        transfer.due = max(transfer.due, now) + nbytes / share
+        if transfer.due - now > 0.01:
+            self.wait(transfer.due - now)
+
+
+LIMITER = RateLimiter()
+
+
+def configure(config: dict):
+    """Configures LIMITER from the user configuration for a new session."""
+    LIMITER.configure(
+        config["requests_per_minute"],
+        config["bandwidth_limit_kib"] * 1024,
+        config["jobs"],
+        config["throttle_backoff_seconds"],
+        config["slow_request_seconds"],
+    )
+
+
+def summary() -> str:
+    return (
+        "Rate limiter: %(requests)d requests, %(throttled)d throttled, %(slow)d slow,"
+        " concurrency %(concurrency)d/%(max_concurrency)d, %(waited).1fs waited"
+        % LIMITER.stats()
+    )
@@ -0,0 +1,111 @@
+"""
+msync/youtube/thumbnails.py - Content-addressed cache of cover art.
+
+Covers are stored once per thumbnail content, converted to JPEG and resized to
+the configured size, as <folder>/<digest[:2]>/<digest>-<size>.jpg where digest is
+the SHA-256 of the downloaded thumbnail. Thumbnail URLs map to their digest under
+<folder>/urls, so a known URL is never fetched again. Cache hits refresh a cover's
+mtime, eviction removes the least recently used covers beyond the size cap.
+
+"""
+
+import hashlib
+import os
+
+URLS_FOLDER = "urls"
+
+
+def url_file(folder: str, url: str) -> str:
+    return os.path.join(folder, URLS_FOLDER, hashlib.sha1(url.encode()).hexdigest())
+
+
+def cover_path(folder: str, digest: str, size: int) -> str:
+    return os.path.join(folder, digest[:2], f"{digest}-{size}.jpg")
+
+
+def write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def touch(path: str) -> bool:
+    """Marks a cover as recently used, False if it is not cached."""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def cached_cover(folder: str, url: str, size: int):
+    """Returns the cached cover of a thumbnail URL, None if unknown."""
+    try:
+        with open(url_file(folder, url)) as f:
+            digest = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    path = cover_path(folder, digest, size)
+    return path if touch(path) else None
+
+
+def add_thumbnail(folder: str, url: str, data: bytes, size: int) -> tuple[str, str]:
+    """Records a downloaded thumbnail.
+
+    Returns:
+        tuple[str, str]: its digest, and its cached cover or "" if it still has to
+            be made with msync.youtube.postprocess.make_cover.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    write_atomic(url_file(folder, url), digest.encode())
+
+    path = cover_path(folder, digest, size)
+    return digest, path if touch(path) else ""
+
+
+def evict(folder: str, max_bytes: int) -> tuple[int, int]:
+    """Removes least recently used covers until the cache fits in `max_bytes`.
+
+    URL entries of covers which are gone are removed as well.
+
+    Returns:
+        tuple[int, int]: covers removed, bytes freed
+    """
+    covers = []  # (mtime, size, path)
+    urls = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if os.path.basename(root) == URLS_FOLDER:
+                urls.append(path)
+            elif name.endswith(".jpg"):
+                covers.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in covers)
+    removed, freed = 0, 0
+    for _, size, path in sorted(covers):
+        if total - freed <= max_bytes:
+            break
+        os.remove(path)
+        removed += 1
+        freed += size
+
+    if removed:
+        digests = {
+            os.path.basename(path).split("-")[0]
+            for _, _, path in covers
+            if os.path.exists(path)
+        }
+        for path in urls:
+            with open(path) as f:
+                if f.read().strip() not in digests:
+                    os.remove(path)
+
+    return removed, freed
@@ -18,16 +18,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
 
-import ffmpeg
 import os
 import shutil
 import json
 import datetime
 import sys
 
+from ..scan import video_id
+from ..tags import read_tags
+
 
 def get_video_id(media_file: str) -> str:
-    return ffmpeg.probe(media_file)['format']['tags']['purl'].split("=")[-1]
+    return video_id(read_tags(media_file)["url"])
 
 
 def ensure_folder(path: str):
@@ -0,0 +1,53 @@
+import struct
+
+from mutagen.mp4 import MP4
+
+from msync.tags import read_tags, write_tags
+from msync.youtube.utils import get_video_id
+
+URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+
+def atom(name: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", 8 + len(data)) + name + data
+
+
+def m4a(path, tags: dict):
+    """Writes an MP4 file without audio, tagged like ffmpeg would."""
+    mvhd = atom(b"mvhd", bytes(4) + struct.pack(">IIII", 0, 0, 1000, 0) + bytes(80))
+    with open(path, "wb") as f:
+        f.write(atom(b"ftyp", b"M4A \0\0\0\0M4A isom") + atom(b"moov", mvhd))
+    audio = MP4(path)
+    audio.add_tags()
+    audio.update(tags)
+    audio.save()
+
+
+def test_mp4_url_from_msync_tags(tmp_path):
+    path = str(tmp_path / "song.m4a")
+    m4a(path, {})
+    write_tags(path, "Title", "Artist", URL)
+
+    assert read_tags(path) == {"title": "Title", "artist": "Artist", "url": URL}
+
+
+def test_mp4_url_from_ffmpeg_purl(tmp_path):
+    path = str(tmp_path / "song.m4a")
+    m4a(path, {"\xa9nam": ["Title"], "\xa9ART": ["Artist"], "purl": [URL]})
+
+    assert read_tags(path)["url"] == URL
+    assert get_video_id(path) == "dQw4w9WgXcQ"
+
+
+def test_mp4_url_from_ffmpeg_comment(tmp_path):
+    path = str(tmp_path / "song.m4a")
+    m4a(path, {"\xa9nam": ["Title"], "\xa9cmt": [URL]})
+
+    assert read_tags(path)["url"] == URL
+
+
+def test_mp4_comment_without_url(tmp_path):
+    path = str(tmp_path / "song.m4a")
+    m4a(path, {"\xa9nam": ["Title"], "\xa9cmt": ["Great song"]})
+
+    assert read_tags(path)["url"] == ""